@@ -0,0 +1,65 @@
+"""
+Локальная заглушка Robokassa /Merchant/Recurring для проверки автосписаний
+без обращения к боевому API.
+
+Запуск:
+    FAKE_ROBOKASSA_LATENCY_MS=200 FAKE_ROBOKASSA_FAIL_RATE=0.1 \
+        uvicorn bench.fake_robokassa:app --port 8081
+В .env бота:
+    ROBOKASSA_RECURRING_URL=http://127.0.0.1:8081/Merchant/Recurring
+
+GET /stats — сколько запросов пришло, сколько отвечено ошибкой,
+максимальная одновременная нагрузка.
+"""
+
+import asyncio
+import os
+import random
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+
+LATENCY_MS = float(os.getenv("FAKE_ROBOKASSA_LATENCY_MS", "100"))
+FAIL_RATE = float(os.getenv("FAKE_ROBOKASSA_FAIL_RATE", "0"))
+
+REQUIRED_FIELDS = (
+    "MerchantLogin",
+    "InvoiceID",
+    "PreviousInvoiceID",
+    "OutSum",
+    "SignatureValue",
+    "Shp_interface",
+    "Shp_user_id",
+)
+
+app = FastAPI(title="Fake Robokassa Recurring")
+
+stats = {"requests": 0, "failed": 0, "in_flight": 0, "max_in_flight": 0}
+
+
+@app.post("/Merchant/Recurring", response_class=PlainTextResponse)
+async def recurring(request: Request):
+    form = await request.form()
+    stats["requests"] += 1
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        await asyncio.sleep(LATENCY_MS / 1000)
+
+        missing = [k for k in REQUIRED_FIELDS if k not in form]
+        if missing:
+            stats["failed"] += 1
+            return PlainTextResponse(f"ERROR missing {','.join(missing)}", status_code=400)
+
+        if random.random() < FAIL_RATE:
+            stats["failed"] += 1
+            return PlainTextResponse("ERROR declined")
+
+        return PlainTextResponse(f"OK{form['InvoiceID']}")
+    finally:
+        stats["in_flight"] -= 1
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
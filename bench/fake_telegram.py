@@ -0,0 +1,243 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочного теста бота.
+
+Отвечает на getMe, getUpdates (long polling), deleteWebhook, sendMessage,
+sendPhoto, sendDocument, answerCallbackQuery, banChatMember, unbanChatMember,
+deleteMessage, createChatInviteLink; остальные методы — {"ok": true, "result": true}.
+Методы, которые ходят в чат, отвечают с задержкой FAKE_TELEGRAM_LATENCY_MS
+и с долей FAKE_TELEGRAM_429_RATE — ошибкой 429 (retry_after FAKE_TELEGRAM_RETRY_AFTER).
+
+Запуск отдельно:
+    FAKE_TELEGRAM_LATENCY_MS=50 FAKE_TELEGRAM_429_RATE=0.01 \
+        uvicorn bench.fake_telegram:app --port 8082
+В .env бота:
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8082/bot
+
+POST /bench/updates — положить апдейт (объект Update без update_id) в очередь getUpdates.
+GET /stats — запросы по методам, ответы 429, максимальная одновременная нагрузка.
+
+bench/load_funnel.py поднимает заглушку в своём процессе и ждёт ответы бота
+напрямую (FakeTelegram.send_and_wait).
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import random
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+LATENCY_MS = float(os.getenv("FAKE_TELEGRAM_LATENCY_MS", "30"))
+RATE_LIMIT_RATE = float(os.getenv("FAKE_TELEGRAM_429_RATE", "0"))
+RETRY_AFTER = int(os.getenv("FAKE_TELEGRAM_RETRY_AFTER", "1"))
+
+BOT_USER = {
+    "id": 7000000001,
+    "is_bot": True,
+    "first_name": "Korkut Bench",
+    "username": "korkut_bench_bot",
+}
+
+# Служебные методы: без задержки и без 429
+CONTROL_METHODS = {"getme", "getupdates", "deletewebhook", "setwebhook", "getwebhookinfo", "close", "logout"}
+
+# Методы, которые отправляют сообщение в чат (ответ бота на шаг воронки)
+REPLY_METHODS = {"sendmessage", "sendphoto", "senddocument"}
+
+
+def _parse_json(value: Any) -> Any:
+    if isinstance(value, str) and value[:1] in ("{", "["):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.updates: deque = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        # chat_id -> ожидающие следующего сообщения бота в этот чат
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+        # chat_id -> сколько сообщений бот отправил в чат
+        self.sent_by_chat: Counter = Counter()
+        self.stats: Dict[str, Any] = {
+            "requests": {},
+            "rate_limited": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+        }
+
+    # -------------------
+    # Апдейты для бота
+    # -------------------
+    def push_update(self, update: Dict[str, Any]) -> int:
+        update_id = next(self._update_ids)
+        self.updates.append({"update_id": update_id, **update})
+        self._new_updates.set()
+        return update_id
+
+    async def send_and_wait(self, update: Dict[str, Any], chat_id: int, timeout: float) -> Dict[str, Any]:
+        """Положить апдейт и дождаться следующего сообщения бота в chat_id (asyncio.TimeoutError — не дождались)."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append(future)
+        self.push_update(update)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self._waiters.get(chat_id)
+            if waiters and future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._waiters.pop(chat_id, None)
+
+    async def get_updates(self, offset: int, limit: int, timeout: float) -> List[Dict[str, Any]]:
+        # offset подтверждает всё, что бот уже получил
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, limit))
+
+    # -------------------
+    # Методы Bot API
+    # -------------------
+    def _message(self, chat_id: int, **fields) -> Dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+            "from": BOT_USER,
+            **{k: v for k, v in fields.items() if v is not None},
+        }
+
+    def _deliver(self, chat_id: int, message: Dict[str, Any]):
+        self.sent_by_chat[chat_id] += 1
+        waiters = self._waiters.get(chat_id)
+        if waiters:
+            future = waiters.pop(0)
+            if not future.done():
+                future.set_result(message)
+
+    async def call(self, method: str, params: Dict[str, Any]) -> JSONResponse:
+        name = method.lower()
+        self.stats["requests"][method] = self.stats["requests"].get(method, 0) + 1
+
+        if name == "getupdates":
+            updates = await self.get_updates(
+                int(params.get("offset") or 0),
+                int(params.get("limit") or 100),
+                float(params.get("timeout") or 0),
+            )
+            return _ok(updates)
+        if name == "getme":
+            return _ok(BOT_USER)
+        if name in CONTROL_METHODS:
+            return _ok(True)
+
+        self.stats["in_flight"] += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+        try:
+            await asyncio.sleep(LATENCY_MS / 1000)
+            if random.random() < RATE_LIMIT_RATE:
+                self.stats["rate_limited"] += 1
+                return JSONResponse(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": f"Too Many Requests: retry after {RETRY_AFTER}",
+                        "parameters": {"retry_after": RETRY_AFTER},
+                    },
+                    status_code=429,
+                )
+            return self._answer(name, params)
+        finally:
+            self.stats["in_flight"] -= 1
+
+    def _answer(self, name: str, params: Dict[str, Any]) -> JSONResponse:
+        if name not in REPLY_METHODS:
+            if name == "createchatinvitelink":
+                return _ok({
+                    "invite_link": f"https://t.me/+bench{next(self._file_ids)}",
+                    "creator": BOT_USER,
+                    "creates_join_request": False,
+                    "is_primary": False,
+                    "is_revoked": False,
+                })
+            return _ok(True)
+
+        chat_id = int(params["chat_id"])
+        reply_markup = _parse_json(params.get("reply_markup"))
+        if name == "sendmessage":
+            message = self._message(chat_id, text=params.get("text"), reply_markup=reply_markup)
+        elif name == "sendphoto":
+            photo = params.get("photo")
+            if isinstance(photo, str):
+                if not photo.startswith("bench-"):
+                    # file_id настоящего Telegram заглушка не знает — бот загрузит файл заново
+                    return JSONResponse(
+                        {"ok": False, "error_code": 400, "description": "Bad Request: wrong file identifier/HTTP URL specified"},
+                        status_code=400,
+                    )
+                file_id = photo
+            else:
+                file_id = f"bench-photo-{next(self._file_ids)}"
+            sizes = [
+                {"file_id": file_id, "file_unique_id": file_id, "width": w, "height": h}
+                for w, h in ((90, 90), (800, 800))
+            ]
+            message = self._message(chat_id, photo=sizes, caption=params.get("caption"), reply_markup=reply_markup)
+        else:
+            file_id = f"bench-document-{next(self._file_ids)}"
+            message = self._message(
+                chat_id,
+                document={"file_id": file_id, "file_unique_id": file_id},
+                caption=params.get("caption"),
+            )
+        self._deliver(chat_id, message)
+        return _ok(message)
+
+
+def _ok(result: Any) -> JSONResponse:
+    return JSONResponse({"ok": True, "result": result})
+
+
+telegram = FakeTelegram()
+
+app = FastAPI(title="Fake Telegram Bot API")
+
+
+@app.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+async def bot_api(token: str, method: str, request: Request):
+    params: Dict[str, Any] = dict(request.query_params)
+    if request.method == "POST":
+        if request.headers.get("content-type", "").startswith("application/json"):
+            params.update(await request.json())
+        else:
+            form = await request.form()
+            params.update({k: v for k, v in form.items()})
+    return await telegram.call(method, params)
+
+
+@app.post("/bench/updates")
+async def add_update(request: Request):
+    update_id = telegram.push_update(await request.json())
+    return {"update_id": update_id}
+
+
+@app.get("/stats")
+async def get_stats():
+    return {**telegram.stats, "queued_updates": len(telegram.updates)}
@@ -0,0 +1,308 @@
+"""
+Нагрузочный тест воронки: сколько одновременных пользователей выдерживает бот.
+
+Скрипт поднимает заглушку Bot API (bench/fake_telegram.py) в своём процессе,
+запускает настоящий bot.py отдельным процессом (polling к заглушке, локальный
+Postgres) и прогоняет синтетических пользователей по шагам
+/start → funnel_story2 … funnel_story7 → funnel_offer_agreement.
+Время шага — от появления апдейта в getUpdates до ответа бота в этот чат.
+Пока идёт тест, с /metrics бота снимаются занятость пула БД и очередь апдейтов.
+
+Запуск из корня репозитория (только на локальной базе: бот пишет пользователей,
+очередь ретаргетинга и media_cache; после теста строки тестовых пользователей удаляются):
+    BENCH_USERS=300 BENCH_RAMP_SECONDS=10 FAKE_TELEGRAM_LATENCY_MS=50 \
+        DATABASE_URL=postgresql://postgres@127.0.0.1:5432/korkut python -m bench.load_funnel
+
+Настройки (окружение):
+    BENCH_USERS — сколько пользователей (200), BENCH_RAMP_SECONDS — за сколько секунд
+    они приходят (10), BENCH_THINK_MS — пауза пользователя между шагами (500),
+    BENCH_STEP_TIMEOUT — сколько ждать ответа на шаг, сек (60),
+    BENCH_FAKE_PORT (8082), BENCH_METRICS_PORT (9102), BENCH_POOL_LIMIT — размер пула
+    для доли насыщения (15: pool_size 5 + max_overflow 10 SQLAlchemy по умолчанию),
+    BENCH_RESULT_JSON — файл для результата (сравнение до/после), BENCH_BOT_LOG — лог бота;
+    FAKE_TELEGRAM_* — задержка и 429 заглушки. Остальное окружение (UPDATE_CONCURRENCY,
+    TELEGRAM_GLOBAL_RATE_PER_SEC, ...) передаётся боту как есть.
+"""
+
+import asyncio
+import json
+import math
+import os
+import signal
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+import psycopg
+import uvicorn
+
+from bench.fake_telegram import app as fake_app, telegram
+from change_feed import to_psycopg_conninfo
+from config import DATABASE_URL
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+USERS = int(os.getenv("BENCH_USERS", "200"))
+RAMP_SECONDS = float(os.getenv("BENCH_RAMP_SECONDS", "10"))
+THINK_MS = float(os.getenv("BENCH_THINK_MS", "500"))
+STEP_TIMEOUT = float(os.getenv("BENCH_STEP_TIMEOUT", "60"))
+FAKE_PORT = int(os.getenv("BENCH_FAKE_PORT", "8082"))
+METRICS_PORT = int(os.getenv("BENCH_METRICS_PORT", "9102"))
+POOL_LIMIT = int(os.getenv("BENCH_POOL_LIMIT", "15"))
+USER_ID_BASE = int(os.getenv("BENCH_USER_ID_BASE", "8000000000"))
+RESULT_JSON = os.getenv("BENCH_RESULT_JSON", "")
+BOT_LOG = os.getenv("BENCH_BOT_LOG", str(Path(tempfile.gettempdir()) / "korkut-bench-bot.log"))
+
+STEPS = ["start"] + [f"funnel_story{i}" for i in range(2, 8)] + ["funnel_offer_agreement"]
+
+# Что снимать с /metrics бота
+SAMPLED_GAUGES = ("korkut_db_pool_checked_out", "korkut_updates_in_flight", "korkut_updates_queued")
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # nearest-rank
+    index = max(math.ceil(p / 100 * len(ordered)) - 1, 0)
+    return ordered[index]
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id - USER_ID_BASE}"}
+
+
+def start_update(user_id: int) -> Dict[str, Any]:
+    return {
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        }
+    }
+
+
+def callback_update(user_id: int, data: str, message: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "callback_query": {
+            "id": uuid.uuid4().hex,
+            "from": _user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": message,
+        }
+    }
+
+
+class FunnelLoad:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {step: [] for step in STEPS}
+        self.timeouts: Dict[str, int] = {step: 0 for step in STEPS}
+        self.completed = 0
+        self.samples: Dict[str, List[float]] = {name: [] for name in SAMPLED_GAUGES}
+
+    async def run_user(self, index: int):
+        user_id = USER_ID_BASE + index
+        await asyncio.sleep(RAMP_SECONDS * index / max(USERS, 1))
+        message: Optional[Dict[str, Any]] = None
+        for step in STEPS:
+            update = start_update(user_id) if step == "start" else callback_update(user_id, step, message)
+            started = time.perf_counter()
+            try:
+                message = await telegram.send_and_wait(update, user_id, STEP_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.timeouts[step] += 1
+                return
+            self.latencies[step].append(time.perf_counter() - started)
+            await asyncio.sleep(THINK_MS / 1000)
+        self.completed += 1
+
+    async def sample_metrics(self, client: httpx.AsyncClient, stop: asyncio.Event):
+        while not stop.is_set():
+            try:
+                response = await client.get(f"http://127.0.0.1:{METRICS_PORT}/metrics")
+                for line in response.text.splitlines():
+                    name, _, value = line.partition(" ")
+                    if name in self.samples:
+                        self.samples[name].append(float(value))
+            except httpx.HTTPError:
+                pass
+            try:
+                await asyncio.wait_for(stop.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        steps = {}
+        for step in STEPS:
+            values = self.latencies[step]
+            steps[step] = {
+                "count": len(values),
+                "timeouts": self.timeouts[step],
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": max(values, default=0.0) * 1000,
+            }
+        handled = sum(len(v) for v in self.latencies.values())
+        pool = self.samples["korkut_db_pool_checked_out"]
+        gauges = {
+            name.replace("korkut_", ""): {
+                "mean": sum(values) / len(values) if values else 0.0,
+                "p95": percentile(values, 95),
+                "max": max(values, default=0.0),
+            }
+            for name, values in self.samples.items()
+        }
+        return {
+            "users": USERS,
+            "completed": self.completed,
+            "elapsed": elapsed,
+            "updates_per_sec": handled / elapsed if elapsed else 0.0,
+            "funnels_per_sec": self.completed / elapsed if elapsed else 0.0,
+            "steps": steps,
+            "gauges": gauges,
+            "pool_limit": POOL_LIMIT,
+            "pool_saturated_share": sum(1 for v in pool if v >= POOL_LIMIT) / len(pool) if pool else 0.0,
+            "telegram": dict(telegram.stats, requests=dict(telegram.stats["requests"])),
+            "settings": {
+                "ramp_seconds": RAMP_SECONDS,
+                "think_ms": THINK_MS,
+                "fake_latency_ms": float(os.getenv("FAKE_TELEGRAM_LATENCY_MS", "30")),
+                "fake_429_rate": float(os.getenv("FAKE_TELEGRAM_429_RATE", "0")),
+                "update_concurrency": os.getenv("UPDATE_CONCURRENCY", "(по умолчанию)"),
+            },
+        }
+
+
+def print_report(result: Dict[str, Any]):
+    print()
+    print(
+        f"Пользователей: {result['users']}, прошли воронку: {result['completed']}, "
+        f"за {result['elapsed']:.1f} сек"
+    )
+    print(
+        f"Пропускная способность: {result['updates_per_sec']:.1f} апдейтов/с, "
+        f"{result['funnels_per_sec']:.2f} воронок/с"
+    )
+    print()
+    print(f"{'Шаг':<24} {'n':>6} {'таймаут':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (мс)")
+    for step, s in result["steps"].items():
+        print(
+            f"{step:<24} {s['count']:>6} {s['timeouts']:>8} {s['p50_ms']:>8.0f} "
+            f"{s['p95_ms']:>8.0f} {s['p99_ms']:>8.0f} {s['max_ms']:>8.0f}"
+        )
+    print()
+    pool = result["gauges"]["db_pool_checked_out"]
+    print(
+        f"Пул БД, занято соединений: среднее {pool['mean']:.1f}, p95 {pool['p95']:.0f}, максимум {pool['max']:.0f}; "
+        f"≥ {result['pool_limit']} в {result['pool_saturated_share']:.0%} замеров"
+    )
+    for name in ("updates_in_flight", "updates_queued"):
+        g = result["gauges"][name]
+        print(f"{name}: среднее {g['mean']:.1f}, p95 {g['p95']:.0f}, максимум {g['max']:.0f}")
+    tg = result["telegram"]
+    calls = ", ".join(f"{m} {n}" for m, n in sorted(tg["requests"].items()))
+    print(f"Bot API: {calls}; ответов 429: {tg['rate_limited']}, одновременно до {tg['max_in_flight']}")
+
+
+async def cleanup_users():
+    """Удалить строки тестовых пользователей и file_id заглушки из media_cache."""
+    async with await psycopg.AsyncConnection.connect(to_psycopg_conninfo(DATABASE_URL), autocommit=True) as conn:
+        for table in ("retargeting_schedule", "questions", "users"):
+            await conn.execute(
+                f"DELETE FROM {table} WHERE user_id BETWEEN %s AND %s",
+                (USER_ID_BASE, USER_ID_BASE + USERS),
+            )
+        await conn.execute("DELETE FROM media_cache WHERE file_id LIKE 'bench-%%'")
+
+
+async def start_bot(log) -> asyncio.subprocess.Process:
+    env = dict(os.environ)
+    env.update(
+        TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{FAKE_PORT}/bot",
+        TELEGRAM_WEBHOOK_MODE="false",
+        METRICS_HOST="127.0.0.1",
+        METRICS_PORT=str(METRICS_PORT),
+        DATABASE_URL=DATABASE_URL,
+    )
+    env.setdefault("TELEGRAM_TOKEN", "123456:bench")
+    env.setdefault("ROBOKASSA_MERCHANT_LOGIN", "bench")
+    env.setdefault("ROBOKASSA_PASSWORD_1", "bench")
+    env.setdefault("ROBOKASSA_PASSWORD_2", "bench")
+    return await asyncio.create_subprocess_exec(
+        sys.executable, "bot.py", cwd=BASE_DIR, env=env, stdout=log, stderr=log
+    )
+
+
+async def stop_bot(bot: asyncio.subprocess.Process):
+    if bot.returncode is not None:
+        return
+    bot.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(bot.wait(), 30)
+    except asyncio.TimeoutError:
+        bot.kill()
+        await bot.wait()
+
+
+async def wait_bot_ready(bot: asyncio.subprocess.Process, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while not telegram.stats["requests"].get("getUpdates"):
+        if bot.returncode is not None:
+            raise RuntimeError(f"Бот завершился с кодом {bot.returncode}, см. {BOT_LOG}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Бот не начал getUpdates за {timeout:.0f} сек, см. {BOT_LOG}")
+        await asyncio.sleep(0.2)
+
+
+async def main():
+    if not DATABASE_URL:
+        print("Ошибка: DATABASE_URL должен указывать на локальный Postgres")
+        sys.exit(1)
+
+    server = uvicorn.Server(uvicorn.Config(fake_app, host="127.0.0.1", port=FAKE_PORT, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    load = FunnelLoad()
+    with open(BOT_LOG, "w") as log:
+        bot = await start_bot(log)
+        print(f"Бот запущен (лог: {BOT_LOG}), ждём getUpdates...")
+        try:
+            await wait_bot_ready(bot)
+            # Бот уже применил миграции; остатки прерванного прошлого прогона — убрать
+            await cleanup_users()
+            print(f"Пользователей: {USERS}, приходят за {RAMP_SECONDS:.0f} сек, шагов: {len(STEPS)}")
+
+            stop = asyncio.Event()
+            async with httpx.AsyncClient(timeout=2) as client:
+                sampler = asyncio.create_task(load.sample_metrics(client, stop))
+                started = time.perf_counter()
+                await asyncio.gather(*(load.run_user(i) for i in range(USERS)))
+                elapsed = time.perf_counter() - started
+                stop.set()
+                await sampler
+        finally:
+            await stop_bot(bot)
+            server.should_exit = True
+            await server_task
+            await cleanup_users()
+
+    result = load.report(elapsed)
+    print_report(result)
+    if RESULT_JSON:
+        Path(RESULT_JSON).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+        print(f"Результат сохранён в {RESULT_JSON}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,376 @@
+"""
+Нагрузочный тест Result URL Robokassa (webhook.py): пропускная способность
+и идемпотентность под повторами уведомлений.
+
+Скрипт запускает webhook.py отдельным процессом (uvicorn, локальный Postgres,
+Bot API — заглушка bench/fake_telegram.py в процессе скрипта) и отправляет
+в POST /robokassa/result формы OutSum/InvId/SignatureValue/Shp_user_id/Shp_interface,
+подписанные так, как их проверяет verify_payment_signature (ROBOKASSA_PASSWORD_2).
+Виды платежей:
+- new — первый платёж нового пользователя, одно уведомление;
+- duplicate — то же, но уведомление приходит 1 + BENCH_DUPLICATE_COPIES раз одновременно
+  (Robokassa повторяет Result URL, пока не получит OK);
+- pending — подтверждение висящего автосписания: перед тестом пользователю
+  создаётся подписка с pending_inv_id, уведомление приходит по этому inv_id.
+
+После теста в БД ищутся двойные продления: больше одной активной подписки,
+больше одного платежа на пользователя или срок, продлённый больше чем на период;
+по заглушке — больше одного сообщения об оплате в чат.
+
+Запуск из корня репозитория (только на локальной базе, тестовые строки удаляются):
+    BENCH_PAYMENTS=2000 BENCH_CONCURRENCY=100 BENCH_MIX=new=0.5,duplicate=0.4,pending=0.1 \
+        DATABASE_URL=postgresql://postgres@127.0.0.1:5432/korkut python -m bench.webhook_bench
+
+Настройки (окружение): BENCH_PAYMENTS (1000), BENCH_CONCURRENCY — запросов одновременно (50),
+BENCH_MIX (new=0.6,duplicate=0.3,pending=0.1), BENCH_DUPLICATE_COPIES (3),
+BENCH_WEBHOOK_PORT (8083), BENCH_WEBHOOK_WORKERS — процессов uvicorn (1),
+BENCH_FAKE_PORT (8082), BENCH_SEED, BENCH_RESULT_JSON, BENCH_WEBHOOK_LOG; FAKE_TELEGRAM_* — заглушка.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+
+import httpx
+import psycopg
+import uvicorn
+
+from bench.fake_telegram import app as fake_app, telegram
+from bench.load_funnel import percentile
+from change_feed import to_psycopg_conninfo
+from config import DATABASE_URL, RENEWAL_PERIOD_DAYS, ROBOKASSA_PASSWORD_2, SUBSCRIPTION_PRICE
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+PAYMENTS = int(os.getenv("BENCH_PAYMENTS", "1000"))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "50"))
+MIX = os.getenv("BENCH_MIX", "new=0.6,duplicate=0.3,pending=0.1")
+DUPLICATE_COPIES = int(os.getenv("BENCH_DUPLICATE_COPIES", "3"))
+WEBHOOK_PORT = int(os.getenv("BENCH_WEBHOOK_PORT", "8083"))
+WEBHOOK_WORKERS = int(os.getenv("BENCH_WEBHOOK_WORKERS", "1"))
+FAKE_PORT = int(os.getenv("BENCH_FAKE_PORT", "8082"))
+SEED = int(os.getenv("BENCH_SEED", "1"))
+USER_ID_BASE = int(os.getenv("BENCH_USER_ID_BASE", "8100000000"))
+INV_ID_BASE = int(os.getenv("BENCH_INV_ID_BASE", "1900000000"))
+RESULT_JSON = os.getenv("BENCH_RESULT_JSON", "")
+WEBHOOK_LOG = os.getenv("BENCH_WEBHOOK_LOG", str(Path(tempfile.gettempdir()) / "korkut-bench-webhook.log"))
+
+# Пароль #2 общий для скрипта и запущенного им webhook.py
+PASSWORD_2 = ROBOKASSA_PASSWORD_2 or "bench"
+PERIOD_DAYS = RENEWAL_PERIOD_DAYS or 30
+OUT_SUM = f"{float(SUBSCRIPTION_PRICE):.6f}"
+
+KINDS = ("new", "duplicate", "pending")
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    weights = {kind: 0.0 for kind in KINDS}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in weights:
+            raise ValueError(f"Неизвестный вид платежа в BENCH_MIX: {kind}")
+        weights[kind] = float(weight)
+    if not sum(weights.values()):
+        raise ValueError("BENCH_MIX: все доли нулевые")
+    return weights
+
+
+def sign(out_sum: str, inv_id: int, user_id: int) -> str:
+    """Подпись Result URL, как её проверяет bot.verify_payment_signature."""
+    base = f"{out_sum}:{inv_id}:{PASSWORD_2}:Shp_interface=link:Shp_user_id={user_id}"
+    return hashlib.md5(base.encode()).hexdigest().upper()
+
+
+def result_form(inv_id: int, user_id: int) -> Dict[str, str]:
+    return {
+        "OutSum": OUT_SUM,
+        "InvId": str(inv_id),
+        "SignatureValue": sign(OUT_SUM, inv_id, user_id),
+        "Shp_user_id": str(user_id),
+        "Shp_interface": "link",
+    }
+
+
+class WebhookLoad:
+    def __init__(self, payments: List[Dict[str, Any]]):
+        self.payments = payments
+        self.latencies: Dict[str, List[float]] = {kind: [] for kind in KINDS}
+        self.errors: Counter = Counter()
+        self.requests = 0
+
+    async def post(self, client: httpx.AsyncClient, slots: asyncio.Semaphore, payment: Dict[str, Any]):
+        async with slots:
+            started = time.perf_counter()
+            try:
+                response = await client.post("/robokassa/result", data=result_form(payment["inv_id"], payment["user_id"]))
+            except httpx.HTTPError as e:
+                self.errors[type(e).__name__] += 1
+                return
+            finally:
+                self.requests += 1
+            self.latencies[payment["kind"]].append(time.perf_counter() - started)
+            if response.status_code != 200 or response.text != f"OK{payment['inv_id']}":
+                self.errors[f"HTTP {response.status_code}"] += 1
+
+    async def run_payment(self, client: httpx.AsyncClient, slots: asyncio.Semaphore, payment: Dict[str, Any]):
+        copies = 1 + DUPLICATE_COPIES if payment["kind"] == "duplicate" else 1
+        # Повторы одного уведомления — одновременно, как при ретраях Robokassa после таймаута
+        await asyncio.gather(*(self.post(client, slots, payment) for _ in range(copies)))
+
+
+def build_payments(weights: Dict[str, float]) -> List[Dict[str, Any]]:
+    rng = random.Random(SEED)
+    kinds = rng.choices(list(weights), weights=list(weights.values()), k=PAYMENTS)
+    return [
+        {"kind": kind, "user_id": USER_ID_BASE + i, "inv_id": INV_ID_BASE + i}
+        for i, kind in enumerate(kinds)
+    ]
+
+
+def _conninfo() -> str:
+    return to_psycopg_conninfo(DATABASE_URL)
+
+
+async def cleanup():
+    """Удалить строки тестовых пользователей."""
+    last_user = USER_ID_BASE + PAYMENTS
+    async with await psycopg.AsyncConnection.connect(_conninfo(), autocommit=True) as conn:
+        for table, column in (
+            ("message_deletions", "chat_id"),
+            ("retargeting_schedule", "user_id"),
+            ("payments", "user_id"),
+            ("subscriptions", "user_id"),
+            ("users", "user_id"),
+        ):
+            await conn.execute(
+                f"DELETE FROM {table} WHERE {column} BETWEEN %s AND %s",
+                (USER_ID_BASE, last_user),
+            )
+
+
+async def seed_pending(payments: List[Dict[str, Any]]) -> Dict[int, Any]:
+    """Подписки с висящим автосписанием для pending-платежей; возвращает user_id -> expires_at до теста."""
+    pending = [p for p in payments if p["kind"] == "pending"]
+    seeded = {}
+    async with await psycopg.AsyncConnection.connect(_conninfo()) as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany(
+                "INSERT INTO users (user_id, username) VALUES (%s, %s)",
+                [(p["user_id"], f"bench_{p['user_id']}") for p in pending],
+            )
+            for p in pending:
+                await cur.execute(
+                    """
+                    INSERT INTO subscriptions (
+                        user_id, expires_at, active, anchor_inv_id, next_charge_at,
+                        pending_inv_id, pending_amount, pending_created_at
+                    )
+                    VALUES (%s, now() + interval '1 day', TRUE, %s, now(), %s, %s, now())
+                    RETURNING expires_at
+                    """,
+                    (p["user_id"], p["inv_id"] - PAYMENTS, p["inv_id"], float(SUBSCRIPTION_PRICE)),
+                )
+                seeded[p["user_id"]] = (await cur.fetchone())[0]
+    return seeded
+
+
+def _naive_utc(dt: datetime) -> datetime:
+    # created_at и expires_at могут быть разных типов (timestamp / timestamptz)
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo else dt
+
+
+async def find_double_renewals(payments: List[Dict[str, Any]], seeded: Dict[int, Any]) -> List[str]:
+    """Пользователи, которым один платёж засчитан больше одного раза."""
+    by_user = {p["user_id"]: p for p in payments}
+    problems = []
+    async with await psycopg.AsyncConnection.connect(_conninfo()) as conn:
+        cur = await conn.execute(
+            """
+            SELECT s.user_id,
+                   count(*) AS active_subscriptions,
+                   max(s.expires_at) AS expires_at,
+                   min(s.created_at) AS created_at,
+                   (SELECT count(*) FROM payments p WHERE p.user_id = s.user_id) AS payments
+            FROM subscriptions s
+            WHERE s.user_id BETWEEN %s AND %s AND s.active = TRUE
+            GROUP BY s.user_id
+            """,
+            (USER_ID_BASE, USER_ID_BASE + PAYMENTS),
+        )
+        rows = {row[0]: row[1:] for row in await cur.fetchall()}
+
+    # Продление на два периода видно при любой таймзоне колонок
+    limit = PERIOD_DAYS * 1.5 * 86400
+    for user_id, payment in by_user.items():
+        row = rows.get(user_id)
+        if row is None:
+            problems.append(f"{user_id} ({payment['kind']}): нет активной подписки")
+            continue
+        active, expires_at, created_at, paid = row
+        base = seeded.get(user_id, created_at)
+        if active > 1:
+            problems.append(f"{user_id} ({payment['kind']}): активных подписок {active}")
+        if paid > 1:
+            problems.append(f"{user_id} ({payment['kind']}): платежей {paid}")
+        if (_naive_utc(expires_at) - _naive_utc(base)).total_seconds() > limit:
+            problems.append(f"{user_id} ({payment['kind']}): срок продлён до {expires_at} (было {base})")
+        if telegram.sent_by_chat[user_id] > 1:
+            problems.append(f"{user_id} ({payment['kind']}): сообщений об оплате {telegram.sent_by_chat[user_id]}")
+    return problems
+
+
+async def start_webhook(log) -> asyncio.subprocess.Process:
+    env = dict(os.environ)
+    env.update(
+        TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{FAKE_PORT}/bot",
+        TELEGRAM_WEBHOOK_MODE="false",
+        ROBOKASSA_PASSWORD_2=PASSWORD_2,
+        DATABASE_URL=DATABASE_URL,
+    )
+    env.setdefault("TELEGRAM_TOKEN", "123456:bench")
+    return await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "webhook:app",
+        "--host", "127.0.0.1", "--port", str(WEBHOOK_PORT),
+        "--workers", str(WEBHOOK_WORKERS), "--log-level", "warning",
+        cwd=BASE_DIR, env=env, stdout=log, stderr=log,
+    )
+
+
+async def wait_webhook_ready(webhook: asyncio.subprocess.Process, client: httpx.AsyncClient, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        if webhook.returncode is not None:
+            raise RuntimeError(f"webhook.py завершился с кодом {webhook.returncode}, см. {WEBHOOK_LOG}")
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"webhook.py не ответил на /health за {timeout:.0f} сек, см. {WEBHOOK_LOG}")
+        await asyncio.sleep(0.2)
+
+
+async def stop_webhook(webhook: asyncio.subprocess.Process):
+    if webhook.returncode is not None:
+        return
+    webhook.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(webhook.wait(), 30)
+    except asyncio.TimeoutError:
+        webhook.kill()
+        await webhook.wait()
+
+
+def report(load: WebhookLoad, elapsed: float, problems: List[str]) -> Dict[str, Any]:
+    everything = [v for values in load.latencies.values() for v in values]
+    kinds = {}
+    for kind in KINDS + ("all",):
+        values = everything if kind == "all" else load.latencies[kind]
+        kinds[kind] = {
+            "requests": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": max(values, default=0.0) * 1000,
+        }
+    return {
+        "payments": Counter(p["kind"] for p in load.payments),
+        "requests": load.requests,
+        "elapsed": elapsed,
+        "requests_per_sec": load.requests / elapsed if elapsed else 0.0,
+        "latency": kinds,
+        "errors": dict(load.errors),
+        "double_renewals": problems,
+        "settings": {
+            "concurrency": CONCURRENCY,
+            "mix": MIX,
+            "duplicate_copies": DUPLICATE_COPIES,
+            "webhook_workers": WEBHOOK_WORKERS,
+            "fake_latency_ms": float(os.getenv("FAKE_TELEGRAM_LATENCY_MS", "30")),
+        },
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    payments = ", ".join(f"{kind} {result['payments'].get(kind, 0)}" for kind in KINDS)
+    print()
+    print(f"Платежей: {payments}; запросов: {result['requests']} за {result['elapsed']:.1f} сек")
+    print(f"Пропускная способность: {result['requests_per_sec']:.1f} запросов/с")
+    print()
+    print(f"{'Вид':<10} {'n':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (мс)")
+    for kind, s in result["latency"].items():
+        print(
+            f"{kind:<10} {s['requests']:>7} {s['p50_ms']:>8.0f} {s['p95_ms']:>8.0f} "
+            f"{s['p99_ms']:>8.0f} {s['max_ms']:>8.0f}"
+        )
+    print()
+    if result["errors"]:
+        print("Ошибки: " + ", ".join(f"{k} {v}" for k, v in result["errors"].items()))
+    problems = result["double_renewals"]
+    if problems:
+        print(f"❌ Двойные продления: {len(problems)}")
+        for line in problems[:20]:
+            print(f"  {line}")
+    else:
+        print("✅ Двойных продлений и повторных сообщений об оплате нет")
+
+
+async def main():
+    if not DATABASE_URL:
+        print("Ошибка: DATABASE_URL должен указывать на локальный Postgres")
+        sys.exit(1)
+    payments = build_payments(parse_mix(MIX))
+
+    server = uvicorn.Server(uvicorn.Config(fake_app, host="127.0.0.1", port=FAKE_PORT, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    load = WebhookLoad(payments)
+    limits = httpx.Limits(max_connections=CONCURRENCY, max_keepalive_connections=CONCURRENCY)
+    with open(WEBHOOK_LOG, "w") as log:
+        webhook = await start_webhook(log)
+        print(f"webhook.py запущен (лог: {WEBHOOK_LOG}), ждём /health...")
+        try:
+            async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{WEBHOOK_PORT}", timeout=60, limits=limits
+            ) as client:
+                await wait_webhook_ready(webhook, client)
+                # webhook.py уже применил миграции
+                await cleanup()
+                seeded = await seed_pending(payments)
+                print(f"Платежей: {PAYMENTS}, одновременно запросов: {CONCURRENCY}, смесь: {MIX}")
+
+                slots = asyncio.Semaphore(CONCURRENCY)
+                started = time.perf_counter()
+                await asyncio.gather(*(load.run_payment(client, slots, p) for p in payments))
+                elapsed = time.perf_counter() - started
+
+            problems = await find_double_renewals(payments, seeded)
+        finally:
+            await stop_webhook(webhook)
+            server.should_exit = True
+            await server_task
+            await cleanup()
+
+    result = report(load, elapsed, problems)
+    print_report(result)
+    if RESULT_JSON:
+        Path(RESULT_JSON).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+        print(f"Результат сохранён в {RESULT_JSON}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
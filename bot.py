@@ -6,6 +6,7 @@ Telegram бот для приёма платежей через Robokassa
 Установка: pip install robokassa
 """
 
+import asyncio
 import logging
 import hashlib
 import urllib.parse
@@ -16,7 +17,6 @@ from typing import Optional
 
 from dotenv import load_dotenv
 import pytz
-import httpx
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import Conflict, NetworkError, RetryAfter, TimedOut
@@ -32,7 +32,17 @@ from telegram.ext import (
 
 from robokassa import Robokassa, HashAlgorithm
 
+from change_feed import ChangeFeedListener
 from database import Database
+from leader import LeaderElection
+from media_cache import MediaCache
+from metrics import REGISTRY, JOB_ITEMS, instrument_handler, instrument_job, start_http_server
+import profiler
+import query_stats
+from ratelimit import SendScheduler, PRIORITY_PAYMENT, PRIORITY_JOIN, PRIORITY_BULK
+from recurring import RecurringClient
+from sharding import ShardedJobRunner
+from update_processor import OrderedUpdateProcessor
 from config import (
     TELEGRAM_TOKEN,
     CHANNEL_ID,
@@ -49,6 +59,38 @@ from config import (
     RECURRING_LEAD_DAYS,
     RECURRING_RETRY_DAYS,
     RECURRING_MAX_FAILURES,
+    SUBSCRIPTION_CACHE_SIZE,
+    SUBSCRIPTION_CACHE_TTL,
+    SUBSCRIPTION_CACHE_NEGATIVE_TTL,
+    USER_STATE_FLUSH_INTERVAL_MS,
+    USER_STATE_FLUSH_MAX_BATCH,
+    SUBSCRIPTION_JOB_PAGE_SIZE,
+    TELEGRAM_GLOBAL_RATE_PER_SEC,
+    TELEGRAM_API_BASE_URL,
+    KICK_CONCURRENCY,
+    ROBOKASSA_RECURRING_URL,
+    RECURRING_CONCURRENCY,
+    RECURRING_RATE_PER_SEC,
+    RECURRING_HTTP_TIMEOUT,
+    RETARGETING_POLL_SECONDS,
+    RETARGETING_BATCH_SIZE,
+    MESSAGE_DELETION_TICK_SECONDS,
+    MESSAGE_DELETION_BATCH_SIZE,
+    UPDATE_CONCURRENCY,
+    TELEGRAM_WEBHOOK_MODE,
+    LEADER_RENEW_SECONDS,
+    JOB_SHARD_COUNT,
+    JOB_SHARD_WORKERS,
+    JOB_SHARD_LEASE_SECONDS,
+    JOB_SHARD_POLL_SECONDS,
+    METRICS_HOST,
+    METRICS_PORT,
+    QUERY_ALERT_MAX_STATEMENTS,
+    QUERY_ALERT_REPEAT,
+    PROFILE_DEFAULT_SECONDS,
+    PROFILE_MAX_SECONDS,
+    PROFILE_SLOW_SECONDS,
+    PROFILE_SAMPLE_INTERVAL_MS,
 )
 
 # Ссылка на договор оферты
@@ -79,8 +121,30 @@ logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.getLogger("httpx").addFilter(DropGetUpdatesFilter())
 
 robokassa_client: Optional[Robokassa] = None
+change_feed: Optional[ChangeFeedListener] = None
+leader_election: Optional[LeaderElection] = None
+shard_runner: Optional[ShardedJobRunner] = None
+metrics_server: Optional[asyncio.AbstractServer] = None
+
+# Имена шардированных job в job_runs/job_shards
+EXPIRED_CHECK_JOB = "expired_check"
+# /check_subs — свой job: ручной запуск не снимает шарды ежедневного и наоборот
+EXPIRED_CHECK_MANUAL_JOB = "expired_check_manual"
+RECURRING_CHARGE_JOB = "recurring_charge"
 ADMIN_SET = set(ADMIN_IDS or [])
 
+# Все вызовы Bot API идут через один планировщик: общий и поканальный лимиты,
+# приоритеты (оплата > заявки в канал > воронка > рассылки) и повтор после RetryAfter
+send_scheduler = SendScheduler(global_rate=TELEGRAM_GLOBAL_RATE_PER_SEC)
+
+# Один keep-alive клиент к Robokassa Recurring на весь процесс
+recurring_client = RecurringClient(
+    ROBOKASSA_RECURRING_URL,
+    timeout=RECURRING_HTTP_TIMEOUT,
+    max_concurrency=RECURRING_CONCURRENCY,
+    rate_per_sec=RECURRING_RATE_PER_SEC,
+)
+
 TEXTS = {
     "start": """Привет! Это Korkut ipoteka — закрытый канал для ипотечных брокеров и риелторов.
 
@@ -253,35 +317,60 @@ def describe_subscription(subscription: dict) -> str:
     )
 
 
-async def delete_message_job(context: ContextTypes.DEFAULT_TYPE):
-    """Удалить сообщение по расписанию."""
-    data = context.job.data or {}
-    chat_id = data.get("chat_id")
-    message_id = data.get("message_id")
-    if not chat_id or not message_id:
-        return
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except Exception as e:
-        logger.warning("Не удалось удалить сообщение %s:%s: %s", chat_id, message_id, e)
+# Telegram удаляет не больше 100 сообщений за один deleteMessages
+DELETE_MESSAGES_CHUNK = 100
 
 
-def schedule_message_deletion(
-    context: ContextTypes.DEFAULT_TYPE,
-    chat_id: int,
-    message_id: int,
-    delay_seconds: int = 300,
-):
-    """Поставить задачу на удаление сообщения с ссылкой."""
-    if not context or not getattr(context, "application", None):
-        return
-    job_queue = context.application.job_queue
-    job_queue.run_once(
-        delete_message_job,
-        when=timedelta(seconds=delay_seconds),
-        data={"chat_id": chat_id, "message_id": message_id},
-        name=f"del_msg_{chat_id}_{message_id}",
-    )
+async def process_message_deletions(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Воркер очереди удаления: раз в тик забирает наступившие удаления,
+    группирует по чатам и удаляет пачками через deleteMessages.
+    """
+    deleted = failed = 0
+    while True:
+        batch = await db.claim_due_message_deletions(limit=MESSAGE_DELETION_BATCH_SIZE)
+        if not batch:
+            break
+
+        by_chat: dict[int, list[int]] = {}
+        for row in batch:
+            by_chat.setdefault(row["chat_id"], []).append(row["message_id"])
+
+        async def delete_chunk(chat_id: int, message_ids: list[int]) -> bool:
+            try:
+                await context.bot.delete_messages(
+                    chat_id=chat_id, message_ids=message_ids, rate_limit_args=PRIORITY_BULK
+                )
+                return True
+            except Exception as e:
+                logger.warning("Не удалось удалить сообщения %s:%s: %s", chat_id, message_ids, e)
+                return False
+
+        chunks = [
+            (chat_id, ids[i:i + DELETE_MESSAGES_CHUNK])
+            for chat_id, ids in by_chat.items()
+            for i in range(0, len(ids), DELETE_MESSAGES_CHUNK)
+        ]
+        results = await asyncio.gather(*(delete_chunk(chat_id, ids) for chat_id, ids in chunks))
+        for (_, ids), ok in zip(chunks, results):
+            if ok:
+                deleted += len(ids)
+            else:
+                failed += len(ids)
+
+        if len(batch) < MESSAGE_DELETION_BATCH_SIZE:
+            break
+
+    if deleted or failed:
+        JOB_ITEMS.inc(deleted, job="message_deletions", kind="deleted")
+        JOB_ITEMS.inc(failed, job="message_deletions", kind="failed")
+        logger.info("Удаление сообщений: удалено %s, ошибок %s", deleted, failed)
+
+
+async def schedule_message_deletion(chat_id: int, message_id: int, delay_seconds: int = 300):
+    """Поставить сообщение с ссылкой в очередь на удаление."""
+    delete_at = datetime.now(TIMEZONE) + timedelta(seconds=delay_seconds)
+    await db.schedule_message_deletion(chat_id, message_id, delete_at)
 
 
 async def reply_with_cleanup(
@@ -292,7 +381,7 @@ async def reply_with_cleanup(
     delete_after: int = 300,
 ):
     msg = await message_obj.reply_text(text, reply_markup=reply_markup)
-    schedule_message_deletion(context, msg.chat_id, msg.message_id, delete_after)
+    await schedule_message_deletion(msg.chat_id, msg.message_id, delete_after)
     return msg
 
 
@@ -302,12 +391,30 @@ async def bot_send_with_cleanup(
     text: str,
     reply_markup=None,
     delete_after: int = 300,
+    rate_limit_args: Optional[int] = None,
 ):
-    msg = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-    schedule_message_deletion(context, chat_id, msg.message_id, delete_after)
+    msg = await context.bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        reply_markup=reply_markup,
+        rate_limit_args=rate_limit_args,
+    )
+    await schedule_message_deletion(chat_id, msg.message_id, delete_after)
     return msg
 
 
+# InvId у Robokassa — int32. Диапазоны не пересекаются: 1..RECURRING_INV_ID_MAX выдаёт
+# автосписаниям последовательность recurring_inv_id_seq (миграция 13), ручные оплаты
+# берут InvId от времени в мс выше этого диапазона
+RECURRING_INV_ID_MAX = 999_999_999
+INV_ID_MAX = 2147483647
+
+
+def new_payment_inv_id() -> int:
+    """InvId ручной оплаты: от времени в мс, вне диапазона автосписаний."""
+    return RECURRING_INV_ID_MAX + 1 + int(time.time() * 1000) % (INV_ID_MAX - RECURRING_INV_ID_MAX)
+
+
 def generate_payment_link_manual(
     inv_id: int,
     out_sum: float,
@@ -391,12 +498,12 @@ def _make_recurring_signature(
 async def send_start_block(message_obj, reply_markup):
     caption = TEXTS["start"]
     if WELCOME_IMAGE_PATH.exists():
-        with WELCOME_IMAGE_PATH.open("rb") as photo:
-            await message_obj.reply_photo(
-                photo=photo,
-                caption=caption,
-                reply_markup=reply_markup
-            )
+        await media_cache.reply_photo(
+            message_obj,
+            WELCOME_IMAGE_PATH,
+            caption=caption,
+            reply_markup=reply_markup
+        )
     else:
         await message_obj.reply_text(
             caption,
@@ -406,7 +513,10 @@ async def send_start_block(message_obj, reply_markup):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    subscription = db.get_subscription(user.id)
+    # Один запрос: подписка + состояние воронки (пишется, только если подписки нет)
+    subscription = await db.get_subscription_and_record_state(
+        user.id, user.username or user.first_name, "start"
+    )
 
     if is_subscription_active(subscription):
         expires_at = format_expires_at(subscription["expires_at"])
@@ -432,7 +542,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    db.update_user_state(user.id, user.username or user.first_name, "start")
     keyboard = [[InlineKeyboardButton("🔘 Это про меня", callback_data="funnel_story2")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await send_start_block(update.message, reply_markup)
@@ -442,7 +551,7 @@ async def funnel_story2(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "story2")
+    await db.update_user_state(user.id, user.username or user.first_name, "story2")
 
     keyboard = [[InlineKeyboardButton("✨ Хочу без ошибок", callback_data="funnel_story3")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -453,7 +562,7 @@ async def funnel_story3(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "story3")
+    await db.update_user_state(user.id, user.username or user.first_name, "story3")
 
     keyboard = [[InlineKeyboardButton("👀 Интересно", callback_data="funnel_story4")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -464,7 +573,7 @@ async def funnel_story4(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "story4")
+    await db.update_user_state(user.id, user.username or user.first_name, "story4")
 
     keyboard = [[InlineKeyboardButton("📥 Хочу доступ", callback_data="funnel_story5")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -475,7 +584,7 @@ async def funnel_story5(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "story5")
+    await db.update_user_state(user.id, user.username or user.first_name, "story5")
 
     keyboard = [[InlineKeyboardButton("✅ Мне это нужно", callback_data="funnel_story6")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -486,7 +595,7 @@ async def funnel_story6(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "story6")
+    await db.update_user_state(user.id, user.username or user.first_name, "story6")
 
     keyboard = [
         [InlineKeyboardButton("💳 Оплатить подписку", callback_data="funnel_offer_agreement")],
@@ -504,7 +613,7 @@ async def funnel_story7(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "story7")
+    await db.update_user_state(user.id, user.username or user.first_name, "story7")
 
     keyboard = [[InlineKeyboardButton("🚀 Присоединиться сейчас", callback_data="funnel_offer_agreement")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -516,19 +625,19 @@ async def funnel_want(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "want")
+    await db.update_user_state(user.id, user.username or user.first_name, "want")
 
     keyboard = [[InlineKeyboardButton("👉 Подписка и доступ", callback_data="funnel_offer_agreement")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     caption = TEXTS["want"]
     if PROGRAM_IMAGE_PATH.exists():
-        with PROGRAM_IMAGE_PATH.open("rb") as photo:
-            await query.message.reply_photo(
-                photo=photo,
-                caption=caption,
-                reply_markup=reply_markup
-            )
+        await media_cache.reply_photo(
+            query.message,
+            PROGRAM_IMAGE_PATH,
+            caption=caption,
+            reply_markup=reply_markup
+        )
     else:
         await query.message.reply_text(
             caption,
@@ -542,7 +651,12 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.warning("Сообщение без effective_user, update_id=%s", getattr(update, "update_id", None))
         return
 
-    subscription = db.get_subscription(user.id)
+    subscription = await db.get_subscription_and_record_state(
+        user.id,
+        user.username or user.first_name,
+        "question_answered",
+        question=update.message.text,
+    )
     if is_subscription_active(subscription):
         keyboard = [
             [InlineKeyboardButton("🔗 Перейти в канал", url=CHANNEL_LINK)],
@@ -557,9 +671,6 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
 
-    db.save_user_question(user.id, update.message.text)
-    db.update_user_state(user.id, user.username or user.first_name, "question_answered")
-
     keyboard = [
         [InlineKeyboardButton("Оформить подписку", callback_data="funnel_offer_agreement")],
         [InlineKeyboardButton("Узнать подробнее", callback_data="funnel_details")],
@@ -574,9 +685,9 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def send_payment_block(query, context: ContextTypes.DEFAULT_TYPE, text: str):
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "payment")
+    await db.update_user_state(user.id, user.username or user.first_name, "payment")
 
-    inv_id = int(time.time() * 1000) % 2147483647
+    inv_id = new_payment_inv_id()
     context.user_data["pending_inv_id"] = inv_id
     context.user_data["pending_amount"] = SUBSCRIPTION_PRICE
 
@@ -603,10 +714,12 @@ async def send_payment_block(query, context: ContextTypes.DEFAULT_TYPE, text: st
             reply_markup=reply_markup
         )
 
-        schedule_retargeting(context, user.id)
+        await schedule_retargeting(user.id)
 
     except Exception as e:
         logger.error("Ошибка при создании ссылки на оплату: %s", e)
+        # Ошибку могла дать БД: прерванную транзакцию апдейта откатываем
+        await db.rollback_unit_of_work()
         await query.message.reply_text(
             "❌ Произошла ошибка при создании ссылки на оплату.\n"
             "Попробуйте позже или обратитесь к администратору."
@@ -633,7 +746,7 @@ async def funnel_confirm_offer(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer("✅ Оферта принята! Теперь вы можете оплатить подписку.")
 
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "offer_confirmed")
+    await db.update_user_state(user.id, user.username or user.first_name, "offer_confirmed")
     context.user_data["offer_confirmed"] = True
 
     await send_payment_block(
@@ -666,7 +779,7 @@ async def funnel_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "details")
+    await db.update_user_state(user.id, user.username or user.first_name, "details")
 
     keyboard = [
         [InlineKeyboardButton("👉 Подписка и доступ", callback_data="funnel_offer_agreement")],
@@ -685,7 +798,7 @@ async def funnel_back_to_want(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
 
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "want")
+    await db.update_user_state(user.id, user.username or user.first_name, "want")
 
     keyboard = [
         [InlineKeyboardButton("👉 Подписка и доступ", callback_data="funnel_offer_agreement")],
@@ -715,7 +828,7 @@ async def funnel_doubt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     user = query.from_user
-    db.update_user_state(user.id, user.username or user.first_name, "doubt")
+    await db.update_user_state(user.id, user.username or user.first_name, "doubt")
 
     keyboard = [
         [InlineKeyboardButton("Перейти к оформлению", callback_data="funnel_offer_agreement")],
@@ -729,46 +842,36 @@ async def funnel_doubt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-def schedule_retargeting(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    jobs_to_remove = [
-        job for job in context.job_queue.jobs()
-        if job.name and job.name.startswith(f"retarget_{user_id}_")
-    ]
-    for job in jobs_to_remove:
-        job.schedule_removal()
-
-    context.job_queue.run_once(
-        send_retarget_24h,
-        when=timedelta(hours=24),
-        data=user_id,
-        name=f"retarget_{user_id}_24h"
-    )
+# Шаги ретаргетинга: задержка от выдачи ссылки на оплату и кнопки сообщения
+RETARGET_STEPS = {
+    "24h": (
+        timedelta(hours=24),
+        [[("Оформить подписку", "funnel_offer_agreement")]],
+    ),
+    "48h": (
+        timedelta(hours=48),
+        [
+            [("Да, вступить", "funnel_offer_agreement")],
+            [("Сомневаюсь", "funnel_doubt")],
+        ],
+    ),
+    "72h": (
+        timedelta(hours=72),
+        [[("Оформить подписку", "funnel_offer_agreement")]],
+    ),
+}
 
-    context.job_queue.run_once(
-        send_retarget_48h,
-        when=timedelta(hours=48),
-        data=user_id,
-        name=f"retarget_{user_id}_48h"
-    )
 
-    context.job_queue.run_once(
-        send_retarget_72h,
-        when=timedelta(hours=72),
-        data=user_id,
-        name=f"retarget_{user_id}_72h"
+async def schedule_retargeting(user_id: int):
+    now = datetime.now(TIMEZONE)
+    await db.schedule_retargeting(
+        user_id,
+        {step: now + delay for step, (delay, _) in RETARGET_STEPS.items()},
     )
 
-    logger.info("Запланирован ретаргетинг для пользователя %s", user_id)
 
-
-def cancel_retargeting(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    jobs_to_remove = [
-        job for job in context.job_queue.jobs()
-        if job.name and job.name.startswith(f"retarget_{user_id}_")
-    ]
-    for job in jobs_to_remove:
-        job.schedule_removal()
-    logger.info("Отменён ретаргетинг для пользователя %s", user_id)
+async def cancel_retargeting(user_id: int):
+    await db.cancel_retargeting(user_id)
 
 
 def build_after_payment_keyboard(include_offer: bool = False) -> InlineKeyboardMarkup:
@@ -781,67 +884,60 @@ def build_after_payment_keyboard(include_offer: bool = False) -> InlineKeyboardM
     return InlineKeyboardMarkup(keyboard)
 
 
-async def send_retarget_24h(context: ContextTypes.DEFAULT_TYPE):
-    user_id = context.job.data
-    subscription = db.get_subscription(user_id)
-    if is_subscription_active(subscription):
-        return
-
-    keyboard = [[InlineKeyboardButton("Оформить подписку", callback_data="funnel_offer_agreement")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+async def send_retarget(context: ContextTypes.DEFAULT_TYPE, user_id: int, step: str) -> bool:
+    _, rows = RETARGET_STEPS[step]
+    reply_markup = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(text, callback_data=data) for text, data in row] for row in rows]
+    )
 
     try:
         await context.bot.send_message(
             chat_id=user_id,
-            text=TEXTS["retarget_24h"],
-            reply_markup=reply_markup
+            text=TEXTS[f"retarget_{step}"],
+            reply_markup=reply_markup,
+            rate_limit_args=PRIORITY_BULK,
         )
-        logger.info("Отправлено напоминание 24ч пользователю %s", user_id)
+        logger.info("Отправлено напоминание %s пользователю %s", step, user_id)
+        return True
     except Exception as e:
-        logger.warning("Не удалось отправить напоминание 24ч пользователю %s: %s", user_id, e)
+        logger.warning("Не удалось отправить напоминание %s пользователю %s: %s", step, user_id, e)
+        return False
 
 
-async def send_retarget_48h(context: ContextTypes.DEFAULT_TYPE):
-    user_id = context.job.data
-    subscription = db.get_subscription(user_id)
-    if is_subscription_active(subscription):
-        return
-
-    keyboard = [
-        [InlineKeyboardButton("Да, вступить", callback_data="funnel_offer_agreement")],
-        [InlineKeyboardButton("Сомневаюсь", callback_data="funnel_doubt")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=TEXTS["retarget_48h"],
-            reply_markup=reply_markup
+async def process_retargeting_queue(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодический воркер ретаргетинга: забирает наступившие шаги пачками,
+    одним запросом отсеивает уже оплативших и рассылает остальным.
+    """
+    sent = skipped = failed = 0
+    while True:
+        batch = await db.claim_due_retargeting(limit=RETARGETING_BATCH_SIZE)
+        if not batch:
+            break
+
+        active = await db.get_active_subscriber_ids(list({row["user_id"] for row in batch}))
+        pending = [row for row in batch if row["user_id"] not in active and row["step"] in RETARGET_STEPS]
+        skipped += len(batch) - len(pending)
+
+        results = await asyncio.gather(
+            *(send_retarget(context, row["user_id"], row["step"]) for row in pending)
         )
-        logger.info("Отправлено напоминание 48ч пользователю %s", user_id)
-    except Exception as e:
-        logger.warning("Не удалось отправить напоминание 48ч пользователю %s: %s", user_id, e)
-
-
-async def send_retarget_72h(context: ContextTypes.DEFAULT_TYPE):
-    user_id = context.job.data
-    subscription = db.get_subscription(user_id)
-    if is_subscription_active(subscription):
-        return
+        sent += sum(results)
+        failed += len(results) - sum(results)
 
-    keyboard = [[InlineKeyboardButton("Оформить подписку", callback_data="funnel_offer_agreement")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        if len(batch) < RETARGETING_BATCH_SIZE:
+            break
 
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=TEXTS["retarget_72h"],
-            reply_markup=reply_markup
+    if sent or skipped or failed:
+        JOB_ITEMS.inc(sent, job="retargeting_queue", kind="sent")
+        JOB_ITEMS.inc(skipped, job="retargeting_queue", kind="skipped")
+        JOB_ITEMS.inc(failed, job="retargeting_queue", kind="failed")
+        logger.info(
+            "Ретаргетинг: отправлено %s, пропущено (есть подписка) %s, ошибок %s",
+            sent,
+            skipped,
+            failed,
         )
-        logger.info("Отправлено напоминание 72ч пользователю %s", user_id)
-    except Exception as e:
-        logger.warning("Не удалось отправить напоминание 72ч пользователю %s: %s", user_id, e)
 
 
 async def check_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -881,7 +977,7 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     expires_at = datetime.now() + timedelta(days=RENEWAL_PERIOD_DAYS)
     next_charge_at = expires_at - timedelta(days=RECURRING_LEAD_DAYS)
 
-    db.add_subscription(
+    await db.add_subscription(
         user_id=target_user_id,
         username=f"user_{target_user_id}",
         expires_at=expires_at,
@@ -890,7 +986,7 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         next_charge_at=next_charge_at,
     )
 
-    db.add_payment(
+    await db.add_payment(
         user_id=target_user_id,
         amount=SUBSCRIPTION_PRICE,
         currency="KZT",
@@ -898,8 +994,8 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         inv_id=inv_id,
     )
 
-    db.update_user_state(target_user_id, f"user_{target_user_id}", "paid")
-    cancel_retargeting(context, target_user_id)
+    await db.update_user_state(target_user_id, f"user_{target_user_id}", "paid")
+    await cancel_retargeting(target_user_id)
 
     logger.info("Подписка активирована админом для пользователя %s", target_user_id)
 
@@ -916,6 +1012,7 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_user_id,
             TEXTS["after_payment"].format(channel_link=CHANNEL_LINK),
             reply_markup=build_after_payment_keyboard(),
+            rate_limit_args=PRIORITY_PAYMENT,
         )
     except Exception as e:
         logger.warning("Не удалось отправить уведомление пользователю %s: %s", target_user_id, e)
@@ -953,7 +1050,7 @@ async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message_obj = update.message
 
     user = update.effective_user
-    subscription = db.get_subscription(user.id)
+    subscription = await db.get_subscription(user.id)
 
     if subscription and is_subscription_active(subscription):
         text = (
@@ -989,7 +1086,7 @@ async def cancel_subscription_action(update: Update, context: ContextTypes.DEFAU
         message_obj = update.message
 
     user = update.effective_user
-    subscription = db.get_subscription(user.id)
+    subscription = await db.get_subscription(user.id)
 
     if not subscription or not is_subscription_active(subscription):
         keyboard = [
@@ -1017,8 +1114,8 @@ async def cancel_subscription_action(update: Update, context: ContextTypes.DEFAU
         )
         return
 
-    db.request_cancel_subscription(user.id)
-    cancel_retargeting(context, user.id)
+    await db.request_cancel_subscription(user.id)
+    await cancel_retargeting(user.id)
 
     keyboard = [
         [InlineKeyboardButton("🔗 Перейти в канал", url=CHANNEL_LINK)],
@@ -1038,22 +1135,30 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
     req = update.chat_join_request
     user_id = req.from_user.id
     username = req.from_user.username or req.from_user.first_name or "user"
-    subscription = db.get_subscription(user_id)
+    subscription = await db.get_subscription(user_id)
+    if not is_subscription_active(subscription):
+        # Отказ перепроверяем мимо кэша: оплата могла только что прийти через вебхук
+        subscription = await db.get_subscription(user_id, use_cache=False)
 
     if is_subscription_active(subscription):
-        await context.bot.approve_chat_join_request(chat_id=req.chat.id, user_id=user_id)
+        await context.bot.approve_chat_join_request(
+            chat_id=req.chat.id, user_id=user_id, rate_limit_args=PRIORITY_JOIN
+        )
         try:
             await bot_send_with_cleanup(
                 context,
                 user_id,
                 "✅ Доступ в канал подтверждён. Добро пожаловать!",
+                rate_limit_args=PRIORITY_JOIN,
             )
         except Exception as e:
             logger.warning("Не удалось отправить сообщение после approve %s: %s", user_id, e)
         logger.info("Join approved: user=%s (%s)", user_id, username)
         return
 
-    await context.bot.decline_chat_join_request(chat_id=req.chat.id, user_id=user_id)
+    await context.bot.decline_chat_join_request(
+        chat_id=req.chat.id, user_id=user_id, rate_limit_args=PRIORITY_JOIN
+    )
     keyboard = [
         [InlineKeyboardButton("Оформить подписку", callback_data="funnel_offer_agreement")],
         [InlineKeyboardButton("Узнать подробнее", callback_data="funnel_details")],
@@ -1072,7 +1177,9 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    subscription = db.get_subscription(user.id)
+    subscription = await db.get_subscription_and_record_state(
+        user.id, user.username or user.first_name, "offer_agreement"
+    )
 
     if is_subscription_active(subscription):
         expires_at = format_expires_at(subscription["expires_at"])
@@ -1098,9 +1205,7 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    db.update_user_state(user.id, user.username or user.first_name, "offer_agreement")
-
-    inv_id = int(time.time() * 1000) % 2147483647
+    inv_id = new_payment_inv_id()
     context.user_data["pending_inv_id"] = inv_id
     context.user_data["pending_amount"] = SUBSCRIPTION_PRICE
 
@@ -1131,9 +1236,11 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
 
-        schedule_retargeting(context, user.id)
+        await schedule_retargeting(user.id)
     except Exception as e:
         logger.error("Ошибка при создании ссылки на оплату: %s", e)
+        # Ошибку могла дать БД: прерванную транзакцию апдейта откатываем
+        await db.rollback_unit_of_work()
         await update.message.reply_text(
             "❌ Произошла ошибка при создании ссылки на оплату.\n"
             "Попробуйте позже или обратитесь к администратору."
@@ -1142,7 +1249,7 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def check_subscription_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    subscription = db.get_subscription(user.id)
+    subscription = await db.get_subscription(user.id)
 
     if subscription:
         expires_at = subscription["expires_at"]
@@ -1194,8 +1301,13 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет доступа к этой команде")
         return
 
-    stats = db.get_statistics()
-    funnel_stats = db.get_funnel_statistics()
+    # Воронку считаем по свежим данным: сначала сбрасываем буфер состояний
+    await db.flush_user_states()
+    stats = await db.get_statistics()
+    funnel_stats = await db.get_funnel_statistics()
+
+    cache_stats = db.subscription_cache.stats()
+    processor = context.application.update_processor
 
     mode = "🧪 ТЕСТОВЫЙ" if ROBOKASSA_TEST_MODE else "💳 БОЕВОЙ"
 
@@ -1210,10 +1322,102 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• Нажали 'Хочу': {funnel_stats.get('want', 0)}\n"
         f"• Дошли до оплаты: {funnel_stats.get('payment', 0)}\n"
         f"• Оплатили: {funnel_stats.get('paid', 0)}\n\n"
+        f"🗄 Кэш подписок: {cache_stats['size']}/{cache_stats['max_size']}, "
+        f"hit {cache_stats['hits']} / miss {cache_stats['misses']} "
+        f"({cache_stats['hit_rate']:.0%}), вытеснено {cache_stats['evictions']}\n"
+        f"⚙️ Апдейты: в обработке {processor.current_concurrent_updates}/{processor.max_concurrent_updates}, "
+        f"в очереди {getattr(processor, 'queued_updates', 0)}\n"
+        f"👑 Ежедневные job на этой реплике: {'да (лидер)' if leader_election and leader_election.is_leader else 'нет'}\n\n"
         f"Режим Robokassa: {mode}"
     )
 
 
+async def admin_sql_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/sql_stats — SQL-запросы по апдейтам и job, предупреждения о N+1; /sql_stats reset — обнулить."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде")
+        return
+
+    if context.args and context.args[0] == "reset":
+        query_stats.reset()
+        await update.message.reply_text("🗄 Статистика SQL обнулена")
+        return
+
+    text = "\n".join(query_stats.format_report(query_stats.snapshot(top=8)))
+    await update.message.reply_text(text[:4096])
+
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [сек] — окно профилирования, результат придёт файлами; /profile stop — закончить раньше."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ У вас нет доступа к этой команде")
+        return
+
+    if context.args and context.args[0] == "stop":
+        if not profiler.is_active():
+            await update.message.reply_text("Профилирование не запущено")
+            return
+        profiler.stop()
+        await update.message.reply_text("⏹ Останавливаю профилирование...")
+        return
+
+    if profiler.is_active():
+        await update.message.reply_text("⏳ Профилирование уже идёт (/profile stop — закончить)")
+        return
+
+    duration = PROFILE_DEFAULT_SECONDS
+    if context.args:
+        try:
+            duration = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Использование: /profile [секунд] или /profile stop")
+            return
+    duration = min(max(duration, 1), PROFILE_MAX_SECONDS)
+
+    await update.message.reply_text(
+        f"🔬 Профилирую {duration} сек: стеки event loop и вызовы дольше {PROFILE_SLOW_SECONDS:g} сек"
+    )
+    # Окно — отдельной задачей: апдейт не должен держать очередь чата и сессию БД
+    context.application.create_task(
+        send_profile(context, update.effective_chat.id, duration), update=update
+    )
+
+
+async def send_profile(context: ContextTypes.DEFAULT_TYPE, chat_id: int, duration: int):
+    try:
+        data = await profiler.run_window(duration)
+    except RuntimeError as e:
+        await context.bot.send_message(chat_id=chat_id, text=f"❌ {e}")
+        return
+
+    stamp = f"{data['started_at']:%Y%m%d-%H%M%S}"
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=data["folded"].encode(),
+        filename=f"profile-{stamp}.folded",
+        caption=(
+            f"🔬 {data['samples']} сэмплов event loop за {data['elapsed']:.0f} сек "
+            f"(каждые {data['sample_interval'] * 1000:.0f} мс), формат collapsed stacks: "
+            f"flamegraph.pl или speedscope.app"
+        ),
+    )
+    if data["slow"]:
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=profiler.format_slow_report(data).encode(),
+            filename=f"slow-{stamp}.txt",
+            caption=f"🐢 Медленных вызовов: {len(data['slow'])} (≥ {data['slow_seconds']:g} сек)",
+        )
+    else:
+        await context.bot.send_message(
+            chat_id=chat_id, text=f"🐢 Вызовов дольше {data['slow_seconds']:g} сек не было"
+        )
+
+
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = (
         "📚 Доступные команды:\n\n"
@@ -1231,6 +1435,8 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/stats - Статистика бота\n"
             "/confirm_payment <user_id> <inv_id> - Подтвердить оплату\n"
             "/check_subs - Ручная проверка подписок\n"
+            "/sql_stats - SQL-запросы по апдейтам и job (reset - обнулить)\n"
+            "/profile [сек] - Профилирование бота (stop - закончить раньше)\n"
         )
 
     await update.message.reply_text(help_text)
@@ -1241,6 +1447,19 @@ RECURRING_LEAD_TIME = timedelta(days=RECURRING_LEAD_DAYS)
 RECURRING_RETRY_DELAY = timedelta(days=RECURRING_RETRY_DAYS)
 
 
+# Сколько строк с деталями помещать в сводку админам (лимит сообщения Telegram — 4096 символов)
+ADMIN_REPORT_MAX_LINES = 30
+
+
+async def notify_admins(context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Отправить сообщение всем админам, ошибки доставки игнорируются."""
+    for admin_id in (ADMIN_SET or ({ADMIN_ID} if ADMIN_ID else set())):
+        try:
+            await context.bot.send_message(chat_id=admin_id, text=text[:4096])
+        except Exception:
+            pass
+
+
 async def perform_recurring_charge(
     user_id: int,
     previous_inv_id: int,
@@ -1275,231 +1494,318 @@ async def perform_recurring_charge(
         "Shp_user_id": str(user_id),
     }
 
-    try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            resp = await client.post("https://auth.robokassa.kz/Merchant/Recurring", data=payload)
+    return await recurring_client.charge(payload)
 
-        if resp.status_code == 200 and resp.text.strip().startswith("OK"):
-            return True, None
 
-        return False, f"Recurring failed: {resp.status_code} {resp.text}"
-    except Exception as e:
-        return False, f"Recurring exception: {e}"
+def _job_run_key() -> str:
+    """Ключ ежедневного запуска: один запуск job на календарный день."""
+    return datetime.now(TIMEZONE).strftime("%Y-%m-%d")
 
 
 async def process_recurring_charges(context: ContextTypes.DEFAULT_TYPE):
+    """Ежедневный запуск автосписаний (на лидере): создаём шарды и сразу берёмся за них."""
+    await shard_runner.start_run(RECURRING_CHARGE_JOB, _job_run_key())
+    await shard_runner.work(context)
+
+
+async def process_recurring_charges_shard(context: ContextTypes.DEFAULT_TYPE, shard: int, shard_count: int) -> dict:
     """
-    Ежедневная обработка автосписаний.
+    Автосписания одного шарда пользователей.
 
     Логика:
     - создаём pending за RECURRING_LEAD_TIME до expires_at
     - если pending уже есть, новый recurring не создаём
+      (отбор целиком в Database.get_due_recurring_charges)
     - expires_at не трогаем до подтверждения через Result URL
+
+    Запросы к Robokassa идут параллельно через recurring_client
+    (RECURRING_CONCURRENCY, RECURRING_RATE_PER_SEC). Перед каждым запросом pending
+    записывается для всего шарда одним условным UPDATE: если шард выполняется
+    повторно (воркер упал, аренду забрал другой), уже начатые списания
+    не создаются второй раз.
+    Сводку админам отправляет report_recurring_charges по всем шардам.
     """
     now_local = datetime.now(TIMEZONE).replace(tzinfo=None)
     charge_window_end = now_local + RECURRING_LEAD_TIME
 
-    subs = db.get_recurring_candidates()
-
-    for sub in subs:
-        if sub.get("cancel_requested"):
-            continue
-
-        user_id = sub["user_id"]
-        username = sub.get("username", "Пользователь")
-        anchor_inv_id = sub.get("anchor_inv_id")
-        expires_at = _to_local_naive(sub.get("expires_at"))
-        next_charge_at = _to_local_naive(sub.get("next_charge_at"))
-
-        if not anchor_inv_id or not expires_at:
-            continue
-
-        current_sub = db.get_subscription(user_id)
-        if not current_sub:
-            continue
-
-        if expires_at > charge_window_end:
-            continue
-
-        if next_charge_at and next_charge_at > now_local:
-            continue
-
-        if current_sub.get("pending_inv_id"):
-            logger.info(
-                "Skip recurring: pending exists user=%s pending_inv_id=%s",
-                user_id,
-                current_sub.get("pending_inv_id"),
-            )
-            continue
-
-        new_inv_id = int(time.time() * 1000) % 2147483647
+    # Фильтры по сроку, графику, pending и шарду — в SQL, повторных запросов на пользователя нет
+    subs = await db.get_due_recurring_charges(
+        now=now_local,
+        charge_window_end=charge_window_end,
+        shard=shard,
+        shard_count=shard_count,
+    )
+    logger.info("Автосписания, шард %s/%s: к обработке %s подписок", shard, shard_count, len(subs))
+
+    if not subs:
+        return {"total": 0, "created": 0, "failed": 0, "kicked": 0}
+
+    started = time.monotonic()
+    retry_at = now_local + RECURRING_RETRY_DELAY
+    # pending всего шарда — одним запросом до обращений к Robokassa; списываем только
+    # забранные. InvId выдаёт последовательность БД: не совпадут ни между шардами,
+    # ни с ручными оплатами (new_payment_inv_id)
+    inv_ids = await db.claim_pending_charges(
+        [sub["user_id"] for sub in subs],
+        amount=float(SUBSCRIPTION_PRICE),
+        created_at=now_local,
+    )
+    claimed = set(inv_ids)
+    skipped = [sub for sub in subs if sub["user_id"] not in claimed]
+    if skipped:
+        logger.warning(
+            "Автосписания, шард %s/%s: у %s подписок уже есть pending, пропущены",
+            shard,
+            shard_count,
+            len(skipped),
+        )
 
+    async def charge(sub: dict):
+        new_inv_id = inv_ids[sub["user_id"]]
         success, error = await perform_recurring_charge(
-            user_id=user_id,
-            previous_inv_id=anchor_inv_id,
+            user_id=sub["user_id"],
+            previous_inv_id=sub["anchor_inv_id"],
             amount=SUBSCRIPTION_PRICE,
             new_inv_id=new_inv_id,
             description="Подписка на канал Korkut Ipoteka",
         )
-
         if success:
-            db.set_pending_charge(
-                user_id=user_id,
-                pending_inv_id=new_inv_id,
-                amount=float(SUBSCRIPTION_PRICE),
-                created_at=now_local,
-            )
-
-            db.update_charge_schedule(
-                user_id=user_id,
-                next_charge_at=now_local + RECURRING_RETRY_DELAY,
-                anchor_inv_id=anchor_inv_id,
-            )
-
             logger.info(
                 "Recurring created: user=%s anchor=%s new_inv_id=%s (pending set)",
-                user_id,
-                anchor_inv_id,
+                sub["user_id"],
+                sub["anchor_inv_id"],
                 new_inv_id,
             )
+        return sub, success, error
+
+    results = await asyncio.gather(*(charge(sub) for sub in subs if sub["user_id"] in claimed))
+
+    # Успешные: pending уже записан, сдвигаем график одним запросом
+    created = [sub for sub, success, _ in results if success]
+    await db.update_charge_schedules([sub["user_id"] for sub in created], next_charge_at=retry_at)
+
+    # Неудачные: счётчики одним запросом, дальше — повтор или исключение
+    # Robokassa операцию не создала — pending снимаем, его место займёт повтор
+    failed = [(sub, error) for sub, success, error in results if not success]
+    await db.clear_pending_charges([sub["user_id"] for sub, _ in failed])
+    failures_by_user = await db.increment_recurring_failures_many([sub["user_id"] for sub, _ in failed])
+
+    to_retry = []
+    to_kick = []
+    admin_lines = []
+    for sub, error in failed:
+        user_id = sub["user_id"]
+        failures = failures_by_user.get(user_id, 0)
+        logger.warning(
+            "Recurring failed: user=%s anchor=%s failures=%s error=%s",
+            user_id,
+            sub["anchor_inv_id"],
+            failures,
+            error,
+        )
+        admin_lines.append(f"user={user_id}, attempt={failures}/{RECURRING_MAX_FAILURES}, err={error}")
+        if failures >= RECURRING_MAX_FAILURES:
+            to_kick.append((user_id, sub.get("username", "Пользователь")))
         else:
-            failures = db.increment_recurring_failures(user_id)
-            logger.warning(
-                "Recurring failed: user=%s anchor=%s failures=%s error=%s",
-                user_id,
-                anchor_inv_id,
-                failures,
-                error,
-            )
+            to_retry.append(user_id)
 
-            warn_text = (
-                "❌ Не удалось выполнить автосписание.\n"
-                f"Попытка {failures} из {RECURRING_MAX_FAILURES}.\n"
-                "Попробуйте оплатить вручную через кнопку ниже."
+    await db.update_charge_schedules(to_retry, next_charge_at=retry_at)
+
+    keyboard = [[InlineKeyboardButton("Оплатить", callback_data="funnel_offer_agreement")]]
+
+    async def warn(user_id: int, failures: int):
+        warn_text = (
+            "❌ Не удалось выполнить автосписание.\n"
+            f"Попытка {failures} из {RECURRING_MAX_FAILURES}.\n"
+            "Попробуйте оплатить вручную через кнопку ниже."
+        )
+        try:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=warn_text,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                rate_limit_args=PRIORITY_BULK,
             )
-            keyboard = [[InlineKeyboardButton("Оплатить", callback_data="funnel_offer_agreement")]]
+        except Exception as e:
+            logger.warning("Не удалось отправить предупреждение пользователю %s: %s", user_id, e)
 
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=warn_text,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                )
-            except Exception as e:
-                logger.warning("Не удалось отправить предупреждение пользователю %s: %s", user_id, e)
-
-            if ADMIN_SET or ADMIN_ID:
-                for admin_id in (ADMIN_SET or {ADMIN_ID}):
-                    try:
-                        await context.bot.send_message(
-                            chat_id=admin_id,
-                            text=(
-                                "❌ Автосписание не удалось: "
-                                f"user={user_id}, attempt={failures}/{RECURRING_MAX_FAILURES}, err={error}"
-                            ),
-                        )
-                    except Exception:
-                        pass
-
-            if failures >= RECURRING_MAX_FAILURES:
-                db.clear_pending_charge(user_id)
-                db.deactivate_subscription(user_id)
-                await kick_user_from_channel(context, user_id, username)
-
-                if ADMIN_SET or ADMIN_ID:
-                    for admin_id in (ADMIN_SET or {ADMIN_ID}):
-                        try:
-                            await context.bot.send_message(
-                                chat_id=admin_id,
-                                text=(
-                                    f"🚫 Пользователь исключен после {failures} неудачных автосписаний: "
-                                    f"user={user_id}"
-                                ),
-                            )
-                        except Exception:
-                            pass
-                continue
-
-            db.update_charge_schedule(
-                user_id=user_id,
-                next_charge_at=now_local + RECURRING_RETRY_DELAY,
-                anchor_inv_id=anchor_inv_id,
+    await asyncio.gather(
+        *(warn(sub["user_id"], failures_by_user.get(sub["user_id"], 0)) for sub, _ in failed)
+    )
+
+    if to_kick:
+        # Деактивируем всех, даже если кик не удался: попытки списания исчерпаны.
+        # pending снят выше вместе с остальными неудачными
+        await db.deactivate_subscriptions([user_id for user_id, _ in to_kick])
+        await kick_users_from_channel(context, to_kick, deactivate=False)
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        "Автосписания, шард %s/%s: создано %s, ошибок %s, исключено %s, %.1f сек",
+        shard,
+        shard_count,
+        len(created),
+        len(failed),
+        len(to_kick),
+        elapsed,
+    )
+
+    return {
+        "total": len(subs),
+        "created": len(created),
+        "skipped": len(skipped),
+        "failed": len(failed),
+        "kicked": len(to_kick),
+        "failures": admin_lines[:ADMIN_REPORT_MAX_LINES],
+        "kicked_ids": [user_id for user_id, _ in to_kick[:ADMIN_REPORT_MAX_LINES]],
+    }
+
+
+async def report_recurring_charges(context: ContextTypes.DEFAULT_TYPE, stats: list, elapsed: float):
+    """Все шарды автосписаний выполнены: одна сводка админам."""
+    total = sum(st.get("total", 0) for st in stats)
+    failed = sum(st.get("failed", 0) for st in stats)
+    failures = [line for st in stats for line in st.get("failures", [])]
+    kicked_ids = [user_id for st in stats for user_id in st.get("kicked_ids", [])]
+    kicked = sum(st.get("kicked", 0) for st in stats)
+    errors = [st["error"] for st in stats if st.get("error")]
+
+    logger.info(
+        "Автосписания завершены: создано %s, ошибок %s, исключено %s, %.1f сек",
+        sum(st.get("created", 0) for st in stats),
+        failed,
+        kicked,
+        elapsed,
+    )
+
+    if failed:
+        text = f"❌ Автосписания не удались: {failed} из {total}\n\n" + "\n".join(
+            failures[:ADMIN_REPORT_MAX_LINES]
+        )
+        if failed > ADMIN_REPORT_MAX_LINES:
+            text += f"\n… и ещё {failed - ADMIN_REPORT_MAX_LINES}"
+        if kicked:
+            text += (
+                f"\n\n🚫 Исключены после {RECURRING_MAX_FAILURES} неудачных автосписаний: "
+                + ", ".join(str(user_id) for user_id in kicked_ids[:ADMIN_REPORT_MAX_LINES])
             )
+        await notify_admins(context, text)
 
+    if errors:
+        await notify_admins(
+            context,
+            f"❌ Ошибка при обработке автосписаний ({len(errors)} шард.):\n" + "\n".join(errors[:ADMIN_REPORT_MAX_LINES]),
+        )
 
-async def check_expired_subscriptions(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("🔍 Запуск ежедневной проверки подписок...")
 
+async def check_expired_subscriptions(
+    context: ContextTypes.DEFAULT_TYPE,
+    job: str = EXPIRED_CHECK_JOB,
+    run_key: Optional[str] = None,
+):
+    """Запуск проверки подписок (ежедневно на лидере или /check_subs): шарды + сразу берёмся за них."""
+    logger.info("🔍 Запуск проверки подписок (%s)...", job)
+    await shard_runner.start_run(job, run_key or _job_run_key())
+    await shard_runner.work(context)
+
+
+async def check_expired_subscriptions_shard(context: ContextTypes.DEFAULT_TYPE, shard: int, shard_count: int) -> dict:
+    """Исключение пользователей с истёкшей подпиской из одного шарда."""
     kicked_count = 0
+    failed_count = 0
     warned_count = 0
 
-    try:
-        all_subscriptions = db.get_all_active_subscriptions()
-
-        for sub in all_subscriptions:
+    # Истекшие подписки приходят страницами: первый кик не ждёт загрузки всей таблицы,
+    # а память не растёт с числом подписчиков
+    pages = 0
+    async for page in db.iter_expired_subscriptions(
+        page_size=SUBSCRIPTION_JOB_PAGE_SIZE,
+        shard=shard,
+        shard_count=shard_count,
+    ):
+        pages += 1
+        to_kick = []
+        stale_pending = []
+        for sub in page:
             user_id = sub["user_id"]
             username = sub.get("username", "Пользователь")
-            expires_at = sub["expires_at"]
-            now_local = _now_for(expires_at)
-
-            if expires_at <= now_local:
-                if sub.get("pending_inv_id"):
-                    pending_created_at = _to_local_naive(sub.get("pending_created_at"))
-                    pending_is_fresh = (
-                        pending_created_at is not None
-                        and (now_local - pending_created_at) <= RECURRING_RETRY_DELAY
-                    )
+            now_local = _now_for(sub["expires_at"])
 
-                    if pending_is_fresh:
-                        logger.info(
-                            "Expired but fresh pending exists, skip kick: user=%s pending_inv_id=%s pending_created_at=%s",
-                            user_id,
-                            sub.get("pending_inv_id"),
-                            pending_created_at,
-                        )
-                        continue
-
-                    # Pending завис: очищаем блокировку кика и исключаем пользователя.
-                    db.clear_pending_charge(user_id)
-                    logger.warning(
-                        "Expired with stale pending, clearing pending and kicking user=%s pending_inv_id=%s pending_created_at=%s",
+            if sub.get("pending_inv_id"):
+                pending_created_at = _to_local_naive(sub.get("pending_created_at"))
+                pending_is_fresh = (
+                    pending_created_at is not None
+                    and (now_local - pending_created_at) <= RECURRING_RETRY_DELAY
+                )
+
+                if pending_is_fresh:
+                    logger.info(
+                        "Expired but fresh pending exists, skip kick: user=%s pending_inv_id=%s pending_created_at=%s",
                         user_id,
                         sub.get("pending_inv_id"),
                         pending_created_at,
                     )
+                    continue
+
+                # Pending завис: очищаем блокировку кика (одним запросом на страницу) и исключаем пользователя.
+                stale_pending.append(user_id)
+                logger.warning(
+                    "Expired with stale pending, clearing pending and kicking user=%s pending_inv_id=%s pending_created_at=%s",
+                    user_id,
+                    sub.get("pending_inv_id"),
+                    pending_created_at,
+                )
 
-                await kick_user_from_channel(context, user_id, username)
-                kicked_count += 1
+            to_kick.append((user_id, username))
 
+        await db.clear_pending_charges(stale_pending)
+        report = await kick_users_from_channel(context, to_kick)
+        kicked_count += report["kicked"]
+        failed_count += report["failed"]
         logger.info(
-            "✅ Проверка завершена: предупреждений отправлено: %s, кикнуто: %s",
-            warned_count,
+            "Проверка подписок, шард %s/%s: страница %s обработана, кикнуто всего: %s",
+            shard,
+            shard_count,
+            pages,
             kicked_count,
         )
 
-        if (ADMIN_SET or ADMIN_ID) and (kicked_count > 0 or warned_count > 0):
-            for admin_id in (ADMIN_SET or {ADMIN_ID}):
-                try:
-                    await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=f"📊 Ежедневная проверка подписок:\n\n"
-                             f"⚠️ Предупреждений отправлено: {warned_count}\n"
-                             f"🚫 Пользователей кикнуто: {kicked_count}"
-                    )
-                except Exception:
-                    pass
+    return {"kicked": kicked_count, "failed": failed_count, "warned": warned_count}
+
+
+async def report_expired_check(context: ContextTypes.DEFAULT_TYPE, stats: list, elapsed: float):
+    """Все шарды проверки подписок выполнены: итог в лог и сводка админам."""
+    kicked_count = sum(st.get("kicked", 0) for st in stats)
+    failed_count = sum(st.get("failed", 0) for st in stats)
+    warned_count = sum(st.get("warned", 0) for st in stats)
+    errors = [st["error"] for st in stats if st.get("error")]
+
+    throughput = (kicked_count + failed_count) / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        "✅ Проверка завершена: предупреждений отправлено: %s, кикнуто: %s, ошибок: %s, "
+        "%.1f сек (%.1f польз./сек)",
+        warned_count,
+        kicked_count,
+        failed_count,
+        elapsed,
+        throughput,
+    )
 
-    except Exception as e:
-        logger.error("Ошибка при проверке подписок: %s", e)
-        if ADMIN_SET or ADMIN_ID:
-            for admin_id in (ADMIN_SET or {ADMIN_ID}):
-                try:
-                    await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=f"❌ Ошибка при проверке подписок:\n{e}"
-                    )
-                except Exception:
-                    pass
+    if kicked_count > 0 or warned_count > 0 or failed_count > 0:
+        await notify_admins(
+            context,
+            f"📊 Ежедневная проверка подписок:\n\n"
+            f"⚠️ Предупреждений отправлено: {warned_count}\n"
+            f"🚫 Пользователей кикнуто: {kicked_count}\n"
+            f"❗️ Не удалось исключить: {failed_count}\n"
+            f"⏱ {elapsed:.1f} сек, {throughput:.1f} польз./сек",
+        )
+
+    if errors:
+        await notify_admins(
+            context,
+            "❌ Ошибка при проверке подписок:\n" + "\n".join(errors[:ADMIN_REPORT_MAX_LINES]),
+        )
 
 
 async def send_expiration_warning(
@@ -1520,6 +1826,7 @@ async def send_expiration_warning(
         await context.bot.send_message(
             chat_id=user_id,
             text=message,
+            rate_limit_args=PRIORITY_BULK,
         )
         logger.info("Отправлено предупреждение пользователю %s (осталось %s дней)", user_id, days_left)
     except Exception as e:
@@ -1527,34 +1834,77 @@ async def send_expiration_warning(
 
 
 async def kick_user_from_channel(context: ContextTypes.DEFAULT_TYPE, user_id: int, username: str):
-    try:
-        await context.bot.ban_chat_member(
-            chat_id=CHANNEL_ID,
-            user_id=user_id
-        )
+    await kick_users_from_channel(context, [(user_id, username)])
 
-        await context.bot.unban_chat_member(
-            chat_id=CHANNEL_ID,
-            user_id=user_id
-        )
 
-        db.deactivate_subscription(user_id)
+async def kick_users_from_channel(
+    context: ContextTypes.DEFAULT_TYPE,
+    users: list[tuple[int, str]],
+    *,
+    deactivate: bool = True,
+) -> dict:
+    """
+    Исключить пачку пользователей из канала.
+
+    - ban/unban идут параллельно (не больше KICK_CONCURRENCY) с приоритетом рассылок,
+      частоту и повторы после RetryAfter обеспечивает send_scheduler;
+    - подписки успешно исключённых деактивируются одним UPDATE
+      (deactivate=False — вызывающий уже деактивировал их сам);
+    - затем параллельно рассылаются уведомления.
+
+    Возвращает отчёт: kicked, failed, elapsed (сек).
+    """
+    started = time.monotonic()
+    if not users:
+        return {"kicked": 0, "failed": 0, "elapsed": 0.0}
 
+    semaphore = asyncio.Semaphore(max(KICK_CONCURRENCY, 1))
+
+    async def remove(user_id: int, username: str) -> bool:
+        async with semaphore:
+            try:
+                await context.bot.ban_chat_member(
+                    chat_id=CHANNEL_ID, user_id=user_id, rate_limit_args=PRIORITY_BULK
+                )
+                await context.bot.unban_chat_member(
+                    chat_id=CHANNEL_ID, user_id=user_id, rate_limit_args=PRIORITY_BULK
+                )
+            except Exception as e:
+                logger.error("Ошибка при кике пользователя %s: %s", user_id, e)
+                return False
         logger.info("Пользователь %s (%s) кикнут из канала (подписка истекла)", user_id, username)
+        return True
 
-        keyboard = [[InlineKeyboardButton("🔄 Продлить подписку", callback_data="funnel_offer_agreement")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    results = await asyncio.gather(*(remove(user_id, username) for user_id, username in users))
+    kicked = [user_id for (user_id, _), ok in zip(users, results) if ok]
 
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="❌ Ваша подписка истекла.\n\n"
-                 "Доступ к закрытому каналу приостановлен.\n\n"
-                 "Чтобы вернуться, продлите подписку 👇",
-            reply_markup=reply_markup
-        )
+    if deactivate:
+        await db.deactivate_subscriptions(kicked)
 
-    except Exception as e:
-        logger.error("Ошибка при кике пользователя %s: %s", user_id, e)
+    keyboard = [[InlineKeyboardButton("🔄 Продлить подписку", callback_data="funnel_offer_agreement")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    async def notify(user_id: int):
+        async with semaphore:
+            try:
+                await context.bot.send_message(
+                    chat_id=user_id,
+                    text="❌ Ваша подписка истекла.\n\n"
+                         "Доступ к закрытому каналу приостановлен.\n\n"
+                         "Чтобы вернуться, продлите подписку 👇",
+                    reply_markup=reply_markup,
+                    rate_limit_args=PRIORITY_BULK,
+                )
+            except Exception as e:
+                logger.warning("Не удалось уведомить исключённого пользователя %s: %s", user_id, e)
+
+    await asyncio.gather(*(notify(user_id) for user_id in kicked))
+
+    return {
+        "kicked": len(kicked),
+        "failed": len(users) - len(kicked),
+        "elapsed": time.monotonic() - started,
+    }
 
 
 async def manual_check_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1564,9 +1914,14 @@ async def manual_check_subscriptions(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text("❌ У вас нет доступа к этой команде")
         return
 
-    await update.message.reply_text("🔍 Запускаю проверку подписок...")
-    await check_expired_subscriptions(context)
-    await update.message.reply_text("✅ Проверка завершена!")
+    # Ключ запуска уникальный: каждая команда — новый запуск ручного job
+    run_key = datetime.now(TIMEZONE).strftime("%Y-%m-%dT%H:%M:%S")
+    await update.message.reply_text("🔍 Проверка подписок запущена")
+    # Отдельной задачей: апдейт не должен держать очередь чата и сессию БД,
+    # у шардов свои короткие транзакции
+    context.application.create_task(
+        check_expired_subscriptions(context, EXPIRED_CHECK_MANUAL_JOB, run_key), update=update
+    )
 
 
 async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
@@ -1584,52 +1939,157 @@ async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYP
         return
 
     if isinstance(err, RetryAfter):
-        logger.warning("Telegram rate limit, retry after: %s sec", err.retry_after)
+        # send_scheduler уже повторял запрос; сюда доходит только исчерпанный лимит повторов
+        logger.warning("Telegram rate limit, повторы исчерпаны, retry after: %s sec", err.retry_after)
         return
 
     logger.exception("Unhandled bot error: %s", err)
 
 
-def main():
-    global robokassa_client
+def build_change_handler(application):
+    """Реакция на изменения из других процессов (вебхук Robokassa и т.п.)."""
 
-    load_dotenv()
+    async def on_change(kind: str, user_ids: list[int]):
+        for user_id in user_ids:
+            db.subscription_cache.invalidate(user_id)
+
+        if kind == "payment":
+            # Оплата прошла — ссылка на оплату из user_data больше не актуальна
+            for user_id in user_ids:
+                user_data = application.user_data.get(user_id)
+                if user_data:
+                    user_data.pop("pending_inv_id", None)
+                    user_data.pop("pending_amount", None)
+            logger.info("Лента изменений: оплата пользователей %s", user_ids)
+
+    return on_change
+
+
+async def on_change_feed_reconnect():
+    # Пока соединения не было, события могли потеряться — кэшу больше не верим
+    db.subscription_cache.clear()
+
+
+async def on_application_startup(application):
+    """post_init: подключение к БД внутри event loop приложения."""
+    global change_feed, metrics_server
+    await db.init_database()
+    db.start_user_state_buffer(USER_STATE_FLUSH_INTERVAL_MS, USER_STATE_FLUSH_MAX_BATCH)
+    await recurring_client.start()
+    change_feed = ChangeFeedListener(
+        DATABASE_URL,
+        build_change_handler(application),
+        on_reconnect=on_change_feed_reconnect,
+    )
+    change_feed.start()
+    leader_election.start()
 
+    # В режиме вебхука метрики отдаёт FastAPI на своём порту
+    if METRICS_PORT and not TELEGRAM_WEBHOOK_MODE:
+        metrics_server = await start_http_server(METRICS_HOST, METRICS_PORT)
+
+
+async def on_application_shutdown(application):
+    """post_shutdown: отдаём лидерство, останавливаем ленту изменений, закрываем HTTP-клиент, дописываем буфер состояний и пул."""
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    if leader_election is not None:
+        await leader_election.stop()
+    if change_feed is not None:
+        await change_feed.stop()
+    await recurring_client.close()
+    await db.close()
+
+
+def scheduled(callback, name: str):
+    """Callback job с метриками (korkut_job_seconds), учётом SQL-запросов и профилированием."""
+    return instrument_job(query_stats.track(profiler.track(callback, name), name), name)
+
+
+def check_config() -> bool:
+    """Обязательные настройки для запуска бота (polling или вебхук)."""
     if not TELEGRAM_TOKEN:
         logger.error("TELEGRAM_TOKEN не установлен!")
-        return
+        return False
 
     if not ROBOKASSA_MERCHANT_LOGIN:
         logger.error("ROBOKASSA_MERCHANT_LOGIN не установлен!")
-        return
+        return False
 
     if not ROBOKASSA_PASSWORD_1:
         logger.error("ROBOKASSA_PASSWORD_1 не установлен!")
-        return
+        return False
 
     if not ROBOKASSA_PASSWORD_2:
         logger.warning("ROBOKASSA_PASSWORD_2 не установлен - проверка подписи недоступна")
 
+    if not DATABASE_URL:
+        logger.error("DATABASE_URL не установлен!")
+        return False
+
+    return True
+
+
+def build_application():
+    """
+    Собрать Application со всеми хендлерами и job.
+    Общее для polling (main) и режима вебхука (webhook.py): запуск и остановку
+    делает вызывающий код, подключение к БД — post_init.
+    """
+    global robokassa_client, db, media_cache, leader_election, shard_runner
+
     robokassa_client = init_robokassa()
     if robokassa_client:
         logger.info("Robokassa клиент инициализирован")
     else:
         logger.warning("Используем ручной метод создания ссылок")
 
-    global db
-    if not DATABASE_URL:
-        logger.error("DATABASE_URL не установлен!")
-        return
-
-    db = Database(DATABASE_URL)
-    db.init_database()
+    db = Database(
+        DATABASE_URL,
+        subscription_cache_size=SUBSCRIPTION_CACHE_SIZE,
+        subscription_cache_ttl=SUBSCRIPTION_CACHE_TTL,
+        subscription_cache_negative_ttl=SUBSCRIPTION_CACHE_NEGATIVE_TTL,
+    )
+    media_cache = MediaCache(db)
+    # Транзакция апдейта коммитится перед каждым запросом к Telegram
+    send_scheduler.before_request = db.commit_unit_of_work
+    query_stats.configure(max_statements=QUERY_ALERT_MAX_STATEMENTS, repeat_threshold=QUERY_ALERT_REPEAT)
+    query_stats.attach(db.engine)
+    profiler.configure(slow_seconds=PROFILE_SLOW_SECONDS, sample_interval=PROFILE_SAMPLE_INTERVAL_MS / 1000)
+    # Ежедневные job выполняет одна реплика из нескольких
+    leader_election = LeaderElection(DATABASE_URL, renew_interval=LEADER_RENEW_SECONDS)
+    # ...а их шарды разбирают все реплики
+    shard_runner = ShardedJobRunner(
+        db,
+        shard_count=JOB_SHARD_COUNT,
+        lease_seconds=JOB_SHARD_LEASE_SECONDS,
+        concurrency=JOB_SHARD_WORKERS,
+    )
+    shard_runner.register(EXPIRED_CHECK_JOB, check_expired_subscriptions_shard, report_expired_check)
+    shard_runner.register(EXPIRED_CHECK_MANUAL_JOB, check_expired_subscriptions_shard, report_expired_check)
+    shard_runner.register(RECURRING_CHARGE_JOB, process_recurring_charges_shard, report_recurring_charges)
 
     mode = "ТЕСТОВЫЙ" if ROBOKASSA_TEST_MODE else "БОЕВОЙ"
     logger.info("Режим Robokassa: %s", mode)
     logger.info("Merchant Login: %s", ROBOKASSA_MERCHANT_LOGIN)
     logger.info("Цена подписки: %s KZT", SUBSCRIPTION_PRICE)
 
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .rate_limiter(send_scheduler)
+        # Параллельно до UPDATE_CONCURRENCY апдейтов, внутри чата — по очереди;
+        # одна сессия БД и один COMMIT на апдейт
+        .concurrent_updates(OrderedUpdateProcessor(db, UPDATE_CONCURRENCY))
+        .post_init(on_application_startup)
+        .post_shutdown(on_application_shutdown)
+    )
+    if TELEGRAM_WEBHOOK_MODE:
+        # Апдейты кладёт в update_queue маршрут webhook.py, getUpdates не нужен
+        builder = builder.updater(None)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("subscribe", subscribe))
@@ -1639,6 +2099,8 @@ def main():
     application.add_handler(CommandHandler("stats", admin_stats))
     application.add_handler(CommandHandler("confirm_payment", confirm_payment))
     application.add_handler(CommandHandler("check_subs", manual_check_subscriptions))
+    application.add_handler(CommandHandler("sql_stats", admin_sql_stats))
+    application.add_handler(CommandHandler("profile", admin_profile))
     application.add_handler(CommandHandler("help", help_cmd))
     application.add_handler(ChatJoinRequestHandler(handle_join_request))
     application.add_handler(CallbackQueryHandler(funnel_story2, pattern="^funnel_story2$"))
@@ -1650,17 +2112,38 @@ def main():
 
     job_queue = application.job_queue
     job_queue.run_daily(
-        check_expired_subscriptions,
+        scheduled(leader_election.leader_only(check_expired_subscriptions), "daily_subscription_check"),
         time=dt_time(hour=12, minute=0, second=0, tzinfo=TIMEZONE),
         name="daily_subscription_check"
     )
     job_queue.run_daily(
-        process_recurring_charges,
+        scheduled(leader_election.leader_only(process_recurring_charges), "daily_recurring_charge"),
         time=dt_time(hour=3, minute=0, second=0, tzinfo=TIMEZONE),
         name="daily_recurring_charge"
     )
+    job_queue.run_repeating(
+        scheduled(shard_runner.work, "job_shards"),
+        interval=JOB_SHARD_POLL_SECONDS,
+        first=JOB_SHARD_POLL_SECONDS,
+        name="job_shards",
+        # Прошлый тик может ещё разбирать шарды — не пропускаем новый с предупреждением
+        job_kwargs={"max_instances": JOB_SHARD_WORKERS + 1},
+    )
+    job_queue.run_repeating(
+        scheduled(process_retargeting_queue, "retargeting_queue"),
+        interval=RETARGETING_POLL_SECONDS,
+        first=RETARGETING_POLL_SECONDS,
+        name="retargeting_queue"
+    )
+    job_queue.run_repeating(
+        scheduled(process_message_deletions, "message_deletions"),
+        interval=MESSAGE_DELETION_TICK_SECONDS,
+        first=MESSAGE_DELETION_TICK_SECONDS,
+        name="message_deletions"
+    )
     logger.info("📅 Запланирована ежедневная проверка подписок в 12:00")
     logger.info("📅 Запланирована ежедневная обработка автосписаний в 03:00")
+    logger.info("📅 Очередь ретаргетинга проверяется каждые %s сек", RETARGETING_POLL_SECONDS)
 
     application.add_handler(CallbackQueryHandler(funnel_want, pattern="^funnel_want$"))
     application.add_handler(CallbackQueryHandler(funnel_details, pattern="^funnel_details$"))
@@ -1676,6 +2159,36 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_message))
     application.add_error_handler(global_error_handler)
 
+    # Время и ошибки каждого хендлера — в метриках (korkut_handler_seconds{handler}),
+    # его SQL-запросы — в query_stats (/sql_stats), медленные вызовы — в окне /profile
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(query_stats.track(profiler.track(handler.callback)))
+
+    processor = application.update_processor
+    REGISTRY.gauge("updates_in_flight", "Апдейты в обработке", lambda: processor.current_concurrent_updates)
+    REGISTRY.gauge("updates_queued", "Апдейты в очереди чата или пула", lambda: getattr(processor, "queued_updates", 0))
+    REGISTRY.gauge("db_pool_checked_out", "Занятые соединения пула БД", db.engine.pool.checkedout)
+    REGISTRY.gauge("is_leader", "Реплика — лидер ежедневных job", lambda: leader_election.is_leader)
+
+    return application
+
+
+def main():
+    load_dotenv()
+
+    if TELEGRAM_WEBHOOK_MODE:
+        logger.error(
+            "TELEGRAM_WEBHOOK_MODE включён: апдейты принимает webhook.py, "
+            "отдельный процесс бота не нужен (uvicorn webhook:app)"
+        )
+        return
+
+    if not check_config():
+        return
+
+    application = build_application()
+
     logger.info("🤖 Бот запущен и готов к работе!")
 
     application.run_polling(
@@ -0,0 +1,106 @@
+"""
+Лента изменений между процессами через Postgres LISTEN/NOTIFY.
+
+Пишущие методы Database делают pg_notify в канал CHANGE_FEED_CHANNEL
+(payload: {"kind": "subscription" | "payment", "user_ids": [...]}).
+ChangeFeedListener держит отдельное autocommit-соединение psycopg с LISTEN
+и передаёт события в колбэк — так бот сразу узнаёт об оплатах,
+пришедших в процесс вебхука.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, List, Optional
+
+import psycopg
+from psycopg import sql
+from sqlalchemy.engine import make_url
+
+from database import CHANGE_FEED_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+ChangeHandler = Callable[[str, List[int]], Awaitable[None]]
+
+
+def to_psycopg_conninfo(db_url: str) -> str:
+    """URL SQLAlchemy (postgresql+psycopg://, postgresql+psycopg2://) -> conninfo для psycopg."""
+    return make_url(db_url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class ChangeFeedListener:
+    def __init__(
+        self,
+        db_url: str,
+        on_change: ChangeHandler,
+        *,
+        on_reconnect: Optional[Callable[[], Awaitable[None]]] = None,
+        channel: str = CHANGE_FEED_CHANNEL,
+        reconnect_delay: float = 5.0,
+        ping_interval: float = 30.0,
+    ):
+        self.conninfo = to_psycopg_conninfo(db_url)
+        self.on_change = on_change
+        self.on_reconnect = on_reconnect
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.ping_interval = ping_interval
+        self._task: Optional[asyncio.Task] = None
+        self.events = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        connected_before = False
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True) as conn:
+                    await conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                    logger.info("Подписка на изменения БД (LISTEN %s)", self.channel)
+
+                    # Пока соединения не было, уведомления могли потеряться
+                    if connected_before and self.on_reconnect is not None:
+                        await self.on_reconnect()
+                    connected_before = True
+
+                    while True:
+                        async for notify in conn.notifies(timeout=self.ping_interval):
+                            await self._dispatch(notify.payload)
+                        # Тишина ping_interval секунд — проверяем, что соединение живо
+                        await conn.execute("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(
+                    "Лента изменений БД прервалась: %s, переподключение через %.0f сек",
+                    e,
+                    self.reconnect_delay,
+                )
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def _dispatch(self, payload: str):
+        try:
+            event = json.loads(payload)
+            kind = event["kind"]
+            user_ids = [int(uid) for uid in event.get("user_ids", [])]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Некорректное событие ленты изменений: %r", payload)
+            return
+
+        self.events += 1
+        try:
+            await self.on_change(kind, user_ids)
+        except Exception as e:
+            logger.error("Ошибка обработки события %s %s: %s", kind, user_ids, e)
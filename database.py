@@ -1,110 +1,328 @@
+import asyncio
 import json
 import logging
 import re
-from datetime import datetime
-from typing import Optional, Dict, List, Any
+import sys
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, List, Any, AsyncIterator, Iterable
 
 import sqlalchemy as sa
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from metrics import instrument_methods
+from migrations import migrate
 
 logger = logging.getLogger(__name__)
 
+# Канал LISTEN/NOTIFY, в который пишущие методы Database сообщают об изменениях
+CHANGE_FEED_CHANNEL = "korkut_changes"
+
+# Сколько user_id класть в одно уведомление (payload NOTIFY ограничен 8000 байт)
+CHANGE_FEED_CHUNK = 500
+
+# Шард пользователя в ежедневных job: равномерно по хэшу user_id
+SHARD_FILTER = "mod(abs(hashint8(s.user_id)::BIGINT), :shard_count) = :shard"
+
+# psycopg (v3) в async-режиме не работает с ProactorEventLoop (дефолт на Windows)
+if sys.platform == "win32":
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+# Синхронные драйверы, которые заменяем на async-вариант psycopg
+_SYNC_PG_DRIVERS = {"postgres", "postgresql", "postgresql+psycopg2", "postgresql+psycopg2cffi"}
+
+
+def _ensure_utc(dt: datetime) -> datetime:
+    """
+    Приводит datetime к aware UTC.
+    Если из БД пришёл naive datetime, считаем его UTC.
+    """
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def _is_active_at(subscription: Optional[Dict[str, Any]], now_local: datetime) -> bool:
+    """Действует ли подписка (naive expires_at — локальное время, как в бот-хендлерах)."""
+    expires_at = (subscription or {}).get("expires_at")
+    if not expires_at:
+        return False
+    if expires_at.tzinfo is not None:
+        return expires_at > datetime.now(expires_at.tzinfo)
+    return expires_at > now_local
+
+
+def to_async_url(db_url: str) -> str:
+    """
+    Приводит DATABASE_URL к async-драйверу.
+    Старые строки вида postgresql+psycopg2://... продолжают работать без правки .env.
+    """
+    url = make_url(db_url)
+    if url.drivername in _SYNC_PG_DRIVERS:
+        url = url.set(drivername="postgresql+psycopg")
+    return url.render_as_string(hide_password=False)
+
+
+class SubscriptionCache:
+    """
+    Ограниченный in-process LRU-кэш активных подписок по user_id с TTL.
+    Отсутствие подписки тоже кэшируется (negative caching) со своим, более коротким TTL.
+    Инвалидация — явная, из всех write-методов Database.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0, negative_ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[int, tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        # Растёт при каждой инвалидации: защита от записи в кэш результата,
+        # прочитанного до параллельного изменения подписки.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: int):
+        """Значение из кэша (копия) или SubscriptionCache.MISSING."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return self.MISSING
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return self.MISSING
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return dict(value) if value is not None else None
+
+    def set(self, user_id: int, value: Optional[Dict[str, Any]], generation: Optional[int] = None):
+        """Положить подписку (или None) в кэш, если с момента чтения не было инвалидаций."""
+        if not self.enabled:
+            return
+        if generation is not None and generation != self._generation:
+            return
+
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+
+        self._entries[user_id] = (time.monotonic() + ttl, dict(value) if value is not None else None)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id: int):
+        self._generation += 1
+        self.invalidations += 1
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class _UnitOfWork:
+    """Общая сессия апдейта: кому принадлежит, что инвалидировать после COMMIT."""
+
+    def __init__(self, db: "Database", session: AsyncSession):
+        self.db = db
+        self.session = session
+        self.task = asyncio.current_task()
+        self.invalidated: set = set()
+        self.failed = False
+
+
+# Текущий unit of work (см. Database.unit_of_work)
+_current_uow: ContextVar[Optional[_UnitOfWork]] = ContextVar("korkut_unit_of_work", default=None)
+
 
 class Database:
     """
-    Postgres-реализация хранилища.
+    Postgres-реализация хранилища (asyncio, SQLAlchemy AsyncEngine + psycopg 3).
     Ожидает, что таблицы уже созданы (users, subscriptions, payments, questions).
-    Интерфейс сохранён, чтобы минимально менять остальной код бота.
+    Интерфейс сохранён, чтобы минимально менять остальной код бота:
+    те же методы, только их нужно await-ить.
+    Для синхронных скриптов есть SyncDatabase.
     """
 
-    def __init__(self, db_url: str):
-        self.engine = create_engine(db_url, future=True)
-        self.Session = sessionmaker(self.engine, expire_on_commit=False, future=True)
+    def __init__(
+        self,
+        db_url: str,
+        *,
+        subscription_cache_size: int = 0,
+        subscription_cache_ttl: float = 60.0,
+        subscription_cache_negative_ttl: float = 5.0,
+    ):
+        self.engine = create_async_engine(to_async_url(db_url))
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        # По умолчанию кэш выключен (size=0): включает его только бот
+        self.subscription_cache = SubscriptionCache(
+            max_size=subscription_cache_size,
+            ttl=subscription_cache_ttl,
+            negative_ttl=subscription_cache_negative_ttl,
+        )
+
+        # Write-behind буфер состояний воронки: user_id -> (username, state).
+        # Пока буфер не запущен, update_user_state пишет в БД сразу.
+        # user_id -> (username, state, когда состояние получено)
+        self._state_buffer: "OrderedDict[int, tuple[str, str, datetime]]" = OrderedDict()
+        self._state_flush_task: Optional[asyncio.Task] = None
+        self._state_flush_interval = 0.5
+        self._state_flush_max_batch = 200
+        self._state_flush_wakeup = asyncio.Event()
+        self._state_flush_lock = asyncio.Lock()
+
+    # -------------------
+    # Сессии / unit of work
+    # -------------------
+    def _active_uow(self) -> Optional[_UnitOfWork]:
+        uow = _current_uow.get()
+        # Задачи, порождённые внутри апдейта (gather, create_task), наследуют contextvar,
+        # но одну AsyncSession нельзя использовать конкурентно — им своя сессия
+        if uow is not None and uow.db is self and uow.task is asyncio.current_task():
+            return uow
+        return None
 
-    def init_database(self):
-        """Проверка подключения и добавление недостающих колонок/индексов."""
+    @asynccontextmanager
+    async def unit_of_work(self):
+        """
+        Одна сессия на весь блок: все методы Database внутри используют её
+        и не коммитят сами. COMMIT — в конце блока и в commit_unit_of_work
+        (перед запросами к Telegram); если упал запрос к БД или сам блок — ROLLBACK.
+        Соединение из пула берётся лениво, при первом запросе.
+        """
+        if self._active_uow() is not None:
+            yield
+            return
+
+        session = self.Session()
+        uow = _UnitOfWork(self, session)
+        token = _current_uow.set(uow)
         try:
-            with self.engine.begin() as conn:
-                conn.execute(sa.text("SELECT 1"))
+            yield
+        except BaseException:
+            uow.failed = True
+            raise
+        finally:
+            _current_uow.reset(token)
+            try:
+                await self._end_transaction(uow, commit=not uow.failed)
+            finally:
+                await session.close()
 
-                conn.execute(
-                    sa.text(
-                        """
-                        ALTER TABLE subscriptions
-                        ADD COLUMN IF NOT EXISTS cancel_requested BOOLEAN DEFAULT FALSE
-                        """
-                    )
-                )
-                conn.execute(
-                    sa.text(
-                        """
-                        ALTER TABLE subscriptions
-                        ADD COLUMN IF NOT EXISTS cancel_requested_at TIMESTAMP
-                        """
-                    )
-                )
-                conn.execute(
-                    sa.text(
-                        """
-                        ALTER TABLE subscriptions
-                        ADD COLUMN IF NOT EXISTS anchor_inv_id BIGINT
-                        """
-                    )
-                )
-                conn.execute(
-                    sa.text(
-                        """
-                        ALTER TABLE subscriptions
-                        ADD COLUMN IF NOT EXISTS next_charge_at TIMESTAMP
-                        """
-                    )
-                )
-                conn.execute(
-                    sa.text(
-                        """
-                        ALTER TABLE subscriptions
-                        ADD COLUMN IF NOT EXISTS pending_inv_id BIGINT
-                        """
-                    )
-                )
-                conn.execute(
-                    sa.text(
-                        """
-                        ALTER TABLE subscriptions
-                        ADD COLUMN IF NOT EXISTS pending_amount NUMERIC
-                        """
-                    )
-                )
-                conn.execute(
-                    sa.text(
-                        """
-                        ALTER TABLE subscriptions
-                        ADD COLUMN IF NOT EXISTS pending_created_at TIMESTAMP
-                        """
-                    )
-                )
-                conn.execute(
-                    sa.text(
-                        """
-                        ALTER TABLE subscriptions
-                        ADD COLUMN IF NOT EXISTS recurring_failure_count INTEGER DEFAULT 0
-                        """
-                    )
-                )
+    async def _end_transaction(self, uow: _UnitOfWork, *, commit: bool):
+        try:
+            if uow.session.in_transaction():
+                if commit:
+                    await uow.session.commit()
+                else:
+                    await uow.session.rollback()
+        finally:
+            uow.failed = False
+            for user_id in uow.invalidated:
+                self.subscription_cache.invalidate(user_id)
+            uow.invalidated.clear()
 
-                # Полезный индекс для защиты от дублей по inv_id
-                conn.execute(
-                    sa.text(
-                        """
-                        CREATE UNIQUE INDEX IF NOT EXISTS ux_payments_inv_id
-                        ON payments (inv_id)
-                        WHERE inv_id IS NOT NULL
-                        """
-                    )
-                )
+    async def commit_unit_of_work(self):
+        """
+        Закоммитить то, что уже сделано в текущем unit of work, и вернуть соединение
+        в пул (если запрос к БД в блоке упал — откатить). Следующий запрос блока
+        начнёт новую транзакцию. Вызывается перед запросами к Telegram: транзакция
+        не должна висеть, пока ждём лимитер и сеть. Вне unit of work ничего не делает.
+        """
+        uow = self._active_uow()
+        if uow is not None:
+            await self._end_transaction(uow, commit=not uow.failed)
 
-            logger.info("Подключено к Postgres")
+    async def rollback_unit_of_work(self):
+        """
+        Откатить текущую транзакцию unit of work: для хендлеров, которые ловят
+        ошибку БД и продолжают работу — иначе следующие запросы упадут
+        в прерванной транзакции, а в конце откатится всё.
+        """
+        uow = self._active_uow()
+        if uow is not None:
+            await self._end_transaction(uow, commit=False)
+
+    @asynccontextmanager
+    async def _session(self) -> AsyncIterator[AsyncSession]:
+        """Сессия текущего unit of work, а вне его — своя короткая транзакция."""
+        uow = self._active_uow()
+        if uow is None:
+            async with self.Session() as s, s.begin():
+                yield s
+            return
+
+        try:
+            yield uow.session
+        except BaseException:
+            uow.failed = True
+            raise
+
+    def _invalidate(self, user_ids: Iterable[int]):
+        """
+        Сбросить кэш подписок. Внутри unit of work — ещё раз после COMMIT/ROLLBACK:
+        до этого другие задачи могли закэшировать старое значение.
+        """
+        uow = self._active_uow()
+        for user_id in user_ids:
+            self.subscription_cache.invalidate(user_id)
+            if uow is not None:
+                uow.invalidated.add(user_id)
+
+    @staticmethod
+    async def _notify_change(s, kind: str, user_ids: List[int]):
+        """
+        NOTIFY об изменении подписок/платежей внутри текущей транзакции:
+        Postgres доставит его слушателям (см. change_feed.py) только после COMMIT.
+        """
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), CHANGE_FEED_CHUNK):
+            await s.execute(
+                sa.text("SELECT pg_notify(:channel, :payload)"),
+                {
+                    "channel": CHANGE_FEED_CHANNEL,
+                    "payload": json.dumps({"kind": kind, "user_ids": user_ids[i:i + CHANGE_FEED_CHUNK]}),
+                },
+            )
+
+    async def init_database(self):
+        """Проверка подключения и версии схемы; недостающие миграции применяются (migrations.py)."""
+        try:
+            version = await migrate(self.engine)
+            logger.info("Подключено к Postgres, схема версии %s", version)
         except Exception as e:
             logger.error(f"Не удалось подключиться к Postgres: {e}")
             raise
@@ -112,28 +330,124 @@ class Database:
     # -------------------
     # Пользователи / воронка
     # -------------------
-    def update_user_state(self, user_id: int, username: str, state: str):
-        """Upsert пользователя и сохранение состояния воронки."""
-        with self.Session() as s, s.begin():
-            s.execute(
+    async def update_user_state(self, user_id: int, username: str, state: str):
+        """
+        Upsert пользователя и сохранение состояния воронки.
+        При запущенном буфере (start_user_state_buffer) запись откладывается
+        и уходит в БД пачкой; для одного пользователя выигрывает последнее состояние.
+        """
+        if self._state_flush_task is not None:
+            self._state_buffer[user_id] = (username, state, datetime.now(timezone.utc))
+            self._state_buffer.move_to_end(user_id)
+            if len(self._state_buffer) >= self._state_flush_max_batch:
+                self._state_flush_wakeup.set()
+            return
+
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
-                    INSERT INTO users (user_id, username, state)
-                    VALUES (:uid, :uname, :state)
+                    INSERT INTO users (user_id, username, state, state_updated_at)
+                    VALUES (:uid, :uname, :state, :state_at)
                     ON CONFLICT (user_id) DO UPDATE
                     SET username = EXCLUDED.username,
                         state = EXCLUDED.state,
+                        state_updated_at = EXCLUDED.state_updated_at,
                         updated_at = now()
                     """
                 ),
-                {"uid": user_id, "uname": username, "state": state},
+                {"uid": user_id, "uname": username, "state": state, "state_at": datetime.now(timezone.utc)},
             )
         logger.info("Состояние пользователя %s обновлено: %s", user_id, state)
 
-    def save_user_question(self, user_id: int, question: str):
+    def start_user_state_buffer(self, flush_interval_ms: int = 500, max_batch: int = 200):
+        """Включить write-behind буфер состояний воронки (вызывать внутри event loop)."""
+        if self._state_flush_task is not None:
+            return
+        self._state_flush_interval = max(flush_interval_ms, 1) / 1000
+        self._state_flush_max_batch = max(max_batch, 1)
+        self._state_flush_task = asyncio.create_task(self._state_flush_loop())
+        logger.info(
+            "Буфер состояний воронки запущен: каждые %s мс или по %s записей",
+            flush_interval_ms,
+            self._state_flush_max_batch,
+        )
+
+    async def stop_user_state_buffer(self):
+        """Остановить буфер и дописать всё накопленное."""
+        task, self._state_flush_task = self._state_flush_task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await self.flush_user_states()
+
+    async def _state_flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._state_flush_wakeup.wait(), self._state_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._state_flush_wakeup.clear()
+            await self.flush_user_states()
+
+    async def flush_user_states(self) -> int:
+        """
+        Записать накопленные состояния одним multi-row upsert. Возвращает размер пачки.
+        Состояние, записанное в обход буфера позже (get_subscription_and_record_state),
+        пачка, которую уже забрали из буфера, не перетирает: сравнение по
+        state_updated_at — его ставят только записи состояния, по часам бота.
+        """
+        async with self._state_flush_lock:
+            if not self._state_buffer:
+                return 0
+            batch, self._state_buffer = self._state_buffer, OrderedDict()
+
+            try:
+                async with self._session() as s:
+                    await s.execute(
+                        sa.text(
+                            """
+                            INSERT INTO users (user_id, username, state, state_updated_at)
+                            SELECT * FROM unnest(
+                                CAST(:uids AS BIGINT[]),
+                                CAST(:unames AS TEXT[]),
+                                CAST(:states AS TEXT[]),
+                                CAST(:times AS TIMESTAMPTZ[])
+                            )
+                            ON CONFLICT (user_id) DO UPDATE
+                            SET username = EXCLUDED.username,
+                                state = EXCLUDED.state,
+                                state_updated_at = EXCLUDED.state_updated_at,
+                                updated_at = now()
+                            WHERE users.state_updated_at IS NULL
+                               OR users.state_updated_at <= EXCLUDED.state_updated_at
+                            """
+                        ),
+                        {
+                            "uids": list(batch.keys()),
+                            "unames": [username for username, _, _ in batch.values()],
+                            "states": [state for _, state, _ in batch.values()],
+                            "times": [received_at for _, _, received_at in batch.values()],
+                        },
+                    )
+            except Exception as e:
+                # Возвращаем пачку в буфер, не перетирая более свежие состояния
+                for user_id, value in batch.items():
+                    self._state_buffer.setdefault(user_id, value)
+                logger.error("Не удалось записать состояния воронки (%s шт.): %s", len(batch), e)
+                return 0
+
+        logger.info("Состояния воронки записаны пачкой: %s пользователей", len(batch))
+        return len(batch)
+
+    async def save_user_question(self, user_id: int, question: str):
         """Сохранить вопрос пользователя."""
-        with self.Session() as s, s.begin():
-            s.execute(
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
                     INSERT INTO questions (user_id, text, created_at)
@@ -147,7 +461,7 @@ class Database:
     # -------------------
     # Подписки
     # -------------------
-    def add_subscription(
+    async def add_subscription(
         self,
         user_id: int,
         username: str,
@@ -157,8 +471,8 @@ class Database:
         next_charge_at: Optional[datetime] = None,
     ):
         """Создать/обновить подписку и пользователя."""
-        with self.Session() as s, s.begin():
-            s.execute(
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
                     INSERT INTO users (user_id, username)
@@ -171,7 +485,7 @@ class Database:
                 {"uid": user_id, "uname": username},
             )
 
-            s.execute(
+            await s.execute(
                 sa.text(
                     """
                     UPDATE subscriptions
@@ -182,7 +496,7 @@ class Database:
                 {"uid": user_id},
             )
 
-            s.execute(
+            await s.execute(
                 sa.text(
                     """
                     INSERT INTO subscriptions (
@@ -224,13 +538,33 @@ class Database:
                     "next_charge": next_charge_at,
                 },
             )
+            await self._notify_change(s, "subscription", [user_id])
+        self._invalidate([user_id])
         logger.info("Подписка создана/обновлена для пользователя %s", user_id)
 
-    def get_subscription(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Получить активную подписку пользователя (самую свежую)."""
-        with self.Session() as s:
+    async def get_subscription(self, user_id: int, *, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Получить активную подписку пользователя (самую свежую).
+        Read-through через subscription_cache; use_cache=False — всегда читать из БД.
+        """
+        cache = self.subscription_cache
+        if use_cache and cache.enabled:
+            cached = cache.get(user_id)
+            if cached is not SubscriptionCache.MISSING:
+                return cached
+
+        generation = cache.generation
+        subscription = await self._fetch_subscription(user_id)
+        uow = self._active_uow()
+        # Незакоммиченные изменения своей транзакции в общий кэш не кладём
+        if uow is None or user_id not in uow.invalidated:
+            cache.set(user_id, subscription, generation)
+        return subscription
+
+    async def _fetch_subscription(self, user_id: int) -> Optional[Dict[str, Any]]:
+        async with self._session() as s:
             row = (
-                s.execute(
+                await s.execute(
                     sa.text(
                         """
                         SELECT user_id, expires_at, active, cancel_requested, cancel_requested_at,
@@ -244,100 +578,221 @@ class Database:
                     ),
                     {"uid": user_id},
                 )
-                .mappings()
-                .first()
-            )
+            ).mappings().first()
 
-            if row:
-                return {
-                    "user_id": row["user_id"],
-                    "expires_at": row["expires_at"],
-                    "active": row["active"],
-                    "cancel_requested": row["cancel_requested"],
-                    "cancel_requested_at": row["cancel_requested_at"],
-                    "anchor_inv_id": row.get("anchor_inv_id"),
-                    "next_charge_at": row.get("next_charge_at"),
-                    "pending_inv_id": row.get("pending_inv_id"),
-                    "pending_amount": row.get("pending_amount"),
-                    "pending_created_at": row.get("pending_created_at"),
-                    "recurring_failure_count": row.get("recurring_failure_count") or 0,
-                }
-        return None
+        return self._subscription_from_row(row)
 
-    def get_expired_subscriptions(self) -> List[Dict[str, Any]]:
-        """Истекшие активные подписки."""
-        with self.Session() as s:
-            rows = (
-                s.execute(
+    @staticmethod
+    def _subscription_from_row(row) -> Optional[Dict[str, Any]]:
+        if not row or row.get("user_id") is None:
+            return None
+        return {
+            "user_id": row["user_id"],
+            "expires_at": row["expires_at"],
+            "active": row["active"],
+            "cancel_requested": row["cancel_requested"],
+            "cancel_requested_at": row["cancel_requested_at"],
+            "anchor_inv_id": row.get("anchor_inv_id"),
+            "next_charge_at": row.get("next_charge_at"),
+            "pending_inv_id": row.get("pending_inv_id"),
+            "pending_amount": row.get("pending_amount"),
+            "pending_created_at": row.get("pending_created_at"),
+            "recurring_failure_count": row.get("recurring_failure_count") or 0,
+        }
+
+    async def get_subscription_and_record_state(
+        self,
+        user_id: int,
+        username: str,
+        state: str,
+        *,
+        question: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Входной путь хендлеров за один запрос: вернуть активную подписку, а если
+        она не действует — записать состояние воронки (и вопрос, если передан).
+        Действующая подписка из кэша возвращается вообще без похода в БД.
+        """
+        now_local = datetime.now()
+        cache = self.subscription_cache
+        if cache.enabled:
+            cached = cache.get(user_id)
+            if cached is not SubscriptionCache.MISSING and _is_active_at(cached, now_local):
+                return cached
+
+        generation = cache.generation
+        async with self._session() as s:
+            row = (
+                await s.execute(
                     sa.text(
                         """
-                        SELECT s.user_id, s.expires_at, u.username,
-                               s.cancel_requested, s.anchor_inv_id, s.next_charge_at,
-                               s.pending_inv_id, s.pending_amount, s.pending_created_at
-                        FROM subscriptions s
-                        LEFT JOIN users u ON u.user_id = s.user_id
-                        WHERE s.active = TRUE AND s.expires_at < now()
+                        WITH sub AS (
+                            SELECT user_id, expires_at, active, cancel_requested, cancel_requested_at,
+                                   anchor_inv_id, next_charge_at, pending_inv_id, pending_amount,
+                                   pending_created_at, recurring_failure_count
+                            FROM subscriptions
+                            WHERE user_id = :uid AND active = TRUE
+                            ORDER BY expires_at DESC
+                            LIMIT 1
+                        ),
+                        inactive AS (
+                            SELECT NOT EXISTS (SELECT 1 FROM sub WHERE expires_at > now()) AS yes
+                        ),
+                        upsert AS (
+                            INSERT INTO users (user_id, username, state, state_updated_at)
+                            SELECT :uid, :uname, :state, CAST(:state_at AS TIMESTAMPTZ)
+                            FROM inactive
+                            WHERE inactive.yes
+                            ON CONFLICT (user_id) DO UPDATE
+                            SET username = EXCLUDED.username,
+                                state = EXCLUDED.state,
+                                state_updated_at = EXCLUDED.state_updated_at,
+                                updated_at = now()
+                            RETURNING user_id
+                        ),
+                        question AS (
+                            INSERT INTO questions (user_id, text, created_at)
+                            SELECT :uid, CAST(:question AS TEXT), now()
+                            FROM inactive
+                            WHERE inactive.yes AND CAST(:question AS TEXT) IS NOT NULL
+                            RETURNING id
+                        )
+                        SELECT sub.*,
+                               (SELECT count(*) FROM upsert) AS state_written,
+                               (SELECT count(*) FROM question) AS question_written
+                        FROM (SELECT 1) AS one
+                        LEFT JOIN sub ON TRUE
                         """
-                    )
+                    ),
+                    {
+                        "uid": user_id,
+                        "uname": username,
+                        "state": state,
+                        "state_at": datetime.now(timezone.utc),
+                        "question": question,
+                    },
                 )
-                .mappings()
-                .all()
-            )
-            return [dict(r) for r in rows]
+            ).mappings().first()
 
-    def get_all_active_subscriptions(self) -> List[Dict[str, Any]]:
-        """Все активные подписки."""
-        with self.Session() as s:
-            rows = (
-                s.execute(
-                    sa.text(
-                        """
-                        SELECT s.user_id, u.username, s.expires_at, s.cancel_requested,
-                               s.anchor_inv_id, s.next_charge_at,
-                               s.pending_inv_id, s.pending_amount, s.pending_created_at,
-                               s.recurring_failure_count
-                        FROM subscriptions s
-                        LEFT JOIN users u ON u.user_id = s.user_id
-                        WHERE s.active = TRUE
-                        """
+        if row["state_written"]:
+            # Более старое состояние из буфера не должно перетереть только что записанное
+            self._state_buffer.pop(user_id, None)
+            logger.info("Состояние пользователя %s обновлено: %s", user_id, state)
+        if row["question_written"]:
+            logger.info("Вопрос пользователя %s сохранён", user_id)
+
+        subscription = self._subscription_from_row(row)
+        uow = self._active_uow()
+        if uow is None or user_id not in uow.invalidated:
+            cache.set(user_id, subscription, generation)
+        return subscription
+
+    async def iter_active_subscriptions(self, page_size: int = 500) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Все активные подписки страницами по page_size (keyset по user_id)."""
+        async for page in self._iter_subscription_pages("TRUE", {}, page_size):
+            yield page
+
+    async def iter_expired_subscriptions(
+        self,
+        now: Optional[datetime] = None,
+        page_size: int = 500,
+        shard: int = 0,
+        shard_count: int = 1,
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Истекшие (expires_at <= now) активные подписки страницами по page_size.
+        Keyset по user_id: можно деактивировать обработанные строки прямо по ходу
+        обхода — следующие страницы от этого не сдвигаются.
+        shard/shard_count — только пользователи своего шарда (см. SHARD_FILTER).
+        """
+        condition = "s.expires_at <= :now"
+        params: Dict[str, Any] = {"now": now or datetime.now()}
+        if shard_count > 1:
+            condition += f" AND {SHARD_FILTER}"
+            params.update(shard=shard, shard_count=shard_count)
+        async for page in self._iter_subscription_pages(condition, params, page_size):
+            yield page
+
+    async def _iter_subscription_pages(
+        self,
+        condition: str,
+        params: Dict[str, Any],
+        page_size: int,
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        last_user_id = 0  # user_id в Telegram всегда положительный
+        while True:
+            async with self._session() as s:
+                rows = (
+                    await s.execute(
+                        sa.text(
+                            f"""
+                            SELECT s.user_id, u.username, s.expires_at, s.cancel_requested,
+                                   s.anchor_inv_id, s.next_charge_at,
+                                   s.pending_inv_id, s.pending_amount, s.pending_created_at,
+                                   s.recurring_failure_count
+                            FROM subscriptions s
+                            LEFT JOIN users u ON u.user_id = s.user_id
+                            WHERE s.active = TRUE
+                              AND ({condition})
+                              AND s.user_id > :after
+                            ORDER BY s.user_id
+                            LIMIT :limit
+                            """
+                        ),
+                        {**params, "after": last_user_id, "limit": page_size},
                     )
-                )
-                .mappings()
-                .all()
-            )
-            return [dict(r) for r in rows]
+                ).mappings().all()
+
+            if not rows:
+                return
+            yield [dict(r) for r in rows]
+            if len(rows) < page_size:
+                return
+            last_user_id = rows[-1]["user_id"]
 
-    def get_recurring_candidates(self) -> List[Dict[str, Any]]:
+    async def get_due_recurring_charges(
+        self,
+        now: datetime,
+        charge_window_end: datetime,
+        shard: int = 0,
+        shard_count: int = 1,
+    ) -> List[Dict[str, Any]]:
         """
-        Кандидаты для логики автосписаний.
-        Берём все активные подписки с anchor_inv_id и без отключённого автоплатежа.
+        Подписки, по которым пора создавать автосписание.
+        Все условия — в SQL (опирается на частичный индекс ix_subscriptions_due_charges):
+        активна, автоплатёж не отключён, есть anchor_inv_id, нет висящего pending,
+        expires_at <= charge_window_end и next_charge_at (если задан) <= now.
+        shard/shard_count — только пользователи своего шарда (см. SHARD_FILTER).
         """
-        with self.Session() as s:
+        shard_condition = f"AND {SHARD_FILTER}" if shard_count > 1 else ""
+        async with self._session() as s:
             rows = (
-                s.execute(
+                await s.execute(
                     sa.text(
-                        """
-                        SELECT s.user_id, u.username, s.expires_at, s.cancel_requested,
-                               s.cancel_requested_at, s.anchor_inv_id, s.next_charge_at,
-                               s.pending_inv_id, s.pending_amount, s.pending_created_at,
-                               s.recurring_failure_count
+                        f"""
+                        SELECT s.user_id, u.username, s.expires_at, s.anchor_inv_id,
+                               s.next_charge_at, s.recurring_failure_count
                         FROM subscriptions s
                         LEFT JOIN users u ON u.user_id = s.user_id
                         WHERE s.active = TRUE
                           AND COALESCE(s.cancel_requested, FALSE) = FALSE
                           AND s.anchor_inv_id IS NOT NULL
+                          AND s.pending_inv_id IS NULL
+                          AND s.expires_at <= :window_end
+                          AND (s.next_charge_at IS NULL OR s.next_charge_at <= :now)
+                          {shard_condition}
+                        ORDER BY s.expires_at
                         """
-                    )
+                    ),
+                    {"now": now, "window_end": charge_window_end, "shard": shard, "shard_count": shard_count},
                 )
-                .mappings()
-                .all()
-            )
+            ).mappings().all()
             return [dict(r) for r in rows]
 
-    def deactivate_subscription(self, user_id: int):
+    async def deactivate_subscription(self, user_id: int):
         """Деактивировать подписку пользователя."""
-        with self.Session() as s, s.begin():
-            s.execute(
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
                     UPDATE subscriptions
@@ -347,9 +802,31 @@ class Database:
                 ),
                 {"uid": user_id},
             )
+            await self._notify_change(s, "subscription", [user_id])
+        self._invalidate([user_id])
         logger.info("Подписка деактивирована для пользователя %s", user_id)
 
-    def renew_subscription(
+    async def deactivate_subscriptions(self, user_ids: List[int]) -> int:
+        """Деактивировать подписки пачки пользователей одним UPDATE. Возвращает число строк."""
+        if not user_ids:
+            return 0
+        async with self._session() as s:
+            result = await s.execute(
+                sa.text(
+                    """
+                    UPDATE subscriptions
+                    SET active = FALSE, updated_at = now()
+                    WHERE user_id = ANY(CAST(:uids AS BIGINT[])) AND active = TRUE
+                    """
+                ),
+                {"uids": list(user_ids)},
+            )
+            await self._notify_change(s, "subscription", user_ids)
+        self._invalidate(user_ids)
+        logger.info("Подписки деактивированы пачкой: %s пользователей", len(user_ids))
+        return result.rowcount
+
+    async def renew_subscription(
         self,
         user_id: int,
         expires_at: datetime,
@@ -360,8 +837,8 @@ class Database:
         Обновить сроки активной подписки пользователя.
         Использовать ТОЛЬКО после подтверждённой оплаты.
         """
-        with self.Session() as s, s.begin():
-            s.execute(
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
                     UPDATE subscriptions
@@ -380,9 +857,11 @@ class Database:
                     "anchor": anchor_inv_id,
                 },
             )
+            await self._notify_change(s, "subscription", [user_id])
+        self._invalidate([user_id])
         logger.info("Подписка обновлена для пользователя %s", user_id)
 
-    def update_charge_schedule(
+    async def update_charge_schedule(
         self,
         user_id: int,
         *,
@@ -393,8 +872,8 @@ class Database:
         Обновить только график списания, не меняя expires_at.
         Использовать для pending / повторных попыток recurring.
         """
-        with self.Session() as s, s.begin():
-            s.execute(
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
                     UPDATE subscriptions
@@ -410,16 +889,18 @@ class Database:
                     "anchor": anchor_inv_id,
                 },
             )
+            await self._notify_change(s, "subscription", [user_id])
+        self._invalidate([user_id])
         logger.info("График списания обновлён для пользователя %s", user_id)
 
-    def request_cancel_subscription(self, user_id: int) -> Optional[Dict[str, Any]]:
+    async def request_cancel_subscription(self, user_id: int) -> Optional[Dict[str, Any]]:
         """
         Пометить автоплатеж как отключённый, оставить доступ до конца оплаченного периода.
         Возвращает данные по подписке или None, если активной нет.
         """
-        with self.Session() as s, s.begin():
+        async with self._session() as s:
             row = (
-                s.execute(
+                await s.execute(
                     sa.text(
                         """
                         SELECT user_id, expires_at, cancel_requested
@@ -431,9 +912,7 @@ class Database:
                     ),
                     {"uid": user_id},
                 )
-                .mappings()
-                .first()
-            )
+            ).mappings().first()
 
             if not row:
                 return None
@@ -441,7 +920,7 @@ class Database:
             result = dict(row)
 
             if not row["cancel_requested"]:
-                s.execute(
+                await s.execute(
                     sa.text(
                         """
                         UPDATE subscriptions
@@ -454,9 +933,350 @@ class Database:
                     {"uid": user_id},
                 )
                 result["cancel_requested"] = True
+            await self._notify_change(s, "subscription", [user_id])
 
+        self._invalidate([user_id])
         return result
 
+    async def get_active_subscriber_ids(self, user_ids: List[int]) -> set:
+        """Кто из user_ids сейчас с действующей подпиской — одним запросом на всю пачку."""
+        if not user_ids:
+            return set()
+        async with self._session() as s:
+            rows = (
+                await s.execute(
+                    sa.text(
+                        """
+                        SELECT DISTINCT user_id
+                        FROM subscriptions
+                        WHERE user_id = ANY(CAST(:uids AS BIGINT[]))
+                          AND active = TRUE
+                          AND expires_at > now()
+                        """
+                    ),
+                    {"uids": list(user_ids)},
+                )
+            ).all()
+        return {r[0] for r in rows}
+
+    # -------------------
+    # Ретаргетинг
+    # -------------------
+    async def schedule_retargeting(self, user_id: int, steps: Dict[str, datetime]):
+        """Запланировать (или перепланировать) шаги ретаргетинга: {step: due_at}."""
+        async with self._session() as s:
+            await s.execute(
+                sa.text(
+                    """
+                    INSERT INTO retargeting_schedule (user_id, step, due_at)
+                    SELECT :uid, step, due_at
+                    FROM unnest(CAST(:steps AS TEXT[]), CAST(:due AS TIMESTAMPTZ[])) AS v(step, due_at)
+                    ON CONFLICT (user_id, step) DO UPDATE
+                    SET due_at = EXCLUDED.due_at,
+                        created_at = now()
+                    """
+                ),
+                {"uid": user_id, "steps": list(steps.keys()), "due": list(steps.values())},
+            )
+        logger.info("Запланирован ретаргетинг для пользователя %s", user_id)
+
+    async def cancel_retargeting(self, user_id: int):
+        """Снять весь запланированный ретаргетинг пользователя."""
+        async with self._session() as s:
+            await s.execute(
+                sa.text("DELETE FROM retargeting_schedule WHERE user_id = :uid"),
+                {"uid": user_id},
+            )
+        logger.info("Отменён ретаргетинг для пользователя %s", user_id)
+
+    async def claim_due_retargeting(self, limit: int = 200) -> List[Dict[str, Any]]:
+        """
+        Забрать (удалить и вернуть) до limit наступивших шагов ретаргетинга.
+        SKIP LOCKED: несколько воркеров не получат одну и ту же строку.
+        """
+        async with self._session() as s:
+            rows = (
+                await s.execute(
+                    sa.text(
+                        """
+                        DELETE FROM retargeting_schedule
+                        WHERE (user_id, step) IN (
+                            SELECT user_id, step
+                            FROM retargeting_schedule
+                            WHERE due_at <= now()
+                            ORDER BY due_at
+                            LIMIT :limit
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING user_id, step, due_at
+                        """
+                    ),
+                    {"limit": limit},
+                )
+            ).mappings().all()
+        return [dict(r) for r in rows]
+
+    # -------------------
+    # Отложенное удаление сообщений
+    # -------------------
+    async def schedule_message_deletion(self, chat_id: int, message_id: int, delete_at: datetime):
+        async with self._session() as s:
+            await s.execute(
+                sa.text(
+                    """
+                    INSERT INTO message_deletions (chat_id, message_id, delete_at)
+                    VALUES (:chat, :msg, :at)
+                    ON CONFLICT (chat_id, message_id) DO UPDATE
+                    SET delete_at = EXCLUDED.delete_at
+                    """
+                ),
+                {"chat": chat_id, "msg": message_id, "at": delete_at},
+            )
+
+    async def claim_due_message_deletions(self, limit: int = 1000) -> List[Dict[str, Any]]:
+        """Забрать (удалить и вернуть) до limit наступивших удалений, по порядку чатов."""
+        async with self._session() as s:
+            rows = (
+                await s.execute(
+                    sa.text(
+                        """
+                        DELETE FROM message_deletions
+                        WHERE (chat_id, message_id) IN (
+                            SELECT chat_id, message_id
+                            FROM message_deletions
+                            WHERE delete_at <= now()
+                            ORDER BY delete_at
+                            LIMIT :limit
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING chat_id, message_id
+                        """
+                    ),
+                    {"limit": limit},
+                )
+            ).mappings().all()
+        return [dict(r) for r in rows]
+
+    # -------------------
+    # Кэш картинок (Telegram file_id)
+    # -------------------
+    async def get_media_file_id(self, sha256: str) -> Optional[str]:
+        async with self._session() as s:
+            return await s.scalar(
+                sa.text("SELECT file_id FROM media_cache WHERE sha256 = :sha"),
+                {"sha": sha256},
+            )
+
+    async def save_media_file_id(self, sha256: str, file_id: str, file_name: Optional[str] = None):
+        async with self._session() as s:
+            await s.execute(
+                sa.text(
+                    """
+                    INSERT INTO media_cache (sha256, file_id, file_name)
+                    VALUES (:sha, :fid, :name)
+                    ON CONFLICT (sha256) DO UPDATE
+                    SET file_id = EXCLUDED.file_id,
+                        file_name = EXCLUDED.file_name,
+                        updated_at = now()
+                    """
+                ),
+                {"sha": sha256, "fid": file_id, "name": file_name},
+            )
+
+    async def delete_media_file_id(self, sha256: str):
+        async with self._session() as s:
+            await s.execute(
+                sa.text("DELETE FROM media_cache WHERE sha256 = :sha"),
+                {"sha": sha256},
+            )
+
+    # -------------------
+    # Шарды ежедневных job
+    # -------------------
+    async def start_job_run(self, job: str, run_key: str, shard_count: int) -> bool:
+        """
+        Начать запуск job: создать shard_count шардов для run_key.
+        Свободные шарды прошлых запусков того же job снимаются — новый запуск
+        покрывает всё заново; шарды в живой аренде дорабатывают свой запуск.
+        False, если запуск с этим run_key уже был (второй вызов за тот же день).
+        """
+        params = {"job": job, "run_key": run_key}
+        async with self._session() as s:
+            started = (
+                await s.execute(
+                    sa.text(
+                        """
+                        INSERT INTO job_runs (job, run_key, shard_count)
+                        VALUES (:job, :run_key, :shard_count)
+                        ON CONFLICT (job, run_key) DO NOTHING
+                        RETURNING 1
+                        """
+                    ),
+                    {**params, "shard_count": shard_count},
+                )
+            ).first()
+            if not started:
+                return False
+
+            await s.execute(
+                sa.text(
+                    """
+                    DELETE FROM job_shards
+                    WHERE job = :job AND run_key <> :run_key AND done_at IS NULL
+                      AND (lease_until IS NULL OR lease_until < now())
+                    """
+                ),
+                params,
+            )
+            # Прошлые запуски, у которых не осталось шардов в работе, больше не нужны
+            await s.execute(
+                sa.text(
+                    """
+                    WITH stale AS (
+                        DELETE FROM job_runs r
+                        WHERE r.job = :job AND r.run_key <> :run_key
+                          AND NOT EXISTS (
+                              SELECT 1 FROM job_shards
+                              WHERE job = r.job AND run_key = r.run_key AND done_at IS NULL
+                          )
+                        RETURNING r.run_key
+                    )
+                    DELETE FROM job_shards
+                    WHERE job = :job AND run_key IN (SELECT run_key FROM stale)
+                    """
+                ),
+                params,
+            )
+            await s.execute(
+                sa.text(
+                    """
+                    INSERT INTO job_shards (job, run_key, shard)
+                    SELECT :job, :run_key, g
+                    FROM generate_series(0, :shard_count - 1) AS g
+                    """
+                ),
+                {**params, "shard_count": shard_count},
+            )
+        return True
+
+    async def claim_job_shard(self, worker_id: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        """
+        Забрать свободный шард любого job: ещё не выполнен и не в аренде
+        (или аренда истекла — воркер упал). Параллельные воркеры не ждут
+        друг друга и не получают один шард дважды (SKIP LOCKED).
+        """
+        async with self._session() as s:
+            row = (
+                await s.execute(
+                    sa.text(
+                        """
+                        UPDATE job_shards js
+                        SET leased_by = :worker,
+                            lease_until = now() + make_interval(secs => :lease),
+                            attempts = js.attempts + 1
+                        FROM (
+                            SELECT job, run_key, shard
+                            FROM job_shards
+                            WHERE done_at IS NULL
+                              AND (lease_until IS NULL OR lease_until < now())
+                            ORDER BY job, shard
+                            LIMIT 1
+                            FOR UPDATE SKIP LOCKED
+                        ) c, job_runs r
+                        WHERE js.job = c.job AND js.run_key = c.run_key AND js.shard = c.shard
+                          AND r.job = js.job AND r.run_key = js.run_key
+                        RETURNING js.job, js.run_key, js.shard, js.attempts, r.shard_count
+                        """
+                    ),
+                    {"worker": worker_id, "lease": float(lease_seconds)},
+                )
+            ).mappings().first()
+        return dict(row) if row else None
+
+    async def renew_job_shard(self, job: str, run_key: str, shard: int, worker_id: str, lease_seconds: float) -> bool:
+        """Продлить аренду шарда. False — шард уже выполнен или его забрал другой воркер."""
+        async with self._session() as s:
+            row = (
+                await s.execute(
+                    sa.text(
+                        """
+                        UPDATE job_shards
+                        SET lease_until = now() + make_interval(secs => :lease)
+                        WHERE job = :job AND run_key = :run_key AND shard = :shard
+                          AND leased_by = :worker AND done_at IS NULL
+                        RETURNING 1
+                        """
+                    ),
+                    {"job": job, "run_key": run_key, "shard": shard, "worker": worker_id, "lease": float(lease_seconds)},
+                )
+            ).first()
+        return bool(row)
+
+    async def complete_job_shard(
+        self,
+        job: str,
+        run_key: str,
+        shard: int,
+        worker_id: str,
+        stats: Dict[str, Any],
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Отметить шард выполненным. Если это был последний шард запуска, запуск
+        закрывается и возвращается dict: stats (статистика всех шардов),
+        elapsed (сек с начала запуска). Иначе None.
+        Закрыть запуск может только один воркер: finished_at ставится условным UPDATE.
+        Если шард уже не в аренде у worker_id (аренда истекла и шард забрал другой
+        воркер, или его снял новый запуск), ничего не отмечаем и возвращаем None:
+        сводку отправит тот, кто выполнит шард.
+        """
+        params = {"job": job, "run_key": run_key}
+        async with self._session() as s:
+            completed = (
+                await s.execute(
+                    sa.text(
+                        """
+                        UPDATE job_shards
+                        SET done_at = now(), lease_until = NULL, stats = CAST(:stats AS JSONB)
+                        WHERE job = :job AND run_key = :run_key AND shard = :shard
+                          AND leased_by = :worker AND done_at IS NULL
+                        RETURNING 1
+                        """
+                    ),
+                    {**params, "shard": shard, "worker": worker_id, "stats": json.dumps(stats)},
+                )
+            ).first()
+        if not completed:
+            logger.warning("Job %s (%s): шард %s уже не в аренде у %s, результат не записан", job, run_key, shard, worker_id)
+            return None
+
+        # Отдельной транзакцией: после коммита своего шарда последний воркер
+        # обязательно увидит все шарды выполненными
+        async with self._session() as s:
+            elapsed = await s.scalar(
+                sa.text(
+                    """
+                    UPDATE job_runs
+                    SET finished_at = now()
+                    WHERE job = :job AND run_key = :run_key AND finished_at IS NULL
+                      AND NOT EXISTS (
+                          SELECT 1 FROM job_shards
+                          WHERE job = :job AND run_key = :run_key AND done_at IS NULL
+                      )
+                    RETURNING EXTRACT(EPOCH FROM now() - started_at)
+                    """
+                ),
+                params,
+            )
+            if elapsed is None:
+                return None
+            rows = (
+                await s.execute(
+                    sa.text("SELECT stats FROM job_shards WHERE job = :job AND run_key = :run_key ORDER BY shard"),
+                    params,
+                )
+            ).scalars().all()
+        return {"stats": [r or {} for r in rows], "elapsed": float(elapsed)}
+
     # -------------------
     # Платежи
     # -------------------
@@ -468,16 +1288,18 @@ class Database:
         match = re.search(r"(\d+)", invoice_payload)
         return int(match.group(1)) if match else None
 
-    def payment_exists(self, inv_id: int) -> bool:
+    async def payment_exists(self, inv_id: int) -> bool:
         """Проверить, есть ли уже платёж с этим inv_id."""
-        with self.Session() as s:
-            row = s.execute(
-                sa.text("SELECT 1 FROM payments WHERE inv_id = :inv LIMIT 1"),
-                {"inv": inv_id},
+        async with self._session() as s:
+            row = (
+                await s.execute(
+                    sa.text("SELECT 1 FROM payments WHERE inv_id = :inv LIMIT 1"),
+                    {"inv": inv_id},
+                )
             ).first()
             return bool(row)
 
-    def add_payment(
+    async def add_payment(
         self,
         user_id: int,
         amount: float,
@@ -490,25 +1312,183 @@ class Database:
         inv = inv_id or self._extract_inv_id(invoice_payload)
         raw_json = json.dumps(raw_payload or {"invoice_payload": invoice_payload})
 
-        with self.Session() as s, s.begin():
-            s.execute(
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
                     INSERT INTO payments (user_id, inv_id, amount, currency, status, raw_payload, created_at)
                     VALUES (:uid, :inv, :amt, :cur, 'paid', CAST(:rawp AS jsonb), now())
-                    ON CONFLICT (inv_id) DO NOTHING
+                    ON CONFLICT (inv_id) WHERE inv_id IS NOT NULL DO NOTHING
                     """
                 ),
                 {"uid": user_id, "inv": inv, "amt": amount, "cur": currency, "rawp": raw_json},
             )
         logger.info("Платёж записан: user=%s, inv_id=%s, amount=%s %s", user_id, inv, amount, currency)
 
+    async def apply_payment(
+        self,
+        *,
+        user_id: int,
+        inv_id: int,
+        amount: float,
+        period_days: int,
+        recurring_lead_days: int,
+        currency: str = "KZT",
+        raw_payload: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Применить подтверждённый платёж (Result URL) одной транзакцией.
+
+        1. INSERT платежа — claim идемпотентности: повтор того же inv_id
+           (в т.ч. параллельный, из другого воркера) ничего не меняет.
+        2. Upsert пользователя + SELECT ... FOR UPDATE активной подписки —
+           платежи одного пользователя применяются строго по очереди.
+        3. Продление от max(expires_at, now), сброс pending, либо новая подписка;
+           снятие запланированного ретаргетинга.
+
+        Возвращает dict: status ("duplicate" | "pending_confirmed" | "renewed" | "created"),
+        notify (нужно ли отправить пользователю ссылку), expires_at, next_charge_at.
+        """
+        raw_json = json.dumps(raw_payload or {"invoice_payload": f"robokassa_{inv_id}"})
+        now_dt = datetime.now(timezone.utc)
+
+        async with self._session() as s:
+            claimed = (
+                await s.execute(
+                    sa.text(
+                        """
+                        INSERT INTO payments (user_id, inv_id, amount, currency, status, raw_payload, created_at)
+                        VALUES (:uid, :inv, :amt, :cur, 'paid', CAST(:rawp AS jsonb), now())
+                        ON CONFLICT (inv_id) WHERE inv_id IS NOT NULL DO NOTHING
+                        RETURNING inv_id
+                        """
+                    ),
+                    {"uid": user_id, "inv": inv_id, "amt": amount, "cur": currency, "rawp": raw_json},
+                )
+            ).first()
+
+            if not claimed:
+                return {"status": "duplicate", "notify": False, "expires_at": None, "next_charge_at": None}
+
+            # Строка users служит замком для пользователя, у которого ещё нет подписки
+            await s.execute(
+                sa.text(
+                    """
+                    INSERT INTO users (user_id, username)
+                    VALUES (:uid, :uname)
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET updated_at = now()
+                    """
+                ),
+                {"uid": user_id, "uname": f"user_{user_id}"},
+            )
+
+            existing = (
+                await s.execute(
+                    sa.text(
+                        """
+                        SELECT expires_at, anchor_inv_id, pending_inv_id
+                        FROM subscriptions
+                        WHERE user_id = :uid AND active = TRUE
+                        ORDER BY expires_at DESC
+                        LIMIT 1
+                        FOR UPDATE
+                        """
+                    ),
+                    {"uid": user_id},
+                )
+            ).mappings().first()
+
+            # Продлеваем от max(expires_at, now)
+            base_dt = now_dt
+            if existing and existing["expires_at"]:
+                base_dt = max(_ensure_utc(existing["expires_at"]), now_dt)
+
+            new_expires_at = base_dt + timedelta(days=period_days)
+            new_next_charge_at = new_expires_at - timedelta(days=recurring_lead_days)
+
+            # Якорь: первый успешный inv_id фиксируем, дальше не меняем
+            anchor_inv_id = (existing["anchor_inv_id"] if existing else None) or inv_id
+
+            if existing:
+                pending_inv_id = existing["pending_inv_id"]
+                status = (
+                    "pending_confirmed"
+                    if pending_inv_id and int(pending_inv_id) == inv_id
+                    else "renewed"
+                )
+                # Висящий pending сбрасываем в любом случае: либо он подтверждён этим
+                # платежом, либо пользователь оплатил вручную.
+                await s.execute(
+                    sa.text(
+                        """
+                        UPDATE subscriptions
+                        SET expires_at = :exp,
+                            next_charge_at = :next_charge,
+                            anchor_inv_id = :anchor,
+                            pending_inv_id = NULL,
+                            pending_amount = NULL,
+                            pending_created_at = NULL,
+                            recurring_failure_count = 0,
+                            updated_at = now()
+                        WHERE user_id = :uid AND active = TRUE
+                        """
+                    ),
+                    {
+                        "uid": user_id,
+                        "exp": new_expires_at,
+                        "next_charge": new_next_charge_at,
+                        "anchor": anchor_inv_id,
+                    },
+                )
+            else:
+                status = "created"
+                await s.execute(
+                    sa.text(
+                        """
+                        INSERT INTO subscriptions (
+                            user_id, expires_at, active, created_at, updated_at,
+                            anchor_inv_id, next_charge_at, cancel_requested, recurring_failure_count
+                        )
+                        VALUES (:uid, :exp, TRUE, now(), now(), :anchor, :next_charge, FALSE, 0)
+                        """
+                    ),
+                    {
+                        "uid": user_id,
+                        "exp": new_expires_at,
+                        "next_charge": new_next_charge_at,
+                        "anchor": anchor_inv_id,
+                    },
+                )
+
+            # Оплатил — напоминания больше не нужны
+            await s.execute(
+                sa.text("DELETE FROM retargeting_schedule WHERE user_id = :uid"),
+                {"uid": user_id},
+            )
+            await self._notify_change(s, "payment", [user_id])
+
+        self._invalidate([user_id])
+        logger.info(
+            "Платёж применён: user=%s inv_id=%s status=%s new_expires_at=%s",
+            user_id,
+            inv_id,
+            status,
+            new_expires_at,
+        )
+        return {
+            "status": status,
+            "notify": True,
+            "expires_at": new_expires_at,
+            "next_charge_at": new_next_charge_at,
+        }
+
     # -------------------
     # Pending recurring
     # -------------------
-    def set_pending_charge(self, user_id: int, pending_inv_id: int, amount: float, created_at: datetime):
-        with self.Session() as s, s.begin():
-            s.execute(
+    async def set_pending_charge(self, user_id: int, pending_inv_id: int, amount: float, created_at: datetime):
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
                     UPDATE subscriptions
@@ -521,11 +1501,13 @@ class Database:
                 ),
                 {"pinv": pending_inv_id, "amt": amount, "pcreated": created_at, "uid": user_id},
             )
+            await self._notify_change(s, "subscription", [user_id])
+        self._invalidate([user_id])
         logger.info("Pending charge set: user=%s inv=%s", user_id, pending_inv_id)
 
-    def clear_pending_charge(self, user_id: int):
-        with self.Session() as s, s.begin():
-            s.execute(
+    async def clear_pending_charge(self, user_id: int):
+        async with self._session() as s:
+            await s.execute(
                 sa.text(
                     """
                     UPDATE subscriptions
@@ -538,13 +1520,15 @@ class Database:
                 ),
                 {"uid": user_id},
             )
+            await self._notify_change(s, "subscription", [user_id])
+        self._invalidate([user_id])
         logger.info("Pending charge cleared: user=%s", user_id)
 
-    def increment_recurring_failures(self, user_id: int) -> int:
+    async def increment_recurring_failures(self, user_id: int) -> int:
         """Увеличить счётчик подряд неудачных автосписаний и вернуть новое значение."""
-        with self.Session() as s, s.begin():
+        async with self._session() as s:
             row = (
-                s.execute(
+                await s.execute(
                     sa.text(
                         """
                         UPDATE subscriptions
@@ -556,25 +1540,128 @@ class Database:
                     ),
                     {"uid": user_id},
                 )
-                .mappings()
-                .first()
-            )
+            ).mappings().first()
+            await self._notify_change(s, "subscription", [user_id])
+        self._invalidate([user_id])
         return int((row or {}).get("recurring_failure_count") or 0)
 
+    # Пакетные варианты для ночного job автосписаний: один запрос на всю пачку
+    async def claim_pending_charges(
+        self,
+        user_ids: List[int],
+        amount: float,
+        created_at: datetime,
+    ) -> Dict[int, int]:
+        """
+        Записать pending до запросов к Robokassa одним условным UPDATE; InvId берётся
+        из recurring_inv_id_seq. Подписки, у которых pending уже стоит (повторный запуск
+        шарда, другой воркер), не забираются. Возвращает {user_id: pending_inv_id}
+        забранных — списывать только их.
+        """
+        if not user_ids:
+            return {}
+        async with self._session() as s:
+            rows = (
+                await s.execute(
+                    sa.text(
+                        """
+                        UPDATE subscriptions
+                        SET pending_inv_id = nextval('recurring_inv_id_seq'),
+                            pending_amount = :amt,
+                            pending_created_at = :pcreated,
+                            updated_at = now()
+                        WHERE user_id = ANY(CAST(:uids AS BIGINT[])) AND active = TRUE AND pending_inv_id IS NULL
+                        RETURNING user_id, pending_inv_id
+                        """
+                    ),
+                    {"uids": list(user_ids), "amt": amount, "pcreated": created_at},
+                )
+            ).all()
+            claimed = {user_id: int(inv_id) for user_id, inv_id in rows}
+            if claimed:
+                await self._notify_change(s, "subscription", list(claimed))
+        self._invalidate(claimed)
+        return claimed
+
+    async def increment_recurring_failures_many(self, user_ids: List[int]) -> Dict[int, int]:
+        """Пакетный increment_recurring_failures. Возвращает {user_id: новое значение}."""
+        if not user_ids:
+            return {}
+        async with self._session() as s:
+            rows = (
+                await s.execute(
+                    sa.text(
+                        """
+                        UPDATE subscriptions
+                        SET recurring_failure_count = COALESCE(recurring_failure_count, 0) + 1,
+                            updated_at = now()
+                        WHERE user_id = ANY(CAST(:uids AS BIGINT[])) AND active = TRUE
+                        RETURNING user_id, recurring_failure_count
+                        """
+                    ),
+                    {"uids": list(user_ids)},
+                )
+            ).mappings().all()
+            await self._notify_change(s, "subscription", user_ids)
+        self._invalidate(user_ids)
+        return {r["user_id"]: int(r["recurring_failure_count"] or 0) for r in rows}
+
+    async def update_charge_schedules(self, user_ids: List[int], *, next_charge_at: datetime):
+        """Пакетный update_charge_schedule с одинаковым next_charge_at."""
+        if not user_ids:
+            return
+        async with self._session() as s:
+            await s.execute(
+                sa.text(
+                    """
+                    UPDATE subscriptions
+                    SET next_charge_at = :next_charge,
+                        updated_at = now()
+                    WHERE user_id = ANY(CAST(:uids AS BIGINT[])) AND active = TRUE
+                    """
+                ),
+                {"uids": list(user_ids), "next_charge": next_charge_at},
+            )
+            await self._notify_change(s, "subscription", user_ids)
+        self._invalidate(user_ids)
+        logger.info("График списания обновлён: %s пользователей", len(user_ids))
+
+    async def clear_pending_charges(self, user_ids: List[int]):
+        """Пакетный clear_pending_charge."""
+        if not user_ids:
+            return
+        async with self._session() as s:
+            await s.execute(
+                sa.text(
+                    """
+                    UPDATE subscriptions
+                    SET pending_inv_id = NULL,
+                        pending_amount = NULL,
+                        pending_created_at = NULL,
+                        updated_at = now()
+                    WHERE user_id = ANY(CAST(:uids AS BIGINT[])) AND active = TRUE
+                    """
+                ),
+                {"uids": list(user_ids)},
+            )
+            await self._notify_change(s, "subscription", user_ids)
+        self._invalidate(user_ids)
+        logger.info("Pending charges cleared: %s пользователей", len(user_ids))
+
     # -------------------
     # Статистика
     # -------------------
-    def get_statistics(self) -> Dict[str, Any]:
+    async def get_statistics(self) -> Dict[str, Any]:
         """Агрегированные числа по пользователям/подпискам/платежам."""
-        with self.Session() as s:
-            total_users = s.execute(sa.text("SELECT count(*) FROM users")).scalar() or 0
-            active_subs = s.execute(
+        async with self._session() as s:
+            total_users = await s.scalar(sa.text("SELECT count(*) FROM users")) or 0
+            active_subs = await s.scalar(
                 sa.text("SELECT count(*) FROM subscriptions WHERE active = TRUE AND expires_at > now()")
-            ).scalar() or 0
-            expired_subs = s.execute(
+            ) or 0
+            expired_subs = await s.scalar(
                 sa.text("SELECT count(*) FROM subscriptions WHERE active = TRUE AND expires_at <= now()")
-            ).scalar() or 0
-            total_payments = s.execute(sa.text("SELECT count(*) FROM payments")).scalar() or 0
+            ) or 0
+            total_payments = await s.scalar(sa.text("SELECT count(*) FROM payments")) or 0
 
         return {
             "total_users": total_users,
@@ -583,16 +1670,50 @@ class Database:
             "total_payments": total_payments,
         }
 
-    def get_funnel_statistics(self) -> Dict[str, int]:
+    async def get_funnel_statistics(self) -> Dict[str, int]:
         """Количество пользователей по состояниям воронки (поле state в users)."""
-        with self.Session() as s:
+        async with self._session() as s:
             rows = (
-                s.execute(sa.text("SELECT state, count(*) AS c FROM users GROUP BY state"))
-                .mappings()
-                .all()
-            )
+                await s.execute(sa.text("SELECT state, count(*) AS c FROM users GROUP BY state"))
+            ).mappings().all()
         return {r["state"]: r["c"] for r in rows if r["state"] is not None}
 
+    async def close(self):
+        """Дописать буфер состояний и закрыть пул соединений."""
+        await self.stop_user_state_buffer()
+        await self.engine.dispose()
+
+# Время и ошибки каждого публичного метода — в метриках (korkut_db_seconds{method})
+instrument_methods(Database)
+
+
+class SyncDatabase:
+    """
+    Синхронная обёртка над Database для скриптов вне event loop
+    (kick_user.py, разовые выгрузки и т.п.).
+    Каждый вызов выполняется на собственном event loop обёртки.
+    Внутри async-кода (бот, вебхук) использовать Database напрямую.
+    """
+
+    def __init__(self, db_url: str):
+        self._loop = asyncio.new_event_loop()
+        self._db = Database(db_url)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._db, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._loop.run_until_complete(attr(*args, **kwargs))
+
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        return call
+
     def close(self):
-        """Закрыть соединение."""
-        self.engine.dispose()
\ No newline at end of file
+        """Закрыть пул соединений и event loop обёртки."""
+        try:
+            self._loop.run_until_complete(self._db.close())
+        finally:
+            self._loop.close()
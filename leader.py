@@ -0,0 +1,146 @@
+"""
+Выбор лидера между репликами бота через Postgres advisory lock.
+
+Каждая реплика держит отдельное autocommit-соединение и раз в renew_interval
+пытается взять pg_try_advisory_lock(LEADER_LOCK_KEY). Блокировка сессионная:
+её держит тот, у кого живо соединение, поэтому лидер «продлевает аренду»,
+проверяя соединение тем же интервалом. Не удалось подтвердить — реплика сразу
+перестаёт считать себя лидером; упавший процесс теряет блокировку вместе
+с соединением, и её забирает следующая реплика.
+
+Плановые задачи, которые должны выполняться ровно одной репликой
+(ежедневная проверка подписок, автосписания), регистрируются через
+leader_only(callback): на остальных репликах запуск пропускается.
+"""
+
+import asyncio
+import functools
+import logging
+from typing import Awaitable, Callable, Optional
+
+import psycopg
+
+from change_feed import to_psycopg_conninfo
+
+logger = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock лидера (произвольная константа, общая для всех реплик)
+LEADER_LOCK_KEY = 7_201_104_002
+
+# Сервер проверяет TCP-соединение лидера сам: если реплика пропала из сети,
+# Postgres закроет её сессию (и снимет блокировку) примерно через
+# idle + interval * count секунд, а не через системные ~2 часа.
+# К этому моменту сама реплика уже сложила полномочия (ping не прошёл).
+_SERVER_KEEPALIVE_OPTIONS = "-c tcp_keepalives_idle=10 -c tcp_keepalives_interval=5 -c tcp_keepalives_count=3"
+
+
+class LeaderElection:
+    def __init__(
+        self,
+        db_url: str,
+        *,
+        lock_key: int = LEADER_LOCK_KEY,
+        renew_interval: float = 5.0,
+        reconnect_delay: float = 5.0,
+    ):
+        self.conninfo = to_psycopg_conninfo(db_url)
+        self.lock_key = lock_key
+        self.renew_interval = renew_interval
+        self.reconnect_delay = reconnect_delay
+        self._conn: Optional[psycopg.AsyncConnection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._is_leader = False
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка: соединение закрывается, блокировка достаётся другой реплике."""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _set_leader(self, value: bool):
+        if value != self._is_leader:
+            self._is_leader = value
+            if value:
+                logger.info("Эта реплика стала лидером (advisory lock %s)", self.lock_key)
+            else:
+                logger.warning("Эта реплика больше не лидер (advisory lock %s)", self.lock_key)
+
+    async def _query(self, conn: psycopg.AsyncConnection, query: str, *params):
+        # Зависший запрос не должен продлевать аренду дольше одного интервала
+        cur = await asyncio.wait_for(conn.execute(query, params or None), self.renew_interval)
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def _run(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    self.conninfo,
+                    autocommit=True,
+                    connect_timeout=max(int(self.renew_interval), 2),
+                    options=_SERVER_KEEPALIVE_OPTIONS,
+                ) as conn:
+                    self._conn = conn
+                    while True:
+                        if self._is_leader:
+                            # Соединение живо — сессионная блокировка по-прежнему наша
+                            await self._query(conn, "SELECT 1")
+                        elif await self._query(conn, "SELECT pg_try_advisory_lock(%s)", self.lock_key):
+                            self._set_leader(True)
+                        await asyncio.sleep(self.renew_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(
+                    "Соединение выбора лидера прервалось: %s, переподключение через %.0f сек",
+                    e,
+                    self.reconnect_delay,
+                )
+            finally:
+                self._conn = None
+                self._set_leader(False)
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def confirm(self) -> bool:
+        """
+        Проверить лидерство прямо сейчас (перед запуском задачи),
+        а не полагаться на результат последнего продления.
+        """
+        conn = self._conn
+        if not self._is_leader or conn is None:
+            return False
+        try:
+            await self._query(conn, "SELECT 1")
+        except Exception as e:
+            logger.warning("Не удалось подтвердить лидерство: %s", e)
+            self._set_leader(False)
+            return False
+        return True
+
+    def leader_only(self, callback: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        """
+        Обёртка job-callback: выполнять только на реплике-лидере.
+        Если в момент запуска лидера нет (идёт переизбрание), запуск пропускается;
+        ежедневные задачи выбирают всё просроченное, так что следующий запуск догонит.
+        """
+
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            if not await self.confirm():
+                logger.info("Задача %s пропущена: эта реплика не лидер", callback.__name__)
+                return None
+            return await callback(*args, **kwargs)
+
+        return wrapper
@@ -0,0 +1,100 @@
+"""
+Кэш Telegram file_id для картинок воронки.
+
+Файл загружается в Telegram один раз, полученный file_id сохраняется в БД
+по sha256 содержимого и дальше отправляется вместо повторной загрузки.
+Изменился файл на диске — изменился хэш, картинка загрузится заново.
+"""
+
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Ответы Telegram на file_id, который больше не годится: только тогда
+# его забываем и грузим файл заново; остальные BadRequest — ошибки самого запроса
+_STALE_FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+    "file_reference_expired",
+    "invalid file_id",
+    "wrong padding",
+    "can't use file of type",
+)
+
+
+def _is_stale_file_id(error: BadRequest) -> bool:
+    message = error.message.lower()
+    return any(marker in message for marker in _STALE_FILE_ID_ERRORS)
+
+
+class MediaCache:
+    def __init__(self, db):
+        self.db = db
+        # sha256 -> file_id (зеркало таблицы media_cache в памяти)
+        self._file_ids: Dict[str, str] = {}
+        # путь -> ((mtime_ns, size), sha256): не перечитывать файл на каждый /start
+        self._hashes: Dict[Path, Tuple[Tuple[int, int], str]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _file_hash(self, path: Path) -> str:
+        st = path.stat()
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        self._hashes[path] = (key, digest)
+        return digest
+
+    async def _get_file_id(self, digest: str) -> Optional[str]:
+        file_id = self._file_ids.get(digest)
+        if file_id is None:
+            file_id = await self.db.get_media_file_id(digest)
+            if file_id is not None:
+                self._file_ids[digest] = file_id
+        return file_id
+
+    async def _forget(self, digest: str):
+        self._file_ids.pop(digest, None)
+        await self.db.delete_media_file_id(digest)
+
+    async def reply_photo(self, message_obj, path: Path, **kwargs):
+        """
+        message_obj.reply_photo с картинкой из path: по file_id, если он уже есть,
+        иначе загрузка файла и сохранение file_id.
+        """
+        digest = self._file_hash(path)
+
+        file_id = await self._get_file_id(digest)
+        if file_id is not None:
+            try:
+                return await message_obj.reply_photo(photo=file_id, **kwargs)
+            except BadRequest as e:
+                if not _is_stale_file_id(e):
+                    raise
+                logger.warning("file_id для %s больше не принимается (%s), загружаем заново", path.name, e)
+                await self._forget(digest)
+
+        # Первая загрузка — под замком, чтобы параллельные /start не грузили файл каждый сам
+        lock = self._locks.setdefault(digest, asyncio.Lock())
+        async with lock:
+            file_id = self._file_ids.get(digest)
+            if file_id is not None:
+                return await message_obj.reply_photo(photo=file_id, **kwargs)
+
+            with path.open("rb") as photo:
+                sent = await message_obj.reply_photo(photo=photo, **kwargs)
+
+            if sent and sent.photo:
+                file_id = sent.photo[-1].file_id
+                self._file_ids[digest] = file_id
+                await self.db.save_media_file_id(digest, file_id, path.name)
+                logger.info("Картинка %s загружена в Telegram, file_id сохранён", path.name)
+            return sent
@@ -0,0 +1,311 @@
+"""
+Метрики процесса в текстовом формате Prometheus.
+
+Свой небольшой реестр вместо prometheus_client: счётчики и гистограммы
+с метками, всё в памяти процесса (бот и вебхук — каждый свой реестр).
+Отдаются:
+- вебхуком: GET /metrics (webhook.py);
+- ботом в режиме polling: отдельный HTTP-слушатель на METRICS_PORT (start_http_server).
+
+Что меряем (имена с префиксом korkut_):
+- handler_seconds{handler} — хендлеры PTB (instrument_handler);
+- db_seconds{method} — методы Database (instrument_methods);
+- telegram_request_seconds{method}, telegram_rate_limit_wait_seconds — вызовы Bot API (SendScheduler);
+- recurring_request_seconds, recurring_requests_total{result} — Robokassa Recurring;
+- job_seconds{job}, job_items_total{job,kind} — ежедневные и фоновые job;
+- http_request_seconds{route,method,status} — маршруты FastAPI.
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "korkut_"
+
+# Границы гистограмм (сек): быстрые операции и длинные job
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """Текущее значение, которое считается в момент выдачи (callback без аргументов)."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], float]):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def _samples(self) -> List[str]:
+        try:
+            value = float(self.callback())
+        except Exception:
+            return []
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # метки -> [счётчики по корзинам (не накопленные), сумма, количество]
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        # Повторная регистрация (перезагрузка модуля, второй Application) — та же метрика
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name: str, help_text: str, callback: Callable[[], float]) -> Gauge:
+        # Gauge заменяется: callback обычно ссылается на объекты текущего процесса
+        metric = Gauge(name, help_text, callback)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram("handler_seconds", "Время обработки хендлером PTB", ["handler"])
+HANDLER_ERRORS = REGISTRY.counter("handler_errors_total", "Исключения в хендлерах PTB", ["handler"])
+DB_SECONDS = REGISTRY.histogram("db_seconds", "Время выполнения методов Database", ["method"])
+DB_ERRORS = REGISTRY.counter("db_errors_total", "Исключения в методах Database", ["method"])
+TELEGRAM_SECONDS = REGISTRY.histogram(
+    "telegram_request_seconds", "Время запроса к Bot API (без ожидания лимитов)", ["method"]
+)
+TELEGRAM_WAIT_SECONDS = REGISTRY.histogram(
+    "telegram_rate_limit_wait_seconds", "Ожидание запроса в очереди SendScheduler", ["method"]
+)
+TELEGRAM_ERRORS = REGISTRY.counter("telegram_errors_total", "Ошибки запросов к Bot API", ["method", "error"])
+RECURRING_SECONDS = REGISTRY.histogram("recurring_request_seconds", "Запрос к Robokassa Recurring")
+RECURRING_REQUESTS = REGISTRY.counter("recurring_requests_total", "Запросы к Robokassa Recurring", ["result"])
+JOB_SECONDS = REGISTRY.histogram("job_seconds", "Длительность job и шардов job", ["job"], buckets=JOB_BUCKETS)
+JOB_ITEMS = REGISTRY.counter("job_items_total", "Обработано job (по видам: kicked, created, failed…)", ["job", "kind"])
+JOB_ERRORS = REGISTRY.counter("job_errors_total", "Исключения в job", ["job"])
+HTTP_SECONDS = REGISTRY.histogram(
+    "http_request_seconds", "Обработка HTTP-запроса FastAPI", ["route", "method", "status"]
+)
+
+
+def instrument_handler(callback: Callable[..., Awaitable], name: Optional[str] = None) -> Callable[..., Awaitable]:
+    """Обёртка callback хендлера PTB: время и исключения по имени хендлера."""
+    handler_name = name or getattr(callback, "__name__", "handler")
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=handler_name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=handler_name)
+
+    return wrapper
+
+
+def instrument_job(callback: Callable[..., Awaitable], name: Optional[str] = None) -> Callable[..., Awaitable]:
+    """Обёртка callback job: длительность и исключения по имени job."""
+    job_name = name or getattr(callback, "__name__", "job")
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            JOB_ERRORS.inc(job=job_name)
+            raise
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - started, job=job_name)
+
+    return wrapper
+
+
+def instrument_methods(cls: type, histogram: Histogram = DB_SECONDS, errors: Counter = DB_ERRORS) -> type:
+    """
+    Обернуть публичные async-методы класса (не генераторы и не контекст-менеджеры):
+    время и исключения по имени метода. Используется для Database.
+    """
+    for attr_name, attr in list(vars(cls).items()):
+        if attr_name.startswith("_") or not inspect.iscoroutinefunction(attr):
+            continue
+        setattr(cls, attr_name, _timed_method(attr, attr_name, histogram, errors))
+    return cls
+
+
+def _timed_method(method, name: str, histogram: Histogram, errors: Counter):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            errors.inc(method=name)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started, method=name)
+
+    return wrapper
+
+
+# -------------------
+# HTTP-слушатель для процесса бота
+# -------------------
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, content_type, body = "200 OK", CONTENT_TYPE, REGISTRY.render().encode()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug("Ошибка запроса метрик: %s", e)
+    finally:
+        writer.close()
+
+
+async def start_http_server(host: str, port: int) -> asyncio.AbstractServer:
+    """GET /metrics на host:port (для процесса бота; вебхук отдаёт метрики сам)."""
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info("📈 Метрики: http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,346 @@
+"""
+Версионированные миграции схемы.
+
+Применённые версии записываются в schema_version. Старт процесса — одна проверка
+версии; если схема отстаёт, миграции применяет ровно один процесс под
+advisory lock, остальные ждут его и видят уже готовую схему.
+
+Обычные миграции идут одной транзакцией вместе с записью версии.
+Индексы на рабочих таблицах строятся CREATE INDEX CONCURRENTLY
+(вне транзакции, без блокировки записи) — по одному индексу на миграцию.
+
+Запуск вручную (например, перед деплоем):
+    python migrations.py
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, List
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock для миграций (произвольная константа, общая для всех процессов)
+MIGRATIONS_LOCK_KEY = 7_201_104_001
+
+# Сколько ждать блокировку таблицы в транзакционной миграции, прежде чем сдаться:
+# лучше упасть и перезапуститься, чем держать очередь из рабочих запросов
+MIGRATION_LOCK_TIMEOUT = "10s"
+
+MIGRATIONS: List[Dict[str, Any]] = [
+    {
+        "version": 1,
+        "name": "subscriptions: колонки отмены и автоплатежа",
+        "statements": [
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS cancel_requested BOOLEAN DEFAULT FALSE",
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS cancel_requested_at TIMESTAMP",
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS anchor_inv_id BIGINT",
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS next_charge_at TIMESTAMP",
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS pending_inv_id BIGINT",
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS pending_amount NUMERIC",
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS pending_created_at TIMESTAMP",
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS recurring_failure_count INTEGER DEFAULT 0",
+        ],
+    },
+    {
+        "version": 2,
+        "name": "payments: уникальный inv_id",
+        "index": "ux_payments_inv_id",
+        "statements": [
+            """
+            CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ux_payments_inv_id
+            ON payments (inv_id)
+            WHERE inv_id IS NOT NULL
+            """,
+        ],
+    },
+    {
+        # Частичный индекс под get_due_recurring_charges: предикат совпадает
+        # с WHERE запроса, поэтому ночной job не читает всю таблицу
+        "version": 3,
+        "name": "subscriptions: индекс подписок к автосписанию",
+        "index": "ix_subscriptions_due_charges",
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subscriptions_due_charges
+            ON subscriptions (expires_at)
+            WHERE active = TRUE
+              AND COALESCE(cancel_requested, FALSE) = FALSE
+              AND anchor_inv_id IS NOT NULL
+              AND pending_inv_id IS NULL
+            """,
+        ],
+    },
+    {
+        "version": 4,
+        "name": "retargeting_schedule: очередь ретаргетинга",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS retargeting_schedule (
+                user_id BIGINT NOT NULL,
+                step TEXT NOT NULL,
+                due_at TIMESTAMPTZ NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (user_id, step)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_retargeting_schedule_due_at ON retargeting_schedule (due_at)",
+        ],
+    },
+    {
+        "version": 5,
+        "name": "message_deletions: очередь удаления сообщений",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS message_deletions (
+                chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                delete_at TIMESTAMPTZ NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_message_deletions_delete_at ON message_deletions (delete_at)",
+        ],
+    },
+    {
+        "version": 6,
+        "name": "media_cache: file_id картинок",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS media_cache (
+                sha256 TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                file_name TEXT,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """,
+        ],
+    },
+    {
+        # get_subscription, FOR UPDATE в apply_payment, пакетные UPDATE по user_id
+        # и keyset-пагинация ежедневных job
+        "version": 7,
+        "name": "subscriptions: активные по user_id",
+        "index": "ix_subscriptions_active_user",
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subscriptions_active_user
+            ON subscriptions (user_id, expires_at DESC)
+            WHERE active = TRUE
+            """,
+        ],
+    },
+    {
+        # Ежедневная проверка истёкших подписок и статистика активных
+        "version": 8,
+        "name": "subscriptions: активные по expires_at",
+        "index": "ix_subscriptions_active_expires_at",
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subscriptions_active_expires_at
+            ON subscriptions (expires_at)
+            WHERE active = TRUE
+            """,
+        ],
+    },
+    {
+        "version": 9,
+        "name": "subscriptions: активные по next_charge_at",
+        "index": "ix_subscriptions_active_next_charge_at",
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subscriptions_active_next_charge_at
+            ON subscriptions (next_charge_at)
+            WHERE active = TRUE
+            """,
+        ],
+    },
+    {
+        "version": 10,
+        "name": "payments: платежи пользователя",
+        "index": "ix_payments_user_id",
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_payments_user_id
+            ON payments (user_id, created_at DESC)
+            """,
+        ],
+    },
+    {
+        # Запуски ежедневных job, разбитых на шарды по хэшу user_id:
+        # шард забирают воркеры любых реплик, аренда истекает — шард подхватит другой
+        "version": 11,
+        "name": "job_runs, job_shards: шардированные ежедневные job",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS job_runs (
+                job TEXT NOT NULL,
+                run_key TEXT NOT NULL,
+                shard_count INTEGER NOT NULL,
+                started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                finished_at TIMESTAMPTZ,
+                PRIMARY KEY (job, run_key)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS job_shards (
+                job TEXT NOT NULL,
+                run_key TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                leased_by TEXT,
+                lease_until TIMESTAMPTZ,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                done_at TIMESTAMPTZ,
+                stats JSONB,
+                PRIMARY KEY (job, run_key, shard)
+            )
+            """,
+        ],
+    },
+    {
+        # Когда записано состояние воронки (часы бота): его трогают только записи
+        # состояния, поэтому пачка буфера не перетирает более новое состояние
+        # из-за updated_at от платежей и подписок
+        "version": 12,
+        "name": "users: state_updated_at",
+        "statements": [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS state_updated_at TIMESTAMPTZ",
+        ],
+    },
+    {
+        # InvId автосписаний: 1..999999999 (bot.RECURRING_INV_ID_MAX), ручные оплаты
+        # берут InvId выше — номера не пересекаются ни между шардами, ни с оплатами
+        "version": 13,
+        "name": "recurring_inv_id_seq: InvId автосписаний",
+        "statements": [
+            """
+            CREATE SEQUENCE IF NOT EXISTS recurring_inv_id_seq
+            AS BIGINT MINVALUE 1 MAXVALUE 999999999 CYCLE
+            """,
+        ],
+    },
+]
+
+LATEST_VERSION = MIGRATIONS[-1]["version"]
+
+
+async def get_schema_version(conn: AsyncConnection) -> int:
+    """Текущая версия схемы (0, если миграции ещё не применялись)."""
+    exists = await conn.scalar(sa.text("SELECT to_regclass('schema_version') IS NOT NULL"))
+    if not exists:
+        return 0
+    return await conn.scalar(sa.text("SELECT COALESCE(MAX(version), 0) FROM schema_version"))
+
+
+async def migrate(engine: AsyncEngine) -> int:
+    """Довести схему до LATEST_VERSION. Возвращает итоговую версию."""
+    async with engine.connect() as conn:
+        version = await get_schema_version(conn)
+    if version >= LATEST_VERSION:
+        return version
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await _acquire_lock(conn)
+        try:
+            await conn.execute(
+                sa.text(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                    """
+                )
+            )
+            # Пока ждали блокировку, миграции мог применить другой процесс
+            version = await get_schema_version(conn)
+            applied = 0
+            for migration in MIGRATIONS:
+                if migration["version"] <= version:
+                    continue
+                logger.info("Миграция %s: %s", migration["version"], migration["name"])
+                if "index" in migration:
+                    await _apply_concurrent(conn, migration)
+                else:
+                    await _apply_transactional(engine, migration)
+                version = migration["version"]
+                applied += 1
+        finally:
+            await conn.execute(sa.text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+
+    if applied:
+        logger.info("Схема БД обновлена до версии %s (миграций: %s)", version, applied)
+    return version
+
+
+async def _acquire_lock(conn: AsyncConnection, poll_interval: float = 1.0):
+    """
+    Ждём advisory lock опросом, а не блокирующим pg_advisory_lock:
+    CREATE INDEX CONCURRENTLY ждёт завершения чужих запросов со снимком,
+    и висящий в pg_advisory_lock процесс дал бы с ним взаимную блокировку.
+    """
+    while not await conn.scalar(sa.text("SELECT pg_try_advisory_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY}):
+        logger.info("Миграции применяет другой процесс, ждём...")
+        await asyncio.sleep(poll_interval)
+
+
+async def _record_version(conn: AsyncConnection, migration: Dict[str, Any]):
+    await conn.execute(
+        sa.text("INSERT INTO schema_version (version, name) VALUES (:v, :n) ON CONFLICT (version) DO NOTHING"),
+        {"v": migration["version"], "n": migration["name"]},
+    )
+
+
+async def _apply_transactional(engine: AsyncEngine, migration: Dict[str, Any]):
+    async with engine.begin() as tx:
+        await tx.execute(sa.text(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+        for statement in migration["statements"]:
+            await tx.execute(sa.text(statement))
+        await _record_version(tx, migration)
+
+
+async def _apply_concurrent(conn: AsyncConnection, migration: Dict[str, Any]):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс,
+    # который IF NOT EXISTS молча пропустил бы — удаляем его и строим заново
+    invalid = await conn.scalar(
+        sa.text(
+            """
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name AND NOT i.indisvalid
+            """
+        ),
+        {"name": migration["index"]},
+    )
+    if invalid:
+        logger.warning("Индекс %s невалиден после прерванной сборки, пересоздаём", migration["index"])
+        await conn.execute(sa.text(f'DROP INDEX CONCURRENTLY IF EXISTS "{migration["index"]}"'))
+
+    for statement in migration["statements"]:
+        await conn.execute(sa.text(statement))
+    await _record_version(conn, migration)
+
+
+async def _main():
+    from config import DATABASE_URL
+    from database import Database
+
+    db = Database(DATABASE_URL)
+    try:
+        version = await migrate(db.engine)
+        print(f"Схема БД: версия {version}")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    asyncio.run(_main())
@@ -0,0 +1,185 @@
+"""
+Профилирование работающего бота по команде админа (/profile), без передеплоя.
+
+На время окна:
+- поток-сэмплер раз в sample_interval снимает стек потока event loop
+  (sys._current_frames) и копит их в формате collapsed stacks
+  («main;run;handler 42») — файл открывается flamegraph.pl и speedscope.
+  Стек, который заканчивается в selectors.select, — цикл простаивает;
+  всё остальное — синхронная работа, которая держит цикл;
+- хендлеры и job, обёрнутые track(), дольше slow_seconds попадают в отчёт
+  с профилем cProfile. cProfile в потоке может быть только один, поэтому
+  профилируется один вызов за раз, и его профиль включает другие задачи цикла,
+  которые выполнялись, пока вызов ждал await (остальные медленные вызовы
+  попадают в отчёт только со временем).
+
+Вне окна track() стоит одной проверки, сэмплер не запущен.
+"""
+
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter as _Counter
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько медленных вызовов держать в отчёте (самые долгие)
+MAX_SLOW_CALLS = 20
+# Сколько строк профиля cProfile на вызов
+PROFILE_LINES = 25
+# Глубина стека сэмпла (от вершины)
+MAX_STACK_DEPTH = 100
+
+# Настройки (configure)
+_slow_seconds = 1.0
+_sample_interval = 0.01
+
+
+class _Window:
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.thread_id = threading.get_ident()
+        self.stacks: _Counter = _Counter()
+        self.samples = 0
+        # name, elapsed, at, текст профиля или None
+        self.slow: List[Dict[str, Any]] = []
+        self.profiling = False
+        self.done = asyncio.Event()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="korkut-profiler", daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(_sample_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})".replace(";", ":"))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def add_slow(self, name: str, elapsed: float, profile: Optional[cProfile.Profile]):
+        text = None
+        if profile is not None:
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            text = stream.getvalue()
+        self.slow.append({"name": name, "elapsed": elapsed, "at": datetime.now(), "profile": text})
+        self.slow.sort(key=lambda call: call["elapsed"], reverse=True)
+        del self.slow[MAX_SLOW_CALLS:]
+
+
+_window: Optional[_Window] = None
+
+
+def configure(slow_seconds: float = 1.0, sample_interval: float = 0.01):
+    global _slow_seconds, _sample_interval
+    _slow_seconds = slow_seconds
+    _sample_interval = max(sample_interval, 0.001)
+
+
+def is_active() -> bool:
+    return _window is not None
+
+
+def stop():
+    """Закончить текущее окно досрочно (run_window вернёт то, что успели собрать)."""
+    if _window is not None:
+        _window.done.set()
+
+
+async def run_window(duration: float) -> Dict[str, Any]:
+    """
+    Окно профилирования на duration сек (вызывать из event loop — его поток и сэмплируется).
+    Одно окно за раз: если уже идёт, RuntimeError.
+    """
+    global _window
+    if _window is not None:
+        raise RuntimeError("Профилирование уже идёт")
+    window = _window = _Window(duration)
+    window._sampler.start()
+    logger.info("Профилирование: окно %.0f сек, порог медленных вызовов %.2f сек", duration, _slow_seconds)
+    try:
+        try:
+            await asyncio.wait_for(window.done.wait(), duration)
+        except asyncio.TimeoutError:
+            pass
+    finally:
+        window._stop.set()
+        _window = None
+        # Сэмплер просыпается раз в sample_interval — ждать его недолго, но из потока
+        await asyncio.to_thread(window._sampler.join, 1.0)
+
+    elapsed = time.perf_counter() - window.started
+    logger.info(
+        "Профилирование завершено: %.0f сек, %s сэмплов, медленных вызовов %s",
+        elapsed,
+        window.samples,
+        len(window.slow),
+    )
+    return {
+        "started_at": window.started_at,
+        "elapsed": elapsed,
+        "samples": window.samples,
+        "sample_interval": _sample_interval,
+        "slow_seconds": _slow_seconds,
+        "folded": "".join(f"{stack} {n}\n" for stack, n in window.stacks.most_common()),
+        "slow": window.slow,
+    }
+
+
+def track(callback: Callable[..., Awaitable], name: Optional[str] = None) -> Callable[..., Awaitable]:
+    """Обёртка хендлера PTB или job: во время окна меряет вызов и профилирует медленные."""
+    call_name = name or getattr(callback, "__name__", "call")
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        window = _window
+        if window is None:
+            return await callback(*args, **kwargs)
+
+        profile = None
+        if not window.profiling:
+            window.profiling = True
+            profile = cProfile.Profile()
+            profile.enable()
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+                window.profiling = False
+            if elapsed >= _slow_seconds:
+                window.add_slow(call_name, elapsed, profile)
+
+    return wrapper
+
+
+def format_slow_report(data: Dict[str, Any]) -> str:
+    """Медленные вызовы окна текстом (для файла отчёта)."""
+    lines = [
+        f"Окно профилирования {data['started_at']:%d.%m.%Y %H:%M:%S}, {data['elapsed']:.0f} сек",
+        f"Медленные вызовы (≥ {data['slow_seconds']:.2f} сек), самые долгие первыми:",
+        "",
+    ]
+    for call in data["slow"]:
+        lines.append(f"=== {call['name']}: {call['elapsed']:.3f} сек ({call['at']:%H:%M:%S})")
+        lines.append(call["profile"] or "(без профиля: в это время профилировался другой вызов)")
+        lines.append("")
+    return "\n".join(lines)
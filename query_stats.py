@@ -0,0 +1,246 @@
+"""
+Учёт SQL-запросов по единицам работы и поиск N+1.
+
+Слушатели before/after_cursor_execute на Database.engine записывают каждый
+запрос: отпечаток (текст без литералов и лишних пробелов), время и число строк.
+Запросы относятся к текущей единице работы — апдейту (хендлеру PTB), job или
+HTTP-запросу вебхука (track / unit, через contextvar; задачи, порождённые
+внутри, наследуют единицу).
+
+По окончании единицы срабатывает предупреждение, если она выполнила больше
+max_statements запросов или один отпечаток повторился repeat_threshold раз
+(запрос в цикле по строкам). Предупреждения пишутся в лог и в метрики,
+последние хранятся в памяти; сводку показывает админ-команда /sql_stats.
+"""
+
+import functools
+import logging
+import re
+import time
+from collections import Counter as _Counter, OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SQL_STATEMENTS = REGISTRY.counter("sql_statements_total", "SQL-запросы по единицам работы", ["unit"])
+QUERY_ALERTS = REGISTRY.counter("query_alerts_total", "Предупреждения о лишних запросах", ["unit", "kind"])
+
+# Пороги предупреждений (configure)
+_max_statements = 50
+_repeat_threshold = 10
+
+# Сколько разных отпечатков и предупреждений держать в памяти
+MAX_FINGERPRINTS = 500
+MAX_ALERTS = 50
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """Текст запроса без литералов и переносов: одинаковый для всех вызовов одного места в коде."""
+    text = _STRING_LITERAL.sub("?", statement)
+    text = _NUMBER.sub("?", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+class _Unit:
+    __slots__ = ("name", "statements", "db_time", "fingerprints")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.statements = 0
+        self.db_time = 0.0
+        self.fingerprints: _Counter = _Counter()
+
+
+_current_unit: ContextVar[Optional[_Unit]] = ContextVar("korkut_query_unit", default=None)
+
+# отпечаток -> [запусков, суммарное время, максимум, строк]
+_fingerprints: "OrderedDict[str, list]" = OrderedDict()
+# единица работы -> [запусков, запросов, максимум запросов за запуск, время в БД]
+_units: Dict[str, list] = {}
+_alerts: Deque[Dict[str, Any]] = deque(maxlen=MAX_ALERTS)
+_started_at = datetime.now()
+
+
+def configure(max_statements: int = 50, repeat_threshold: int = 10):
+    global _max_statements, _repeat_threshold
+    _max_statements = max_statements
+    _repeat_threshold = repeat_threshold
+
+
+def attach(engine: AsyncEngine):
+    """Подключить учёт к движку (повторный вызов для того же движка ничего не делает)."""
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "after_cursor_execute", _after_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._korkut_query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_korkut_query_started", None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    rows = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+    key = fingerprint(statement)
+
+    entry = _fingerprints.get(key)
+    if entry is None:
+        entry = _fingerprints[key] = [0, 0.0, 0.0, 0]
+        if len(_fingerprints) > MAX_FINGERPRINTS:
+            _fingerprints.popitem(last=False)
+    else:
+        _fingerprints.move_to_end(key)
+    entry[0] += 1
+    entry[1] += duration
+    entry[2] = max(entry[2], duration)
+    entry[3] += rows
+
+    unit = _current_unit.get()
+    if unit is not None:
+        unit.statements += 1
+        unit.db_time += duration
+        unit.fingerprints[key] += 1
+        SQL_STATEMENTS.inc(unit=unit.name)
+    else:
+        SQL_STATEMENTS.inc(unit="other")
+
+
+@contextmanager
+def unit(name: str) -> Iterator[None]:
+    """
+    Единица работы для учёта запросов. Вложенная единица (шард внутри job)
+    считается отдельно: запрос относится к самой внутренней.
+    """
+    current = _Unit(name)
+    token = _current_unit.set(current)
+    try:
+        yield
+    finally:
+        _current_unit.reset(token)
+        _finish(current)
+
+
+def track(callback: Callable[..., Awaitable], name: Optional[str] = None) -> Callable[..., Awaitable]:
+    """Обёртка хендлера PTB или job: каждый вызов — отдельная единица работы."""
+    unit_name = name or getattr(callback, "__name__", "unit")
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        with unit(unit_name):
+            return await callback(*args, **kwargs)
+
+    return wrapper
+
+
+def _finish(current: _Unit):
+    if not current.statements:
+        return
+    stats = _units.setdefault(current.name, [0, 0, 0, 0.0])
+    stats[0] += 1
+    stats[1] += current.statements
+    stats[2] = max(stats[2], current.statements)
+    stats[3] += current.db_time
+
+    repeated = [(key, n) for key, n in current.fingerprints.most_common(3) if n >= _repeat_threshold]
+    too_many = current.statements > _max_statements
+    if not repeated and not too_many:
+        return
+
+    alert = {
+        "at": datetime.now(),
+        "unit": current.name,
+        "statements": current.statements,
+        "db_time": current.db_time,
+        "repeated": repeated,
+    }
+    _alerts.append(alert)
+    if too_many:
+        QUERY_ALERTS.inc(unit=current.name, kind="too_many")
+    if repeated:
+        QUERY_ALERTS.inc(unit=current.name, kind="repeated")
+
+    logger.warning(
+        "SQL: %s выполнил %s запросов за %.3f сек%s",
+        current.name,
+        current.statements,
+        current.db_time,
+        "".join(f"; повтор {n}× (N+1?): {key[:200]}" for key, n in repeated),
+    )
+
+
+def snapshot(top: int = 10) -> Dict[str, Any]:
+    """Сводка для админ-команды: самые дорогие запросы, единицы работы, последние предупреждения."""
+    fingerprints = sorted(_fingerprints.items(), key=lambda item: item[1][1], reverse=True)
+    units = sorted(_units.items(), key=lambda item: item[1][1] / item[1][0], reverse=True)
+    return {
+        "since": _started_at,
+        "statements": sum(v[0] for v in _fingerprints.values()),
+        "db_time": sum(v[1] for v in _fingerprints.values()),
+        "top_queries": [
+            {"fingerprint": key, "count": v[0], "total": v[1], "max": v[2], "rows": v[3]}
+            for key, v in fingerprints[:top]
+        ],
+        "units": [
+            {"unit": name, "runs": v[0], "avg_statements": v[1] / v[0], "max_statements": v[2], "db_time": v[3]}
+            for name, v in units[:top]
+        ],
+        "alerts": list(_alerts)[-top:],
+        "max_statements": _max_statements,
+        "repeat_threshold": _repeat_threshold,
+    }
+
+
+def reset():
+    global _started_at
+    _fingerprints.clear()
+    _units.clear()
+    _alerts.clear()
+    _started_at = datetime.now()
+
+
+def format_report(data: Dict[str, Any], query_width: int = 120) -> List[str]:
+    """Сводка snapshot() текстом для Telegram (строки, без разметки)."""
+    lines = [
+        f"🗄 SQL с {data['since']:%d.%m %H:%M}: {data['statements']} запросов, {data['db_time']:.2f} сек в БД",
+        f"Пороги: > {data['max_statements']} запросов на единицу работы, повтор ≥ {data['repeat_threshold']}",
+        "",
+        "Самые дорогие запросы:",
+    ]
+    for i, q in enumerate(data["top_queries"], 1):
+        lines.append(
+            f"{i}. {q['count']}× {q['total']:.2f} с (max {q['max'] * 1000:.0f} мс, строк {q['rows']}): "
+            f"{q['fingerprint'][:query_width]}"
+        )
+    lines += ["", "Запросов на единицу работы (среднее / максимум):"]
+    for u in data["units"]:
+        lines.append(
+            f"• {u['unit']}: {u['avg_statements']:.1f} / {u['max_statements']} за {u['runs']} запусков, "
+            f"{u['db_time']:.2f} с в БД"
+        )
+    if data["alerts"]:
+        lines += ["", "Последние предупреждения:"]
+        for a in reversed(data["alerts"]):
+            repeated = "; ".join(f"{n}× {key[:query_width]}" for key, n in a["repeated"])
+            lines.append(
+                f"⚠️ {a['at']:%d.%m %H:%M:%S} {a['unit']}: {a['statements']} запросов"
+                + (f"; повтор {repeated}" if repeated else "")
+            )
+    return lines
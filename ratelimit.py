@@ -0,0 +1,228 @@
+"""
+Ограничение частоты вызовов Telegram Bot API.
+
+TokenBucket — асинхронный token bucket (rate токенов в секунду, запас capacity)
+с приоритетами ожидающих.
+SendScheduler — rate limiter для PTB (ApplicationBuilder().rate_limiter(...)):
+все запросы бота проходят через общий bucket (~30/с) и bucket чата,
+в порядке приоритета; после RetryAfter запрос повторяется автоматически.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_ERRORS, TELEGRAM_SECONDS, TELEGRAM_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты отправки (меньше — важнее). Передаются как rate_limit_args=...
+# Начинаются с 1: PTB не передаёт лимитеру «пустые» rate_limit_args, в т.ч. 0.
+PRIORITY_PAYMENT = 1  # подтверждения оплаты
+PRIORITY_JOIN = 2  # заявки на вступление в канал
+PRIORITY_FUNNEL = 3  # ответы в воронке (по умолчанию)
+PRIORITY_BULK = 4  # ретаргетинг, массовые кики и уведомления из ежедневных job
+
+# Методы, которые отправляют сообщение в чат и подпадают под лимит чата
+_CHAT_LIMITED_PREFIXES = ("send", "copyMessage", "forwardMessage")
+
+
+def retry_after_seconds(err: RetryAfter) -> float:
+    """RetryAfter.retry_after в секундах (PTB отдаёт int или timedelta)."""
+    delay = err.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class TokenBucket:
+    """
+    Асинхронный token bucket.
+    Ожидающие получают токены по приоритету, при равном приоритете — по очереди (FIFO).
+    pause() останавливает выдачу всем ожидающим этого bucket: RetryAfter ставит
+    на паузу bucket чата, а если 429 может быть общим флуд-лимитом — и общий bucket
+    (см. SendScheduler.process_request).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = asyncio.Condition()
+        self._waiting: List[tuple] = []
+        self._seq = itertools.count()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    async def acquire(self, tokens: float = 1.0, priority: int = 0):
+        entry = (priority, next(self._seq))
+        async with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    if self._waiting[0] is not entry:
+                        await self._cond.wait()
+                        continue
+
+                    now = time.monotonic()
+                    delay = self._paused_until - now
+                    if delay <= 0:
+                        self._refill(now)
+                        if self._tokens >= tokens:
+                            self._tokens -= tokens
+                            heapq.heappop(self._waiting)
+                            self._cond.notify_all()
+                            return
+                        delay = (tokens - self._tokens) / self.rate
+
+                    # Ждём токен, но просыпаемся, если в очередь встал кто-то важнее
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                raise
+
+    @property
+    def available(self) -> float:
+        """Сколько токенов можно взять прямо сейчас."""
+        self._refill(time.monotonic())
+        return self._tokens
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class SendScheduler(BaseRateLimiter[int]):
+    """
+    Планировщик исходящих запросов к Bot API.
+
+    - общий bucket на весь бот (global_rate запросов/сек);
+    - для отправки сообщений — ещё и bucket чата: личка ~1/с, группы/каналы 20/мин;
+    - очередь к общему bucket идёт по приоритету (rate_limit_args, см. PRIORITY_*);
+    - RetryAfter ставит на паузу bucket чата (лимит Telegram на чат) и общий
+      bucket, если ограничение может быть на весь бот: запрос без чата, рассылка
+      (PRIORITY_BULK) или bucket чата уже пуст; запрос встаёт в очередь
+      заново (не больше max_retries повторов);
+    - before_request (если задан) вызывается перед ожиданием в очереди — в задаче
+      того, кто отправляет: бот закрывает в нём транзакцию апдейта.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        *,
+        private_chat_rate: float = 1.0,
+        private_chat_burst: float = 3.0,
+        group_chat_rate: float = 20 / 60,
+        group_chat_burst: float = 20.0,
+        max_retries: int = 3,
+        max_tracked_chats: int = 10000,
+        before_request: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.global_bucket = TokenBucket(rate=global_rate)
+        self.private_chat_rate = private_chat_rate
+        self.private_chat_burst = private_chat_burst
+        self.group_chat_rate = group_chat_rate
+        self.group_chat_burst = group_chat_burst
+        self.max_retries = max_retries
+        self.max_tracked_chats = max_tracked_chats
+        self.before_request = before_request
+        self._chat_buckets: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chat_buckets.clear()
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+            if is_group:
+                bucket = TokenBucket(rate=self.group_chat_rate, capacity=self.group_chat_burst)
+            else:
+                bucket = TokenBucket(rate=self.private_chat_rate, capacity=self.private_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > self.max_tracked_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        if self.before_request is not None:
+            await self.before_request()
+        priority = rate_limit_args if rate_limit_args is not None else PRIORITY_FUNNEL
+        chat_id = data.get("chat_id")
+        chat_bucket = None
+        if chat_id is not None and endpoint.startswith(_CHAT_LIMITED_PREFIXES):
+            chat_bucket = self._chat_bucket(chat_id)
+
+        attempt = 0
+        while True:
+            queued = time.perf_counter()
+            if chat_bucket is not None:
+                await chat_bucket.acquire(priority=priority)
+            await self.global_bucket.acquire(priority=priority)
+            started = time.perf_counter()
+            TELEGRAM_WAIT_SECONDS.observe(started - queued, method=endpoint)
+            try:
+                return await callback(*args, **kwargs)
+            except Exception as e:
+                TELEGRAM_ERRORS.inc(method=endpoint, error=type(e).__name__)
+                if not isinstance(e, RetryAfter):
+                    raise
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                self.retries += 1
+                logger.warning(
+                    "Telegram RetryAfter %.1f сек (%s, chat=%s), повтор %s/%s",
+                    delay,
+                    endpoint,
+                    chat_id,
+                    attempt,
+                    self.max_retries,
+                )
+                if chat_bucket is not None:
+                    chat_bucket.pause(delay)
+                # Флуд в один чат не должен останавливать отправку остальным. Но если
+                # bucket чата уже пуст (шлём на пределе) или шла рассылка, 429 может
+                # быть общим флуд-лимитом бота — тогда стоят все
+                if chat_bucket is None or priority >= PRIORITY_BULK or chat_bucket.available < 1:
+                    self.global_bucket.pause(delay)
+            finally:
+                TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=endpoint)
@@ -0,0 +1,80 @@
+"""
+Клиент рекуррентных платежей Robokassa (/Merchant/Recurring).
+
+Один долгоживущий httpx.AsyncClient с keep-alive пулом на весь процесс:
+без нового TCP+TLS рукопожатия на каждого подписчика.
+Параллельность ограничена семафором, частота запросов — TokenBucket.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from metrics import RECURRING_REQUESTS, RECURRING_SECONDS
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECURRING_URL = "https://auth.robokassa.kz/Merchant/Recurring"
+
+
+class RecurringClient:
+    def __init__(
+        self,
+        url: str = DEFAULT_RECURRING_URL,
+        *,
+        timeout: float = 20.0,
+        max_concurrency: int = 10,
+        rate_per_sec: float = 5.0,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.max_concurrency = max(max_concurrency, 1)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._bucket = TokenBucket(rate=rate_per_sec)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=self.max_concurrency,
+            ),
+        )
+        logger.info("Recurring-клиент Robokassa запущен: %s", self.url)
+
+    async def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    async def charge(self, payload: Dict[str, str]) -> tuple[bool, Optional[str]]:
+        """
+        Отправить запрос дочернего платежа.
+        OK от Robokassa = операция создана, а не факт списания.
+        """
+        if self._client is None:
+            await self.start()
+
+        async with self._semaphore:
+            await self._bucket.acquire()
+            started = time.perf_counter()
+            try:
+                resp = await self._client.post(self.url, data=payload)
+            except Exception as e:
+                RECURRING_REQUESTS.inc(result="exception")
+                return False, f"Recurring exception: {e}"
+            finally:
+                RECURRING_SECONDS.observe(time.perf_counter() - started)
+
+        if resp.status_code == 200 and resp.text.strip().startswith("OK"):
+            RECURRING_REQUESTS.inc(result="ok")
+            return True, None
+        RECURRING_REQUESTS.inc(result="failed")
+        return False, f"Recurring failed: {resp.status_code} {resp.text}"
@@ -0,0 +1,119 @@
+"""
+Ежедневные job, разбитые на шарды по хэшу user_id.
+
+Запуск job (start_run, на реплике-лидере) создаёт shard_count строк в job_shards.
+Дальше шарды разбирают воркеры всех реплик (work — repeating job на каждой
+реплике плюс сам лидер сразу после старта): шард берётся в аренду через
+SELECT … FOR UPDATE SKIP LOCKED, аренда продлевается, пока шард в работе.
+Упал воркер — аренда истекает, и шард подхватывает любой другой.
+Воркер, закрывший последний шард, получает статистику всех шардов
+и отправляет общую сводку (on_finished).
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from database import Database
+from metrics import JOB_ITEMS, JOB_SECONDS
+import query_stats
+
+logger = logging.getLogger(__name__)
+
+# handler(context, shard, shard_count) -> статистика шарда (dict, уходит в JSONB)
+ShardHandler = Callable[[Any, int, int], Awaitable[Dict[str, Any]]]
+# on_finished(context, статистика всех шардов, секунд с начала запуска)
+FinishHandler = Callable[[Any, List[Dict[str, Any]], float], Awaitable[None]]
+
+
+class ShardedJobRunner:
+    def __init__(
+        self,
+        db: Database,
+        *,
+        shard_count: int = 16,
+        lease_seconds: float = 300.0,
+        concurrency: int = 2,
+    ):
+        self.db = db
+        self.shard_count = max(shard_count, 1)
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # Сколько шардов этот процесс обрабатывает одновременно
+        self._slots = asyncio.Semaphore(max(concurrency, 1))
+        self._jobs: Dict[str, tuple] = {}
+        self.shards_done = 0
+
+    def register(self, job: str, handler: ShardHandler, on_finished: Optional[FinishHandler] = None):
+        self._jobs[job] = (handler, on_finished)
+
+    async def start_run(self, job: str, run_key: str) -> bool:
+        """Создать шарды запуска run_key. False — этот запуск уже создан."""
+        started = await self.db.start_job_run(job, run_key, self.shard_count)
+        if started:
+            logger.info("Job %s (%s): запуск на %s шардов", job, run_key, self.shard_count)
+        else:
+            logger.info("Job %s (%s): запуск уже создан, пропускаем", job, run_key)
+        return started
+
+    async def work(self, context):
+        """Разбирать свободные шарды, пока они есть (callback repeating job)."""
+        if self._slots.locked():
+            # Все слоты заняты — их воркеры сами заберут следующие шарды
+            return
+        while True:
+            async with self._slots:
+                claim = await self.db.claim_job_shard(self.worker_id, self.lease_seconds)
+                if claim is None:
+                    return
+                await self._process(context, claim)
+
+    async def _process(self, context, claim: Dict[str, Any]):
+        job, run_key, shard, shard_count = claim["job"], claim["run_key"], claim["shard"], claim["shard_count"]
+        handler, on_finished = self._jobs.get(job, (None, None))
+        if handler is None:
+            # Шард job, которого эта версия бота не знает (выкатка в процессе): аренда истечёт
+            logger.warning("Неизвестный job %s в job_shards, шард %s пропущен", job, shard)
+            return
+        if claim["attempts"] > 1:
+            logger.warning("Job %s (%s): шард %s подхвачен после прерванной попытки", job, run_key, shard)
+
+        renewer = asyncio.create_task(self._renew_lease(job, run_key, shard))
+        started = time.perf_counter()
+        try:
+            with query_stats.unit(f"{job}_shard"):
+                stats = await handler(context, shard, shard_count)
+        except Exception as e:
+            # Шард закрываем с ошибкой: повтор того же исключения не поможет,
+            # а запуск должен завершиться и прислать сводку
+            logger.error("Job %s (%s): ошибка в шарде %s: %s", job, run_key, shard, e)
+            stats = {"error": str(e)}
+        finally:
+            renewer.cancel()
+            JOB_SECONDS.observe(time.perf_counter() - started, job=f"{job}_shard")
+
+        for kind, value in (stats or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                JOB_ITEMS.inc(value, job=job, kind=kind)
+        if "error" in (stats or {}):
+            JOB_ITEMS.inc(job=job, kind="shard_errors")
+
+        self.shards_done += 1
+        finished = await self.db.complete_job_shard(job, run_key, shard, self.worker_id, stats or {})
+        if finished is not None:
+            logger.info("Job %s (%s): все %s шардов выполнены за %.1f сек", job, run_key, shard_count, finished["elapsed"])
+            if on_finished is not None:
+                await on_finished(context, finished["stats"], finished["elapsed"])
+
+    async def _renew_lease(self, job: str, run_key: str, shard: int):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                if not await self.db.renew_job_shard(job, run_key, shard, self.worker_id, self.lease_seconds):
+                    logger.warning("Job %s (%s): аренда шарда %s потеряна", job, run_key, shard)
+                    return
+            except Exception as e:
+                logger.warning("Job %s (%s): не удалось продлить аренду шарда %s: %s", job, run_key, shard, e)
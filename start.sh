@@ -1,6 +1,17 @@
 #!/usr/bin/env bash
 set -euo pipefail
 
+# Миграции схемы до старта процессов: дальше они только сверяют версию
+python migrations.py
+
+# Режим вебхука Telegram: бот работает внутри uvicorn, отдельный процесс не нужен
+WEBHOOK_MODE="${TELEGRAM_WEBHOOK_MODE:-false}"
+case "${WEBHOOK_MODE,,}" in
+  true|1|yes)
+    exec uvicorn webhook:app --host 0.0.0.0 --port 8000
+    ;;
+esac
+
 # Запуск бота (polling) и вебхука (uvicorn) в одном контейнере
 python bot.py &
 BOT_PID=$!
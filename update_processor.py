@@ -0,0 +1,105 @@
+"""
+Обработка апдейтов Telegram.
+
+UnitOfWorkUpdateProcessor оборачивает обработку каждого апдейта в
+Database.unit_of_work(): все обращения хендлеров к БД идут через одну сессию
+и одну транзакцию, вместо отдельной транзакции (и отдельного соединения из пула)
+на каждый вызов Database. Транзакция коммитится перед каждым запросом к Telegram
+(SendScheduler.before_request) и в конце апдейта: соединение не держится,
+пока запрос ждёт лимитер и сеть.
+
+OrderedUpdateProcessor добавляет параллельную обработку: до
+max_concurrent_updates апдейтов одновременно, но апдейты одного чата
+(пользователя) — строго по очереди, в порядке поступления.
+
+Подключение: ApplicationBuilder().concurrent_updates(OrderedUpdateProcessor(db, n)).
+"""
+
+import asyncio
+import contextlib
+import inspect
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Chat, Update
+from telegram.ext import BaseUpdateProcessor
+
+from database import Database
+
+
+class UnitOfWorkUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, db: Database, max_concurrent_updates: int = 1):
+        super().__init__(max_concurrent_updates)
+        self.db = db
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        async with self.db.unit_of_work():
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class OrderedUpdateProcessor(UnitOfWorkUpdateProcessor):
+    """
+    Замок чата берётся раньше слота пула: пока апдейт ждёт предыдущий апдейт
+    того же чата, он не занимает слот и не мешает другим пользователям.
+    asyncio.Lock отдаётся ожидающим по очереди (FIFO), а Application создаёт
+    задачи в порядке поступления апдейтов — так сохраняется порядок внутри чата.
+    """
+
+    def __init__(self, db: Database, max_concurrent_updates: int = 8):
+        super().__init__(db, max(max_concurrent_updates, 1))
+        # ключ -> [замок, сколько апдейтов его держат или ждут]
+        self._locks: Dict[Any, list] = {}
+        self._queued = 0
+
+    @staticmethod
+    def _ordering_key(update: object) -> Optional[Any]:
+        if not isinstance(update, Update):
+            return None
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is not None and (chat.type == Chat.CHANNEL or update.chat_join_request is not None):
+            # effective_chat — канал, общий для всех: иначе заявки на вступление всех
+            # пользователей шли бы по одной. Ключ — id пользователя, он же id его лички:
+            # заявка встаёт в одну очередь с его сообщениями боту
+            return user.id if user is not None else None
+        if chat is not None:
+            return chat.id
+        if user is not None:
+            return ("user", user.id)
+        return None
+
+    @property
+    def queued_updates(self) -> int:
+        """Апдейты, ждущие свою очередь в чате или свободный слот пула."""
+        return self._queued
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._ordering_key(update)
+        entry = None
+        if key is not None:
+            entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+
+        waiting = True
+        self._queued += 1
+        try:
+            async with entry[0] if entry is not None else contextlib.nullcontext():
+                async with self._semaphore:
+                    waiting = False
+                    self._queued -= 1
+                    await self.do_process_update(update, coroutine)
+        finally:
+            if waiting:
+                # Отменили, пока ждали очереди: корутина хендлеров так и не запустилась
+                self._queued -= 1
+                if inspect.iscoroutine(coroutine):
+                    coroutine.close()
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._locks.pop(key, None)
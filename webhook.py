@@ -1,9 +1,11 @@
 """
 Простой FastAPI-вебхук для приема Result URL от Robokassa.
 - Проверяет MD5-подпись (Пароль #2)
-- Идемпотентно сохраняет платёж
-- Продлевает/активирует подписку (pending-инвойсы поддерживаются)
-- Отправляет пользователю ссылку на канал
+- Идемпотентно сохраняет платёж и продлевает/активирует подписку
+  одной транзакцией (Database.apply_payment, pending-инвойсы поддерживаются)
+- Отправляет пользователю ссылку на канал и ставит её в очередь на удаление
+- В режиме TELEGRAM_WEBHOOK_MODE принимает апдейты Telegram (POST /telegram/webhook)
+  и обрабатывает их приложением бота в этом же процессе
 
 Запуск (пример):
     uvicorn webhook:app --host 0.0.0.0 --port 8000
@@ -12,15 +14,17 @@ Result URL в кабинете Robokassa:
 Метод: POST
 """
 
-import asyncio
+import hmac
 import logging
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Dict
 
 from fastapi import FastAPI, HTTPException, Request, status
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response
 from dotenv import load_dotenv
-from telegram import Bot
+from telegram import Update
+from telegram.ext import ExtBot
 
 from config import (
     TELEGRAM_TOKEN,
@@ -29,9 +33,20 @@ from config import (
     ROBOKASSA_TEST_MODE,
     RENEWAL_PERIOD_DAYS,
     RECURRING_LEAD_DAYS,
+    TELEGRAM_GLOBAL_RATE_PER_SEC,
+    TELEGRAM_API_BASE_URL,
+    TELEGRAM_WEBHOOK_MODE,
+    TELEGRAM_WEBHOOK_URL,
+    TELEGRAM_WEBHOOK_SECRET,
+    QUERY_ALERT_MAX_STATEMENTS,
+    QUERY_ALERT_REPEAT,
 )
+import bot as bot_app
 from bot import verify_payment_signature, TEXTS, build_after_payment_keyboard
 from database import Database
+from metrics import CONTENT_TYPE, HTTP_SECONDS, REGISTRY
+import query_stats
+from ratelimit import SendScheduler, PRIORITY_PAYMENT
 
 load_dotenv()
 
@@ -46,39 +61,98 @@ if not TELEGRAM_TOKEN:
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL не задан (проверьте .env)")
 
-db = Database(DATABASE_URL)
-db.init_database()
+if TELEGRAM_WEBHOOK_MODE:
+    if not TELEGRAM_WEBHOOK_URL:
+        raise RuntimeError("TELEGRAM_WEBHOOK_URL не задан (проверьте .env)")
+    if not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET не задан (проверьте .env)")
+    if not bot_app.check_config():
+        raise RuntimeError("Не хватает настроек бота (подробности в логе)")
+
+    # Бот работает в этом процессе: пул БД, Bot и планировщик отправки общие
+    # для апдейтов Telegram и Result URL Robokassa
+    application = bot_app.build_application()
+    db = bot_app.db
+    bot = application.bot
+else:
+    application = None
+
+    # Кэш подписок здесь не включаем: вебхук продлевает подписки и должен
+    # видеть изменения, сделанные процессом бота, без задержки.
+    db = Database(DATABASE_URL)
+
+    # Тот же планировщик отправки, что и в боте: лимиты Telegram и повтор после RetryAfter
+    bot = ExtBot(
+        token=TELEGRAM_TOKEN,
+        base_url=TELEGRAM_API_BASE_URL,
+        rate_limiter=SendScheduler(global_rate=TELEGRAM_GLOBAL_RATE_PER_SEC),
+    )
 
-bot = Bot(token=TELEGRAM_TOKEN)
+    REGISTRY.gauge("db_pool_checked_out", "Занятые соединения пула БД", db.engine.pool.checkedout)
+    query_stats.configure(max_statements=QUERY_ALERT_MAX_STATEMENTS, repeat_threshold=QUERY_ALERT_REPEAT)
+    query_stats.attach(db.engine)
 
 app = FastAPI(title="Robokassa Webhook", version="1.0.0")
 
-
-def _ensure_utc(dt: datetime) -> datetime:
-    """
-    Приводит datetime к aware UTC.
-    Если из БД пришёл naive datetime, считаем его UTC.
-    """
-    if dt.tzinfo is None:
-        return dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc)
+# Через сколько удалять сообщение со ссылкой на канал
+LINK_MESSAGE_TTL = timedelta(minutes=5)
 
 
-async def delete_message_later(chat_id: int, message_id: int, delay_seconds: int = 300):
-    """Отложенное удаление сообщения с ссылкой, чтобы нельзя было использовать её позже."""
-    await asyncio.sleep(delay_seconds)
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    """Время обработки по шаблону маршрута (korkut_http_request_seconds) и учёт SQL-запросов."""
+    started = time.perf_counter()
+    status_code = 500
     try:
-        await bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except Exception as e:
-        logger.warning("Не удалось удалить сообщение %s:%s: %s", chat_id, message_id, e)
+        # Каждый запрос — единица работы для учёта SQL (см. query_stats)
+        with query_stats.unit(f"{request.method} {request.url.path}"):
+            response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_SECONDS.observe(
+            time.perf_counter() - started,
+            route=getattr(route, "path", "unmatched"),
+            method=request.method,
+            status=status_code,
+        )
 
 
 @app.on_event("startup")
 async def on_startup():
+    if application is not None:
+        # Тот же порядок, что в Application.run_webhook; post_init подключает БД
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        await application.bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+        )
+        logger.info("🤖 Бот принимает апдейты через вебхук: %s", TELEGRAM_WEBHOOK_URL)
+    else:
+        await db.init_database()
     mode = "ТЕСТОВЫЙ" if ROBOKASSA_TEST_MODE else "БОЕВОЙ"
     logger.info("🚀 Robokassa webhook запущен (%s)", mode)
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    if application is not None:
+        # Вебхук в Telegram не снимаем: пока процесс перезапускается,
+        # Telegram копит апдейты и доставит их после старта.
+        # post_shutdown закрывает пул БД (он общий с db)
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+    else:
+        await db.close()
+
+
 def _form_to_dict(form_data) -> Dict[str, str]:
     """Приводим starlette.datastructures.FormData к обычному dict."""
     return {k: v for k, v in form_data.items()}
@@ -89,6 +163,43 @@ async def health():
     return "ok"
 
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики процесса в текстовом формате Prometheus (см. metrics.py)."""
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+if application is not None:
+
+    @app.post("/telegram/webhook", response_class=PlainTextResponse)
+    async def telegram_webhook(request: Request):
+        """
+        Апдейт от Telegram. Подлинность — по секрету из set_webhook
+        (заголовок X-Telegram-Bot-Api-Secret-Token).
+        Апдейт только ставится в очередь приложения: ответ уходит сразу,
+        обработка идёт через OrderedUpdateProcessor, как и при polling.
+        """
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+            logger.warning("Апдейт Telegram с неверным секретом от %s", request.client)
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="bad secret token",
+            )
+
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logger.warning("Некорректный апдейт Telegram: %s", e)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="bad update",
+            )
+
+        await application.update_queue.put(update)
+        return "ok"
+
+
 @app.post("/robokassa/result", response_class=PlainTextResponse)
 async def robokassa_result(request: Request):
     """
@@ -146,101 +257,31 @@ async def robokassa_result(request: Request):
             detail="bad numeric fields",
         )
 
-    # Идемпотентность: если платёж уже записан — просто отвечаем OK
-    if db.payment_exists(inv_id_int):
-        logger.info(
-            "Duplicate ResultURL ignored (payment exists): user=%s inv_id=%s",
-            user_id,
-            inv_id,
-        )
-        return PlainTextResponse(content=f"OK{inv_id}")
-
-    period_days = RENEWAL_PERIOD_DAYS or 30
-    recurring_lead_days = RECURRING_LEAD_DAYS or 1
-    now_dt = datetime.now(timezone.utc)
-
-    existing = db.get_subscription(user_id_int)
-
-    # Продлеваем от max(expires_at, now)
-    if existing and existing.get("expires_at"):
-        existing_expires = _ensure_utc(existing["expires_at"])
-        base_dt = existing_expires if existing_expires > now_dt else now_dt
-    else:
-        base_dt = now_dt
-
-    new_expires_at = base_dt + timedelta(days=period_days)
-    new_next_charge_at = new_expires_at - timedelta(days=recurring_lead_days)
-
-    # Якорь: первый успешный inv_id фиксируем, дальше не меняем
-    anchor_inv_id = existing.get("anchor_inv_id") if existing else None
-    if not anchor_inv_id:
-        anchor_inv_id = inv_id_int
-
-    is_confirmed_pending = (
-        existing
-        and existing.get("pending_inv_id")
-        and int(existing["pending_inv_id"]) == inv_id_int
+    # Идемпотентность, блокировка подписки и продление — одной транзакцией
+    result = await db.apply_payment(
+        user_id=user_id_int,
+        inv_id=inv_id_int,
+        amount=amount_float,
+        period_days=RENEWAL_PERIOD_DAYS or 30,
+        recurring_lead_days=RECURRING_LEAD_DAYS or 1,
+        currency="KZT",
+        raw_payload=payload,
     )
 
-    # Подтверждённый recurring pending
-    if is_confirmed_pending:
-        db.clear_pending_charge(user_id_int)
-        db.renew_subscription(
-            user_id=user_id_int,
-            expires_at=new_expires_at,
-            next_charge_at=new_next_charge_at,
-            anchor_inv_id=anchor_inv_id,
-        )
+    if not result["notify"]:
         logger.info(
-            "Pending recurring confirmed: user=%s inv_id=%s new_expires_at=%s",
+            "Duplicate ResultURL ignored (payment exists): user=%s inv_id=%s",
             user_id,
             inv_id,
-            new_expires_at,
         )
-    else:
-        # Обычный первый / ручной / не-pending платёж
-        if existing:
-            # Если у пользователя завис старый pending, а он оплатил вручную —
-            # очищаем pending, чтобы логика не залипла.
-            if existing.get("pending_inv_id"):
-                db.clear_pending_charge(user_id_int)
-
-            db.renew_subscription(
-                user_id=user_id_int,
-                expires_at=new_expires_at,
-                next_charge_at=new_next_charge_at,
-                anchor_inv_id=anchor_inv_id,
-            )
-            logger.info(
-                "Manual/initial payment applied to existing subscription: user=%s inv_id=%s new_expires_at=%s",
-                user_id,
-                inv_id,
-                new_expires_at,
-            )
-        else:
-            db.add_subscription(
-                user_id=user_id_int,
-                username=f"user_{user_id}",
-                expires_at=new_expires_at,
-                payment_amount=amount_float,
-                anchor_inv_id=anchor_inv_id,
-                next_charge_at=new_next_charge_at,
-            )
-            logger.info(
-                "New subscription created from payment: user=%s inv_id=%s new_expires_at=%s",
-                user_id,
-                inv_id,
-                new_expires_at,
-            )
+        return PlainTextResponse(content=f"OK{inv_id}")
 
-    # Пишем платёж после успешной обработки
-    db.add_payment(
-        user_id=user_id_int,
-        amount=amount_float,
-        currency="KZT",
-        invoice_payload=f"robokassa_{inv_id}",
-        inv_id=inv_id_int,
-        raw_payload=payload,
+    logger.info(
+        "Payment applied (%s): user=%s inv_id=%s new_expires_at=%s",
+        result["status"],
+        user_id,
+        inv_id,
+        result["expires_at"],
     )
 
     # Отправляем пользователю ссылку на канал и управление автоплатежом
@@ -249,8 +290,12 @@ async def robokassa_result(request: Request):
             chat_id=user_id_int,
             text=TEXTS["after_payment"].format(channel_link=CHANNEL_LINK),
             reply_markup=build_after_payment_keyboard(),
+            rate_limit_args=PRIORITY_PAYMENT,
+        )
+        # Удалит воркер очереди в процессе бота (переживает рестарты обоих)
+        await db.schedule_message_deletion(
+            user_id_int, msg.message_id, datetime.now(timezone.utc) + LINK_MESSAGE_TTL
         )
-        asyncio.create_task(delete_message_later(user_id_int, msg.message_id))
     except Exception as e:
         logger.warning("Не удалось отправить сообщение пользователю %s: %s", user_id, e)
 